@@ -14,6 +14,13 @@ from . import datajack
 # So that from outside this package we can do e.g. datajack.Element()
 Element = datajack.code.Element.Element
 Entry = datajack.code.Element.Entry
+Path = datajack.code.Element.Path
+compile_path = datajack.code.Element.compile_path
+PathSet = datajack.code.Element.PathSet
+iterparse = datajack.code.stream.iterparse
+iterparse_file = datajack.code.stream.iterparse_file
+FeedParser = datajack.code.stream.FeedParser
+Document = datajack.code.flat.Document
 
 
 
@@ -0,0 +1,694 @@
+#!/usr/bin/python3
+
+
+
+
+# Imports
+import os
+import sys
+import tempfile
+import subprocess
+import time
+import tracemalloc
+import argparse
+import logging
+
+
+
+
+# Local imports
+# (Can't use relative imports because this is a top-level script)
+import datajack
+
+
+
+
+# Shortcuts
+Element = datajack.code.Element.Element
+Entry = datajack.code.Element.Entry
+Document = datajack.code.flat.Document
+iterparse = datajack.code.stream.iterparse
+Path = datajack.code.Element.Path
+compile_path = datajack.code.Element.compile_path
+
+
+
+
+# Notes:
+# - This script measures the performance of the datajack package on generated EML documents.
+# - Example commands:
+# -- python3 benchmark.py --task parse
+# -- python3 benchmark.py --task parse --size 5000
+# -- python3 benchmark.py --task entry --size 10
+# -- python3 benchmark.py --task nodes
+# -- python3 benchmark.py --task events
+# -- python3 benchmark.py --task file
+# -- python3 benchmark.py --task memory
+# -- python3 benchmark.py --task flat
+# -- python3 benchmark.py --task serialize
+# -- python3 benchmark.py --task path
+# -- python3 benchmark.py --task siblings
+# -- python3 benchmark.py --task extract
+# -- python3 benchmark.py --task paths
+# -- python3 benchmark.py --task json
+# -- python3 benchmark.py --task from_dict
+# -- python3 benchmark.py --task copy
+
+
+
+
+# Set up logger for this module. By default, it logs at ERROR level.
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+logger.setLevel(logging.ERROR)
+log = logger.info
+deb = logger.debug
+
+
+
+
+def setup(
+    log_level = 'error',
+    debug = False,
+    log_timestamp = False,
+    log_file = None,
+    ):
+  logger_name = 'benchmark'
+  # Configure logger for this module.
+  datajack.util.module_logger.configure_module_logger(
+    logger = logger,
+    logger_name = logger_name,
+    log_level = log_level,
+    debug = debug,
+    log_timestamp = log_timestamp,
+    log_file = log_file,
+  )
+  deb('Setup complete.')
+  # Configure logging levels for datajack package.
+  datajack.setup(
+    log_level = log_level,
+    debug = debug,
+    log_timestamp = log_timestamp,
+    log_file = log_file,
+  )
+
+
+
+
+def main():
+
+  parser = argparse.ArgumentParser(
+    description='Performance benchmarks for the datajack package.'
+  )
+
+  parser.add_argument(
+    '-t', '--task',
+    help="Task to perform (default: '%(default)s').",
+    default='parse',
+  )
+
+  parser.add_argument(
+    '-n', '--size', type=int,
+    help="Size of the generated document. For 'parse', this is the number of articles. For 'entry', this is the number of MB (default: '%(default)s').",
+    default=1000,
+  )
+
+  parser.add_argument(
+    '-r', '--repeat', type=int,
+    help="Number of timed runs. The best time is reported (default: '%(default)s').",
+    default=3,
+  )
+
+  parser.add_argument(
+    '-l', '--log-level', type=str, dest='log_level',
+    choices=['debug', 'info', 'warning', 'error'],
+    help="Choose logging level (default: '%(default)s').",
+    default='error',
+  )
+
+  a = parser.parse_args()
+
+  # Setup
+  setup(
+    log_level = a.log_level,
+  )
+
+  # Run top-level function (i.e. the appropriate task).
+  tasks = 'parse entry nodes events file memory flat serialize path siblings extract paths json from_dict copy'.split()
+  if a.task not in tasks:
+    msg = "Unrecognised task: {}".format(a.task)
+    msg += "\nTask list: {}".format(tasks)
+    stop(msg)
+  globals()[a.task](a)  # run task.
+
+
+
+
+def parse(a):
+  # Compare the throughput of the parser engines.
+  data = build_document(a.size)
+  n_bytes = len(data)
+  print("Document: {} articles, {} bytes.".format(a.size, n_bytes))
+  results = {}
+  for engine in datajack.code.Element.parser_engines:
+    t = best_time(a.repeat, Element.from_string, data=data, engine=engine)
+    results[engine] = t
+    mb_per_s = n_bytes / t / 1e6
+    print("- engine {}: {:.3f} s ({:.2f} MB/s)".format(repr(engine), t, mb_per_s))
+  speedup = results['recursive'] / results['table']
+  print("Speedup of 'table' over 'recursive': {:.2f}x".format(speedup))
+
+
+
+
+def entry(a):
+  # Measure the parsing speed of a single large entry.
+  # Here, size is the approximate size of the entry in MB.
+  line = "VGhpcyBpcyBhIGJhc2U2NCBibG9iIHRoYXQgaXMgbG9uZ2VyIHRoYW4gaXQgbmVlZHMgdG8gYmU=\n"
+  n_lines = int(a.size * 1e6 / len(line))
+  data = '<blob>' + line * n_lines + 'An escaped \\< here.</blob>'
+  n_bytes = len(data)
+  print("Document: 1 entry, {} bytes.".format(n_bytes))
+  for engine in datajack.code.Element.parser_engines:
+    t = best_time(a.repeat, Element.from_string, data=data, engine=engine)
+    mb_per_s = n_bytes / t / 1e6
+    print("- engine {}: {:.3f} s ({:.2f} MB/s)".format(repr(engine), t, mb_per_s))
+
+
+
+
+def nodes(a):
+  # Measure the per-node cost of parsing, and the per-node cost of the argument validation that from_string and from_string_section perform.
+  # Notes:
+  # - Only the public entry point validates its arguments. Child Elements and Entries are built with from_string_trusted and from_string_section_trusted, so the validation cost is paid once per document rather than once per node.
+  data = build_document(a.size)
+  e = Element.from_string(data=data)
+  n_nodes = count_nodes(e)
+  print("Document: {} articles, {} bytes, {} nodes.".format(a.size, len(data), n_nodes))
+  t = best_time(a.repeat, Element.from_string, data=data)
+  print("- Parse time per node (engine 'recursive'): {:.2f} us".format(t / n_nodes * 1e6))
+  t2 = best_time(a.repeat, validate_arguments, data, n_nodes)
+  print("- Validation time per node (now skipped for child nodes): {:.2f} us ({:.1f}% of the parse time)".format(
+    t2 / n_nodes * 1e6, t2 / t * 100
+  ))
+
+
+def events(a):
+  # Compare the time and peak memory of building an Element tree with those of processing the same document as a stream of events.
+  data = build_document(a.size)
+  print("Document: {} articles, {} bytes.".format(a.size, len(data)))
+  t, peak = measure(Element.from_string, data=data, engine='table')
+  print("- Element.from_string (engine 'table'): {:.3f} s, peak memory {:.1f} MB".format(t, peak / 1e6))
+  t, peak = measure(count_events, data)
+  print("- iterparse: {:.3f} s, peak memory {:.1f} MB".format(t, peak / 1e6))
+
+
+def file(a):
+  # Compare Element.from_file with and without use_mmap: the parse time, the memory used by the input, and the peak memory of the whole process.
+  # Notes:
+  # - Without use_mmap, the file is read into a str, which is then parsed with the default ('recursive') engine. With use_mmap=True, the mapped bytes are parsed with the 'table' engine. For a comparison of the input alone, the str is also parsed with the 'table' engine.
+  # - The times are measured without tracemalloc, which slows the parser down a lot.
+  # - What mmap saves is the input str. The tree is the same size in both modes. So the memory of the input (the peak while the file is read into a str) and of the tree are measured separately with tracemalloc.
+  # - The peak memory allocated by each mode (the input str plus the tree, or the tree alone) is measured with tracemalloc. This is what mmap saves.
+  # - The peak resident memory (RSS) of each mode is measured in a new process, minus that of a process that only imports datajack. Pages of the mapped file are counted in the RSS while they are resident, so for an ASCII file the two peaks are close. But the OS can drop the mapped pages at any time, because they are backed by the file, whereas the str has to stay in memory (or in swap).
+  data = build_document(a.size) + '\n'
+  with tempfile.TemporaryDirectory() as dir_name:
+    file_path = os.path.join(dir_name, 'data.txt')
+    with open(file_path, 'w') as f:
+      f.write(data)
+    print("Document: {} articles, {} bytes.".format(a.size, len(data)))
+    t1 = best_time(a.repeat, Element.from_file, file_path, use_mmap=False)
+    t2 = best_time(a.repeat, parse_file_text, file_path)
+    t3 = best_time(a.repeat, Element.from_file, file_path, use_mmap=True)
+    print("- from_file: {:.3f} s".format(t1))
+    print("- read the file, then from_string (engine='table'): {:.3f} s".format(t2))
+    print("- from_file (use_mmap=True): {:.3f} s".format(t3))
+    input_size = measure(read_file_text, file_path)[1]
+    tracemalloc.start()
+    e = Element.from_file(file_path, use_mmap=True)
+    tree_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del e
+    print("- Input str: {:.1f} MB (with use_mmap=True: none)".format(input_size / 1e6))
+    print("- Tree: {:.1f} MB (the same in both modes)".format(tree_size / 1e6))
+    for use_mmap in [False, True]:
+      peak = measure(Element.from_file, file_path, use_mmap=use_mmap)[1]
+      print("- Peak memory allocated by from_file (use_mmap={}): {:.1f} MB".format(use_mmap, peak / 1e6))
+    base = peak_rss('')
+    if base is None:
+      return
+    for use_mmap in [False, True]:
+      statement = "Element.from_file({}, use_mmap={})".format(repr(file_path), use_mmap)
+      rss = peak_rss(statement) - base
+      print("- Peak RSS of from_file (use_mmap={}): {:.1f} MB".format(use_mmap, rss / 1e6))
+
+
+def read_file_text(file_path):
+  with open(file_path) as f:
+    return f.read().rstrip('\n')
+
+
+def parse_file_text(file_path):
+  return Element.from_string(data=read_file_text(file_path), engine='table')
+
+
+def peak_rss(statement):
+  # Run the statement in a new Python process that has imported datajack, and return the peak RSS of the process in bytes. Return None if this can't be measured on this platform.
+  # Notes:
+  # - On Linux, the peak is read from VmHWM in /proc/self/status. (ru_maxrss isn't used there, because it keeps the peak of the parent process across fork and exec.)
+  # - Elsewhere, ru_maxrss is used. It's in bytes on macOS.
+  try:
+    import resource
+  except ImportError:
+    return None
+  code = "import os, resource, sys, datajack\n"
+  code += "Element = datajack.code.Element.Element\n"
+  code += statement + "\n"
+  code += "if os.path.exists('/proc/self/status'):\n"
+  code += "  lines = [x for x in open('/proc/self/status') if x.startswith('VmHWM:')]\n"
+  code += "  print(int(lines[0].split()[1]) * 1024)\n"
+  code += "else:\n"
+  code += "  print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+  directory = os.path.dirname(os.path.abspath(__file__))
+  output = subprocess.check_output([sys.executable, '-c', code], cwd=directory)
+  return int(output.decode('ascii').split()[-1])
+
+
+def memory(a):
+  # Measure the memory used by a parsed tree, per node.
+  # Notes:
+  # - The memory is measured with tracemalloc, as the memory that is still allocated after parsing (i.e. the tree itself), not the peak memory.
+  # - The entry data and the names are included. To show the size of the nodes alone, we also measure the size of an empty Element and an empty Entry.
+  data = build_document(a.size)
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  e = Element.from_string(data=data, engine='table')
+  tree_size = tracemalloc.get_traced_memory()[0] - before
+  n = 10000
+  before = tracemalloc.get_traced_memory()[0]
+  elements = [Element() for i in range(n)]
+  element_size = (tracemalloc.get_traced_memory()[0] - before) / n
+  before = tracemalloc.get_traced_memory()[0]
+  entries = [Entry() for i in range(n)]
+  entry_size = (tracemalloc.get_traced_memory()[0] - before) / n
+  tracemalloc.stop()
+  n_nodes = count_nodes(e)
+  print("Document: {} articles, {} bytes, {} nodes.".format(a.size, len(data), n_nodes))
+  print("- Tree: {:.1f} MB, {:.0f} bytes per node".format(tree_size / 1e6, tree_size / n_nodes))
+  print("- Empty Element: {:.0f} bytes".format(element_size))
+  print("- Empty Entry: {:.0f} bytes".format(entry_size))
+
+
+def flat(a):
+  # Compare the memory used by an Element tree and by a flat Document, and the time taken to find all the Elements with a particular name.
+  data = build_document(a.size)
+  results = []
+  for build in [Element.from_string, Document.from_string]:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    x = build(data=data)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    results.append((x, size))
+  (e, element_size), (doc, document_size) = results
+  n_nodes = len(doc)
+  print("Document: {} articles, {} bytes, {} nodes.".format(a.size, len(data), n_nodes))
+  print("- Element tree: {:.1f} MB, {:.0f} bytes per node".format(element_size / 1e6, element_size / n_nodes))
+  print("- Flat Document: {:.1f} MB, {:.0f} bytes per node".format(document_size / 1e6, document_size / n_nodes))
+  t = best_time(a.repeat, e.get, '//title')
+  print("- Element.get('//title'): {:.4f} s".format(t))
+  t = best_time(a.repeat, doc.elements_with_name, 'title')
+  print("- Document.elements_with_name('title'): {:.4f} s".format(t))
+
+
+def serialize(a):
+  # Measure the time taken to serialize a wide document and a deep document (i.e. to build Element.data).
+  # Here, size is the number of articles in the wide document. The wrapped document contains the same articles inside a single wrapper Element. The deep document contains 500 nested Elements, each with an Entry of 2 KB. The nested document contains 4000 nested Elements with no other data.
+  wide = build_document(a.size)
+  wrapped = '<doc>' + wide + '</doc>'
+  deep = ('<a>' + 'x' * 2000) * 500 + '</a>' * 500
+  nested = '<a>' * 4000 + 'x' + '</a>' * 4000
+  # - write_data: Serialize without building the caches.
+  # - first: Build .data, which caches the data of the Element and of the large Elements below it.
+  # - cached: Get .data again.
+  # - edit: Change one Entry in the last Element and get .data again. Only the uncached Elements around the Entry are walked again, and the caches on its path to the root are joined again.
+  # - cache size: The total length of the cached data in the tree.
+  for label, data in [('wide', wide), ('wrapped', wrapped), ('deep', deep), ('nested', nested)]:
+    e = Element.from_string(data=data, engine='table')
+    t1 = best_time(a.repeat, e.write_data, [], chunk_size=None)
+    t2 = best_time(1, getattr, e, 'data')
+    t3 = best_time(a.repeat, getattr, e, 'data')
+    entry = last_entry(e)
+    t4 = best_time(a.repeat, edit_entry, e, entry)
+    cache_size = sum(len(x.cached_data) for x in [e] + list(e.iter_elements()) if x.cached_data is not None)
+    msg = "- {} document ({} bytes): write_data {:.4f} s, first {:.4f} s, cached {:.4f} s, edit {:.4f} s, cache size {} bytes"
+    print(msg.format(label, len(data), t1, t2, t3, t4, cache_size))
+
+
+def last_entry(e):
+  # Find the last Entry of the last leaf Element.
+  while not e.is_leaf:
+    e = e.element_children[-1]
+  return e.children[-1]
+
+
+def edit_entry(e, entry):
+  entry.data = entry.data
+  return e.data
+
+
+def path(a):
+  # Measure the time taken to get a value from each article with an xpath string. Compare parsing the xpath on every call with using the cache of compiled Paths. Then measure child lookups by name in a wide Element, descendant queries, and predicate queries.
+  data = build_document(a.size)
+  e = Element.from_string(data=data, engine='table')
+  articles = e.get('article')
+  xpath = 'content/link/sha256'
+  t1 = best_time(a.repeat, get_values, articles, xpath, lambda x: Path(x))
+  t2 = best_time(a.repeat, get_values, articles, xpath, compile_path)
+  p = compile_path(xpath)
+  t3 = best_time(a.repeat, get_values, articles, p, lambda x: x)
+  print("Document: {} articles. get_value('{}') on each article.".format(len(articles), xpath))
+  print("- xpath parsed on every call: {:.4f} s".format(t1))
+  print("- xpath string (cached Path): {:.4f} s".format(t2))
+  print("- compiled Path: {:.4f} s".format(t3))
+  # Look up a child by name in a wide Element (the root, which has one child per article).
+  t4 = best_time(a.repeat, has_children, e, 'title', len(articles))
+  print("- has_child('title') on the root, {} times: {:.4f} s".format(len(articles), t4))
+  # Descendant queries, with and without a NameIndex.
+  xpath = '//sha256'
+  t5 = best_time(a.repeat, descendant_queries, articles, xpath)
+  t6 = best_time(a.repeat, e.build_name_index)
+  t7 = best_time(a.repeat, descendant_queries, articles, xpath)
+  print("- get('{}') on each article, without a NameIndex: {:.4f} s".format(xpath, t5))
+  print("- get('{}') on each article, with a NameIndex: {:.4f} s (building the index: {:.4f} s)".format(xpath, t7, t6))
+
+  # Predicate queries, with and without a value index.
+  xpath = "article[@title='Article_{}']".format(len(articles) // 2)
+  t8 = best_time(a.repeat, repeat_query, e, xpath, 100)
+  e.index_values('article', 'title')
+  t9 = best_time(a.repeat, repeat_query, e, xpath, 100)
+  print("- get(\"{}\") on the root, 100 times, without a value index: {:.4f} s".format(xpath, t8))
+  print("- get(\"{}\") on the root, 100 times, with a value index: {:.4f} s".format(xpath, t9))
+
+
+def repeat_query(e, xpath, n):
+  for i in range(n):
+    e.get(xpath)
+
+
+def descendant_queries(articles, xpath):
+  for article in articles:
+    article.get(xpath)
+
+
+def has_children(e, name, n):
+  for i in range(n):
+    e.has_child(name)
+
+
+def get_values(articles, xpath, compile):
+  for article in articles:
+    article.get_one(compile(xpath)).value
+
+
+def siblings(a):
+  # Measure the time taken to walk along the children of the root Element with next_sibling.
+  data = build_document(a.size)
+  e = Element.from_string(data=data, engine='table')
+  t = best_time(a.repeat, walk_siblings, e.children[0])
+  print("Document: {} articles, {} children of the root Element.".format(a.size, e.nc))
+  print("- next_sibling walk: {:.4f} s".format(t))
+
+
+def walk_siblings(item):
+  n = 1
+  while True:
+    try:
+      item = item.next_sibling
+    except KeyError:
+      return n
+    n += 1
+
+
+def extract(a):
+  # Measure the time taken to extract a record of fields from each article: one get_value call per field, compared with a single get_value_many call.
+  data = build_document(a.size)
+  e = Element.from_string(data=data, engine='table')
+  articles = e.get('article')
+  fields = {
+    'title': 'title',
+    'author': 'author_name',
+    'date': 'date',
+    'signed': 'signed_by_author',
+    'list_title': 'content/list/title',
+    'location': 'content/list/location',
+    'link_type': 'content/link/type',
+    'filename': 'content/link/filename',
+    'sha256': 'content/link/sha256',
+  }
+  t1 = best_time(a.repeat, extract_fields, articles, fields)
+  t2 = best_time(a.repeat, extract_fields_together, articles, fields)
+  print("Document: {} articles, {} fields per article.".format(len(articles), len(fields)))
+  print("- get_value for each field: {:.4f} s".format(t1))
+  print("- get_value_many: {:.4f} s".format(t2))
+
+
+def extract_fields(articles, fields):
+  return [{k: x.get_value(xpath) for k, xpath in fields.items()} for x in articles]
+
+
+def extract_fields_together(articles, fields):
+  return [x.get_value_many(fields) for x in articles]
+
+
+def paths(a):
+  # Measure the time taken to find path_from_root for every Element in a wide document and in a deep document.
+  # Here, size is the number of articles in the wide document. The deep document contains 2000 nested Elements.
+  wide = build_document(a.size)
+  deep = '<a>' * 2000 + 'x' + '</a>' * 2000
+  for label, data in [('wide', wide), ('deep', deep)]:
+    e = Element.from_string(data=data, engine='table')
+    elements = e.element_descendants
+    t1 = best_time(1, all_paths_by_walk, elements)
+    start = time.perf_counter()
+    all_paths(elements)
+    t2 = time.perf_counter() - start
+    t3 = best_time(a.repeat, all_paths, elements)
+    print("Document ({}): {} Elements.".format(label, len(elements)))
+    print("- walk to the root for each Element: {:.4f} s".format(t1))
+    print("- path_from_root (first): {:.4f} s".format(t2))
+    print("- path_from_root (cached): {:.4f} s".format(t3))
+
+
+def all_paths(elements):
+  return [x.path_from_root for x in elements]
+
+
+def all_paths_by_walk(elements):
+  # Build each path by walking up the parent links, without using the cached paths.
+  results = []
+  for x in elements:
+    path = x.name
+    p = x.parent
+    while p.parent is not None:
+      path = p.name + '/' + path
+      p = p.parent
+    results.append(path)
+  return results
+
+
+def json(a):
+  # Measure the time taken to convert a document to a dict and to JSON, and the peak memory of to_json and write_json.
+  # Notes:
+  # - to_json builds the whole dict and the whole JSON string. write_json writes the JSON to a file in chunks, without building the dict.
+  data = build_document(a.size)
+  e = Element.from_string(data=data, engine='table')
+  t1 = best_time(a.repeat, e.to_dict)
+  print("Document: {} articles, {} bytes.".format(a.size, len(data)))
+  print("- to_dict: {:.4f} s".format(t1))
+  # to_json caches the JSON, so each measurement uses a new tree.
+  e = Element.from_string(data=data, engine='table')
+  t2 = best_time(1, e.to_json)
+  e = Element.from_string(data=data, engine='table')
+  peak2 = measure(e.to_json)[1]
+  print("- to_json: {:.4f} s, peak memory {:.1f} MB".format(t2, peak2 / 1e6))
+  e = Element.from_string(data=data, engine='table')
+  with tempfile.TemporaryDirectory() as dir_name:
+    file_path = os.path.join(dir_name, 'data.json')
+    with open(file_path, 'w') as f:
+      t3 = best_time(a.repeat, e.write_json, f)
+      peak3 = measure(e.write_json, f)[1]
+  print("- write_json: {:.4f} s, peak memory {:.1f} MB".format(t3, peak3 / 1e6))
+
+
+def from_dict(a):
+  # Measure the time taken to build an Element tree from a dict (from_dict), compared with the previous recursive implementation, which made each Entry with Entry.from_string and checked its text one character at a time.
+  data = build_document(a.size)
+  d = Element.from_string(data=data, engine='table').to_dict()
+  n_nodes = count_nodes(Element.from_dict(d))
+  t1 = best_time(a.repeat, from_dict_by_recursion, d)
+  t2 = best_time(a.repeat, Element.from_dict, d)
+  t3 = best_time(a.repeat, Element.from_dict, d, sort_keys=False)
+  print("Document: {} articles, {} nodes.".format(a.size, n_nodes))
+  print("- recursive from_dict: {:.4f} s".format(t1))
+  print("- from_dict: {:.4f} s".format(t2))
+  print("- from_dict (sort_keys=False): {:.4f} s".format(t3))
+
+
+def from_dict_by_recursion(d, recursive_depth=0):
+  # The previous implementation of Element.from_dict, for comparison.
+  e = Element()
+  e.name = list(d.keys())[0]
+  e.recursive_depth = recursive_depth
+  child_value = d[e.name]
+  if isinstance(child_value, str):
+    e.children.append(entry_by_loop(child_value))
+  else:
+    for key, value in sorted(child_value.items()):
+      values = value if isinstance(value, list) else [value]
+      for x in values:
+        child = from_dict_by_recursion({key: x}, recursive_depth + 1)
+        e.children.extend([entry_by_loop('\n'), child])
+    e.children.append(entry_by_loop('\n'))
+  for child in e.children:
+    child.parent = e
+  e.complete = True
+  return e
+
+
+def entry_by_loop(value):
+  for byte in value:
+    if byte not in datajack.code.Element.entry_characters:
+      raise ValueError
+  entry = Entry()
+  entry.data = value
+  return entry
+
+
+def copy(a):
+  # Measure the time taken to generate documents from a template: copy an article, set some of its values, and serialize it.
+  # Here, size is the number of documents. The copies are made with create_copy, and, for comparison, by serializing the article and parsing it again.
+  data = build_document(1)
+  template = Element.from_string(data=data, engine='table').get_one('article')
+  template.data
+  t1 = best_time(a.repeat, fill_templates, template, a.size, copy_by_parsing)
+  t2 = best_time(a.repeat, fill_templates, template, a.size, Element.create_copy)
+  print("Template: {} bytes, {} documents.".format(len(template.data), a.size))
+  print("- serialize and parse: {:.4f} s".format(t1))
+  print("- create_copy: {:.4f} s".format(t2))
+
+
+def copy_by_parsing(e):
+  return Element.from_string(data=e.data, engine='table')
+
+
+def fill_templates(template, n, copy_function):
+  results = []
+  for i in range(n):
+    e = copy_function(template)
+    e.get_one('title').set_value('Title {}'.format(i))
+    e.get_one('date').set_value('2024-01-{:02d}'.format(i % 28 + 1))
+    results.append(e.data)
+  return results
+
+
+def count_events(data):
+  n = 0
+  for event in iterparse(data):
+    n += 1
+  return n
+
+
+def measure(function, *args, **kwargs):
+  # Return the time taken by one call of the function, and the peak memory allocated during it.
+  tracemalloc.start()
+  start = time.perf_counter()
+  function(*args, **kwargs)
+  t = time.perf_counter() - start
+  current, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return t, peak
+
+
+def validate_arguments(data, n):
+  # Perform the same validation as from_string, n times.
+  v = datajack.util.validate
+  location = 'benchmark.py:validate_arguments()'
+  for i in range(n):
+    v.validate_string(data, 'data', location)
+    v.validate_positive_integer(len(data), 'data_length', location)
+    v.validate_whole_number(i, 'data_index', location)
+    v.pi(1, 'line_number', location)
+    v.wn(i, 'line_index', location)
+    v.wn(1, 'recursive_depth', location)
+    v.validate_boolean(False, 'verbose', location)
+
+
+def count_nodes(e):
+  n = 0
+  stack = [e]
+  while stack:
+    item = stack.pop()
+    n += 1
+    if item.is_element:
+      stack.extend(item.children)
+  return n
+
+
+
+
+def build_document(n_articles):
+  # Build an EML document that contains n_articles articles.
+  # Each article has the same shape as the example tree in datajack/code/Element.py.
+  lines = ['<archive>']
+  for i in range(n_articles):
+    lines.append(build_article(i))
+  lines.append('</archive>')
+  return '\n'.join(lines)
+
+
+def build_article(i):
+  body = "Paragraph {i} of the article, with an escaped \\<tag\\> and a backslash \\\\ in it.\n".format(i=i)
+  article = """<article>
+<title>Article_{i}</title>
+<author_name>stjohn_piano</author_name>
+<date>2017-07-21</date>
+<signed_by_author>no</signed_by_author>
+<content>
+{body}<list>
+<title>Guild_Members</title>
+<name>StJohn_Piano</name>
+<name>Robert_Smith</name>
+<location>Cambridge</location>
+</list>
+<link>
+<type>asset</type>
+<filename>file_{i}.tar.bz2.asc</filename>
+<sha256>d9a497da682c7c0990361bbdc9b7c5c961250ec4679e3feda19cfbec37695100</sha256>
+</link>
+</content>
+</article>"""
+  return article.format(i=i, body=body * 5)
+
+
+def best_time(repeat, function, *args, **kwargs):
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+
+
+
+def stop(msg=None):
+  if msg is not None:
+    print(msg)
+  sys.exit()
+
+
+
+
+if __name__ == '__main__':
+  main()
@@ -1,7 +1,14 @@
 # Imports
 import logging
+import sys
 import string
 import json
+import re
+import mmap
+import os
+import functools
+import bisect
+import itertools
 
 
 
@@ -55,6 +62,8 @@ entry_characters += "\""
 escaped_characters = "<>\\"
 whitespace_characters = " \t\n"
 entry_characters += escaped_characters + whitespace_characters
+# Translation table for Element.delete_whitespace, which replaces each whitespace character with a space.
+whitespace_table = str.maketrans(whitespace_characters, ' ' * len(whitespace_characters))
 # Define contexts.
 EMPTY = 0
 START_TAG_OPEN = 1
@@ -73,11 +82,727 @@ context_names = {
   6: 'END_TAG_OPEN', 7: 'END_TAG_NAME', 8: 'END_TAG_CLOSE',
   9: 'DATA', 10: 'ESCAPED'
 }
+# Parser engines that can be selected in Element.from_string.
+parser_engines = ['recursive', 'table']
+# Define character classes (used by the table-driven parser engine).
+LT = 0
+GT = 1
+SLASH = 2
+BACKSLASH = 3
+NAME = 4
+NEWLINE = 5
+ENTRY = 6
+INVALID = 7
+n_character_classes = 8
+character_classes = dict.fromkeys(entry_characters, ENTRY)
+character_classes.update(dict.fromkeys(element_name_characters, NAME))
+character_classes['<'] = LT
+character_classes['>'] = GT
+character_classes['/'] = SLASH
+character_classes['\\'] = BACKSLASH
+character_classes['\n'] = NEWLINE
+# Define transition actions.
+NO_ACTION = 0
+ADD_TO_NAME = 1
+ADD_TO_END_NAME = 2
+START_ENTRY = 3
+START_CHILD = 4
+CLOSE_START_TAG = 5
+CLOSE_ELEMENT = 6
+# Element transitions: (context, character class) -> (next context, action).
+# Any (context, character class) pair that is not listed here is an error.
+# This encodes exactly the same grammar as Element.process_string.
+element_transitions_spec = {
+  (EMPTY, LT): (START_TAG_OPEN, NO_ACTION),
+  (START_TAG_OPEN, NAME): (START_TAG_NAME, ADD_TO_NAME),
+  (START_TAG_NAME, NAME): (START_TAG_NAME, ADD_TO_NAME),
+  (START_TAG_NAME, GT): (START_TAG_CLOSE, CLOSE_START_TAG),
+  (START_TAG_CLOSE, LT): (TAG_OPEN, NO_ACTION),
+  (START_TAG_CLOSE, SLASH): (INSIDE_ELEMENT, START_ENTRY),
+  (START_TAG_CLOSE, BACKSLASH): (INSIDE_ELEMENT, START_ENTRY),
+  (START_TAG_CLOSE, NAME): (INSIDE_ELEMENT, START_ENTRY),
+  (START_TAG_CLOSE, NEWLINE): (INSIDE_ELEMENT, START_ENTRY),
+  (START_TAG_CLOSE, ENTRY): (INSIDE_ELEMENT, START_ENTRY),
+  (TAG_OPEN, SLASH): (END_TAG_OPEN, NO_ACTION),
+  (TAG_OPEN, NAME): (INSIDE_ELEMENT, START_CHILD),
+  (INSIDE_ELEMENT, LT): (TAG_OPEN, NO_ACTION),
+  (INSIDE_ELEMENT, BACKSLASH): (INSIDE_ELEMENT, START_ENTRY),
+  (INSIDE_ELEMENT, NAME): (INSIDE_ELEMENT, START_ENTRY),
+  (INSIDE_ELEMENT, NEWLINE): (INSIDE_ELEMENT, START_ENTRY),
+  (INSIDE_ELEMENT, ENTRY): (INSIDE_ELEMENT, START_ENTRY),
+  (END_TAG_OPEN, NAME): (END_TAG_NAME, ADD_TO_END_NAME),
+  (END_TAG_NAME, NAME): (END_TAG_NAME, ADD_TO_END_NAME),
+  (END_TAG_NAME, GT): (END_TAG_CLOSE, CLOSE_ELEMENT),
+}
+# Expand the transition spec into lists, so that a lookup is just two list indexing operations: transitions[context][character_class].
+element_transitions = [
+  [element_transitions_spec.get((x, y)) for y in range(n_character_classes)]
+  for x in sorted(context_names)
+]
+# An entry run is a sequence of entry characters that don't need any special handling (i.e. everything except the escaped characters).
+# Pattern for checking the text of new Entries (see Entry.from_string and Element.from_dict).
+entry_data_pattern = re.compile('[' + re.escape(entry_characters) + ']*')
+entry_run_characters = ''.join(c for c in entry_characters if c not in escaped_characters)
+entry_run_pattern = re.compile('[' + re.escape(entry_run_characters) + ']+')
+# Versions of the character classes and the entry run pattern for bytes-like data (e.g. an mmap of a file), in which each byte is an int.
+byte_character_classes = {ord(c): x for c, x in character_classes.items()}
+entry_run_bytes_pattern = re.compile(entry_run_pattern.pattern.encode('ascii'))
+# Escaping of Entry data. Each escaped character is preceded by a backslash. The backslash itself must be replaced first.
+escape_replacements = [('\\', '\\\\'), ('<', '\\<'), ('>', '\\>')]
+# Status message templates, used in parsing error messages.
+element_status_msg = "Element: context [{c}], byte [{b}], data_index [{di}], line_number [{ln}], line_index [{li}], recursive_depth [{r}]."
+entry_status_msg = "Entry: context [{c}], byte [{b}], data_index [{di}], line_number [{ln}], line_index [{li}], recursive_depth [{r}]."
 # END IMMUTABLE DATA
 
 
 
 
+def as_text(x):
+  # Bytes-like data is parsed as ASCII. Convert a byte (an int) or a slice of bytes-like data to a str. A str (or None) is returned unchanged.
+  # Notes:
+  # - Invalid non-ASCII bytes can appear in error messages, so we decode with latin-1, which accepts any byte.
+  if isinstance(x, int):
+    return chr(x)
+  if isinstance(x, (bytes, bytearray)):
+    return x.decode('latin-1')
+  return x
+
+
+
+
+def intern_name(name, symbols):
+  # Return the copy of this Element name that is stored in the symbol table (a dict), adding it if necessary.
+  # Notes:
+  # - The parser uses one symbol table per document, so all the Elements with the same name share a single string object.
+  # - The stored strings are also interned with sys.intern, so a name that is looked up with sys.intern (e.g. in get_element_children_with_name) is the same object, and the comparison succeeds with an identity check.
+  symbol = symbols.get(name)
+  if symbol is None:
+    symbol = symbols[name] = sys.intern(name)
+  return symbol
+
+
+
+
+def remove_by_identity(items, item):
+  # Remove an item from a list. Unlike list.remove, this compares with 'is', so an equal item (e.g. a flat.Cursor) isn't removed by mistake.
+  for i, x in enumerate(items):
+    if x is item:
+      del items[i]
+      return
+  raise ValueError
+
+
+
+
+def number_children(children):
+  # Store the index of each item in a list of children in its position attribute.
+  # The list is numbered backwards, so that if an item appears more than once, its position is the first one.
+  for i in range(len(children) - 1, -1, -1):
+    children[i].position = i
+
+
+def find_depth(item):
+  # Return the depth of an Element or Entry below the root of its tree.
+  # Notes:
+  # - A depth that isn't known is None. It's found from the nearest ancestor whose depth is known (or from the root, which has depth 0), and stored in each item on the way back down.
+  # - The parser stores the depth of every item, so this only walks up the tree after an item has been moved (see clear_locations).
+  chain = []
+  while item.stored_depth is None:
+    chain.append(item)
+    item = item.parent
+    if item is None:
+      depth = -1
+      break
+  else:
+    depth = item.stored_depth
+  for item in reversed(chain):
+    depth += 1
+    item.stored_depth = depth
+  return depth
+
+
+def clear_locations(item, depth):
+  # Clear the stored depths and the cached paths (see Element.path_from_root) of an item that has been moved, and of its descendants.
+  # Notes:
+  # - depth is the item's new depth, or None if it isn't known. If it's the same as the old depth, the depths below the item are still correct, and only the cached paths are cleared.
+  # - An item only has a stored depth or a cached path if its parent has one too. So we don't look below an item that has neither, and this takes time proportional to the number of Elements whose paths have been used (or to the size of the item, if its depth has changed).
+  same_depth = depth is not None and item.stored_depth == depth
+  item.stored_depth = depth
+  if not item.is_element:
+    return
+  item.cached_path = None
+  stack = [item]
+  while stack:
+    element = stack.pop()
+    for child in element.children:
+      if child.is_element:
+        if child.cached_path is None and (same_depth or child.stored_depth is None):
+          continue
+        child.cached_path = None
+        stack.append(child)
+      if not same_depth:
+        child.stored_depth = None
+
+
+
+
+class Path(object):
+  """A compiled xpath, which can be used to select Elements many times without parsing the xpath again."""
+  # Notes:
+  # - The xpath is split into steps. Each step is a tuple: (name, descendants, number, predicates). For example, the xpath "//list[@title='Guild_Members']/name" has two steps: ('list', True, None, (('title', 'Guild_Members'),)) and ('name', False, None, ()).
+  # - The steps are parsed in the same way as Element.get originally parsed the xpath: one section at a time, with the rest of the xpath handled as a new xpath. So paths such as 'a//b' keep their original meaning.
+  # - Errors in the xpath (invalid names or predicates) are raised when it is compiled, even if no Element would be reached by the invalid step.
+  # - select() only uses the Element methods get_element_children_with_name, iter_element_descendants_with_name, get_value_if_exists, value, and select_by_value (if value_index is not None), so it also works with other classes that provide them (e.g. flat.Cursor).
+
+
+  __slots__ = ('xpath', 'steps', 'lazy')
+
+
+  def __init__(self, xpath):
+    self.xpath = xpath
+    self.steps = Path.parse(xpath)
+    # A Query for this Path is evaluated lazily if it has a descendant section (see Query).
+    self.lazy = any(step[1] for step in self.steps)
+
+
+  def __repr__(self):
+    return 'Path({})'.format(repr(self.xpath))
+
+
+  @staticmethod
+  def parse(xpath):
+    deb('Compiling xpath: ' + xpath)
+    steps = []
+    x = xpath
+    # xpath: ''
+    if x == '':
+      return tuple(steps)
+    while x:
+      # Handle double-slash at beginning.
+      # xpath: //name
+      descendants = False
+      if len(x) > 2:
+        if x[:2] == '//':
+          x = x[2:]
+          descendants = True
+      # xpaths that contain sections split by '/'
+      # x: 'content/list/title'
+      rest = None
+      if x.count('/') > 0:
+        sections = x.split('/')
+        x = sections[0]  # The first section of the path is this step.
+        rest = '/'.join(sections[1:])  # Rest of path.
+      # Get predicate if it exists.
+      # xpath: link[type='asset']
+      # xpath: //list[@title='Guild_Members'][@name='StJohn_Piano']
+      # xpath: structure/number_of_columns/row[1]/index
+      predicates = {}
+      number = None
+      if x.count('[') > 0:
+        sections = x.split('[')
+        x = sections[0]
+        for p in sections[1:]:
+          p = p.replace('@', '').replace(']', '')
+          if '=' in p:
+            k, value = p.split('=')
+            value = value.replace("'", "")
+            predicates[k] = value
+          elif p.isdigit():  # e.g. [1]
+            number = int(p)
+          else:
+            raise Exception("Invalid predicate [{}] in xpath: {}".format(p, repr(xpath)))
+      if not Element.is_element_name(x):
+        raise ValueError(x)
+      steps.append((sys.intern(x), descendants, number, tuple(predicates.items())))
+      x = rest
+    return tuple(steps)
+
+
+  def where(self, key, value):
+    # Return a new Path, with an extra predicate on the last section: the value at the xpath key must be equal to value.
+    p = Path.__new__(Path)
+    p.xpath = "{}[@{}='{}']".format(self.xpath, key, value)
+    steps = list(self.steps)
+    name, descendants, number, predicates = steps[-1]
+    steps[-1] = (name, descendants, number, predicates + ((key, value),))
+    p.steps = tuple(steps)
+    p.lazy = self.lazy
+    return p
+
+
+  def select(self, element):
+    # Return the list of Elements that this xpath selects, starting from element.
+    elements = [element]
+    for step in self.steps:
+      matches = []
+      for e in elements:
+        items, predicates = Path.candidates(e, step, False)
+        matches.extend(Path.filter(items, predicates))
+      elements = matches
+    return elements
+
+
+  def iter_select(self, element):
+    # Generate the Elements that this xpath selects, starting from element, in the same order as select.
+    # Each section of the xpath is a generator that pulls Elements from the previous section as it needs them, so if the caller stops early (see Query), the rest of the tree isn't searched.
+    items = iter((element,))
+    for step in self.steps:
+      items = Path.iter_step(items, step)
+    return items
+
+
+  @staticmethod
+  def iter_step(elements, step):
+    for e in elements:
+      items, predicates = Path.candidates(e, step, True)
+      for x in items:
+        if not predicates or Path.filter([x], predicates):
+          yield x
+
+
+  @staticmethod
+  def candidates(e, step, lazy, descendants_by_name=None):
+    # Return the Elements below e that match the name (and number) of this xpath section, and the predicates that still have to be checked.
+    # Notes:
+    # - If e has a value index for the first predicate (see Element.index_values), it is used instead of checking each candidate.
+    # - If lazy is True, descendants are returned as an iterator, which searches the tree only as far as needed.
+    # - descendants_by_name is a dict of name -> descendants of e with that name (see PathSet), or None.
+    name, descendants, number, predicates = step
+    if number is None and predicates and e.value_index is not None:
+      k, value = predicates[0]
+      items = e.select_by_value(descendants, name, k, value)
+      if items is not None:
+        return items, predicates[1:]
+    if not descendants:
+      items = e.get_element_children_with_name(name)
+    elif descendants_by_name is not None:
+      items = descendants_by_name[name]
+    elif lazy:
+      items = e.iter_element_descendants_with_name(name)
+      if number is not None:
+        items = list(itertools.islice(items, number + 1))
+    else:
+      items = e.get_element_descendants_with_name(name)
+    if number is not None:  # e.g. [1] predicate.
+      items = [items[number]]
+    return items, predicates
+
+
+  @staticmethod
+  def filter(items, predicates):
+    # Return the items that match all the predicates.
+    for k, value in predicates:
+      if k == '':
+        # The value of the Element itself (see where).
+        items = [x for x in items if x.value == value]
+      else:
+        items = [x for x in items if x.get_value_if_exists(k) == value]
+    return items
+
+
+
+
+class Query(object):
+  """The lazily evaluated result of an xpath query (see Element.query)."""
+  # Notes:
+  # - If the xpath has a descendant section (e.g. '//name'), the Elements are found as they are needed, so first(), exists(), and limit() stop searching as soon as they have their answer. count() searches the whole tree, but doesn't build a list of the results.
+  # - Otherwise, each section only looks at the children of the Elements found by the previous section, which is cheap, so the results are found with Path.select, which is faster for small results.
+  # - Iterating over a Query runs the search again each time.
+
+
+  __slots__ = ('element', 'path')
+
+
+  def __init__(self, element, path):
+    self.element = element
+    self.path = path
+
+
+  def __iter__(self):
+    if self.path.lazy:
+      return self.path.iter_select(self.element)
+    return iter(self.path.select(self.element))
+
+
+  def __repr__(self):
+    return 'Query({})'.format(repr(self.path.xpath))
+
+
+  def first(self):
+    # Return the first result, or None if there are no results.
+    return next(iter(self), None)
+
+
+  def exists(self):
+    return self.first() is not None
+
+
+  def count(self):
+    n = 0
+    for item in self:
+      n += 1
+    return n
+
+
+  def limit(self, n):
+    # Return a list of at most n results.
+    return list(itertools.islice(self, n))
+
+
+  def all(self):
+    return list(self)
+
+
+
+
+class NameIndex(object):
+  """An index of the Elements in a tree by name, in document order."""
+  # Notes:
+  # - The index is held by the root Element of the tree (see Element.name_index). It is built during parsing if from_string is called with index_names=True, or later by Element.build_name_index().
+  # - Each Element in the tree has a span: a pair of numbers [start, end]. The numbers increase in document order, and the spans of an Element's descendants are inside its span. So the descendants of an Element with a particular name are a slice of the list for that name, which is found with a binary search. A descendant query takes time proportional to the size of the result (plus a log factor), not the size of the tree.
+  # - The numbers are assigned with gaps between them, so that a new subtree can usually be given numbers between those of its neighbours. Removing a subtree just removes its numbers. If there is no room for a new subtree, part of the index is numbered again (see insert). In the rare case that this isn't possible, the index is marked as stale, and it is rebuilt by the next query.
+
+
+  __slots__ = ('root', 'elements', 'positions', 'spans', 'counter', 'stale')
+  # Distance between consecutive numbers when the index is built.
+  gap = 1024
+  # Smallest step between the numbers when part of the index is numbered again (see renumber).
+  min_gap = 16
+
+
+  def __init__(self, root=None):
+    self.root = root
+    # name -> list of Elements, in document order.
+    self.elements = {}
+    # name -> list of the start numbers of these Elements.
+    self.positions = {}
+    # Element -> [start, end]
+    self.spans = {}
+    self.counter = 0
+    self.stale = False
+
+
+  def open(self, element):
+    # Called when the start tag of an Element has been processed.
+    start = self.counter
+    self.counter += self.gap
+    self.spans[element] = [start, None]
+    self.add_to_lists(element, start)
+
+
+  def close(self, element):
+    # Called when the end tag of an Element has been processed.
+    self.spans[element][1] = self.counter
+    self.counter += self.gap
+
+
+  def add_to_lists(self, element, start):
+    name = element.name
+    positions = self.positions.get(name)
+    if positions is None:
+      self.positions[name] = [start]
+      self.elements[name] = [element]
+      return
+    if not positions or start > positions[-1]:
+      positions.append(start)
+      self.elements[name].append(element)
+      return
+    i = bisect.bisect_left(positions, start)
+    positions.insert(i, start)
+    self.elements[name].insert(i, element)
+
+
+  def build(self):
+    # Number all the Elements in the tree, in document order.
+    self.elements = {}
+    self.positions = {}
+    self.spans = {}
+    self.counter = 0
+    self.stale = False
+    stack = [(self.root, False)]
+    while stack:
+      element, finished = stack.pop()
+      if finished:
+        self.close(element)
+        continue
+      self.open(element)
+      stack.append((element, True))
+      for child in reversed(element.children):
+        if child.is_element:
+          stack.append((child, False))
+
+
+  def insert(self, element, position):
+    # Add a subtree to the index. element has just been inserted at this position in the children of its parent.
+    # Notes:
+    # - If the subtree is at the end of the document (e.g. it has been appended to the root Element, or to the last Element of the document), it's numbered after its previous neighbour with the usual gap, and the ends of its ancestors are moved after it. So appending at the end doesn't use up the gaps.
+    # - Otherwise, it's numbered between its neighbours, with a step of at most the usual gap, so that room is left after it.
+    # - If there isn't room between the neighbours, the smallest enclosing subtree that has room is numbered again inside its own span (see renumber). Only if there is no such subtree is the index marked as stale.
+    if self.stale:
+      return
+    parent = element.parent
+    children = parent.children
+    parent_span = self.spans.get(parent)
+    if parent_span is None or element in self.spans:
+      self.stale = True
+      return
+    # Find the numbers of the neighbouring Elements.
+    low = parent_span[0]
+    for i in range(position - 1, -1, -1):
+      if children[i].is_element:
+        low = self.spans[children[i]][1]
+        break
+    high = parent_span[1]
+    for i in range(position + 1, len(children)):
+      if children[i].is_element:
+        high = self.spans[children[i]][0]
+        break
+    if high == parent_span[1] and self.at_end(parent):
+      self.counter = low + self.gap
+      self.number(element, self.gap)
+      ancestor = parent
+      while ancestor is not None:
+        self.spans[ancestor][1] = self.counter
+        self.counter += self.gap
+        ancestor = ancestor.parent
+      return
+    # Each Element in the subtree needs two numbers.
+    n = len(self.subtree(element))
+    step = min(self.gap, (high - low) // (2 * n + 2))
+    if step >= 1:
+      self.counter = low + step
+      self.number(element, step)
+      return
+    ancestor = parent
+    while ancestor is not None:
+      if self.renumber(ancestor):
+        return
+      ancestor = ancestor.parent
+    self.stale = True
+
+
+  @staticmethod
+  def subtree(element):
+    # Return the Elements in the subtree of element (including element), in any order.
+    elements = [element]
+    for e in elements:
+      elements.extend(c for c in e.children if c.is_element)
+    return elements
+
+
+  @staticmethod
+  def at_end(element):
+    # Return True if no Element comes after the end of element in document order, i.e. element and each of its ancestors is the last element child of its parent.
+    while element.parent is not None:
+      for child in reversed(element.parent.children):
+        if child.is_element:
+          break
+      if child is not element:
+        return False
+      element = element.parent
+    return True
+
+
+  def number(self, element, step):
+    # Number a subtree that isn't in the index yet, starting at counter.
+    stack = [(element, False)]
+    while stack:
+      e, finished = stack.pop()
+      if finished:
+        self.spans[e][1] = self.counter
+        self.counter += step
+        continue
+      self.spans[e] = [self.counter, None]
+      self.add_to_lists(e, self.counter)
+      self.counter += step
+      stack.append((e, True))
+      for child in reversed(e.children):
+        if child.is_element:
+          stack.append((child, False))
+
+
+  def renumber(self, element):
+    # Number the descendants of element again, inside its span, including any new subtree below it that isn't in the index yet. Return False if there isn't room for a step of at least min_gap between the numbers.
+    # Notes:
+    # - The numbers stay inside the span and keep their order, so each list of start numbers stays sorted. The start numbers of the Elements that are already in the index are changed in place.
+    # - The numbers only use the first half of the span, so that there is room for more Elements to be appended.
+    start, end = self.spans[element]
+    descendants = self.subtree(element)[1:]
+    step = (end - start) // (2 * (2 * len(descendants) + 1))
+    if step < self.min_gap:
+      return False
+    # Find the list index of each Element that is already in the index, before any numbers change.
+    indexes = []
+    for e in descendants:
+      span = self.spans.get(e)
+      if span is not None:
+        indexes.append((e, bisect.bisect_left(self.positions[e.name], span[0])))
+    new = []
+    counter = start + step
+    stack = [(c, False) for c in reversed(element.children) if c.is_element]
+    while stack:
+      e, finished = stack.pop()
+      if finished:
+        self.spans[e][1] = counter
+        counter += step
+        continue
+      span = self.spans.get(e)
+      if span is None:
+        self.spans[e] = [counter, None]
+        new.append(e)
+      else:
+        span[0] = counter
+      counter += step
+      stack.append((e, True))
+      for child in reversed(e.children):
+        if child.is_element:
+          stack.append((child, False))
+    for e, i in indexes:
+      self.positions[e.name][i] = self.spans[e][0]
+    for e in new:
+      self.add_to_lists(e, self.spans[e][0])
+    return True
+
+
+  def remove(self, element):
+    # Remove a subtree from the index.
+    if self.stale:
+      return
+    stack = [element]
+    while stack:
+      e = stack.pop()
+      span = self.spans.pop(e, None)
+      if span is None:
+        continue
+      positions = self.positions[e.name]
+      i = bisect.bisect_left(positions, span[0])
+      del positions[i]
+      del self.elements[e.name][i]
+      stack.extend(e.element_children)
+
+
+  def select(self, element, name):
+    # Return the descendants of element that have this name, in document order. Return None if element isn't in the index.
+    if self.stale:
+      self.build()
+    span = self.spans.get(element)
+    if span is None:
+      return None
+    positions = self.positions.get(name)
+    if not positions:
+      return []
+    i = bisect.bisect_right(positions, span[0])
+    j = bisect.bisect_right(positions, span[1], i)
+    return self.elements[name][i:j]
+
+
+
+
+# The number of compiled xpaths that compile_path keeps.
+path_cache_size = 1024
+
+
+@functools.lru_cache(maxsize=path_cache_size)
+def compile_path(xpath):
+  # Return a compiled Path for this xpath.
+  # Notes:
+  # - The most recently used Paths are cached, so an xpath string that is used many times (e.g. by Element.get) is only parsed once.
+  # - A Path is returned unchanged.
+  if isinstance(xpath, Path):
+    return xpath
+  location = 'datajack/code/Element.py:compile_path()'
+  v.validate_string(xpath, 'xpath', location)
+  return Path(xpath)
+
+
+
+
+class PathSet(object):
+  """Several compiled xpaths, which are evaluated together (see Element.get_many)."""
+  # Notes:
+  # - The Paths are merged into a prefix tree of xpath sections, so a section that several Paths start with (e.g. 'content' in 'content/link/sha256' and 'content/list/title') is evaluated only once.
+  # - If several Paths continue with a descendant section (e.g. '//name' and '//title'), the descendants of each Element are found in a single walk, which collects all of these names.
+  # - Each node of the prefix tree is a tuple: (list of (section, child node), list of the keys of the Paths that end here, set of the names of the descendant sections). The tree is built once, when the PathSet is created.
+
+
+  __slots__ = ('paths', 'root')
+
+
+  def __init__(self, xpaths):
+    # xpaths is a dict of key -> xpath (a string or a Path).
+    self.paths = {}
+    for key, xpath in xpaths.items():
+      self.paths[key] = compile_path(xpath)
+
+    def new_node():
+      return ({}, [])
+    root = new_node()
+    for key, path in self.paths.items():
+      node = root
+      for step in path.steps:
+        if step not in node[0]:
+          node[0][step] = new_node()
+        node = node[0][step]
+      node[1].append(key)
+    self.root = PathSet.freeze(root)
+
+
+  def __repr__(self):
+    return 'PathSet({})'.format(repr({k: p.xpath for k, p in self.paths.items()}))
+
+
+  @staticmethod
+  def freeze(root):
+    # Convert the nodes of the prefix tree to their final form (see Notes).
+    stack = [root]
+    frozen = {}
+    order = []
+    while stack:
+      node = stack.pop()
+      order.append(node)
+      stack.extend(node[0].values())
+    for node in reversed(order):
+      steps = [(step, frozen[id(child)]) for step, child in node[0].items()]
+      names = set(step[0] for step, child in steps if step[1])
+      frozen[id(node)] = (steps, node[1], names)
+    return frozen[id(root)]
+
+
+  def select(self, element):
+    # Return a dict of key -> list of Elements (the same list that the key's Path would select).
+    results = {}
+    stack = [(self.root, [element])]
+    while stack:
+      (steps, keys, names), elements = stack.pop()
+      for key in keys:
+        results[key] = list(elements)
+      if not steps:
+        continue
+      if len(names) > 1:
+        found = [e.get_element_descendants_with_names(names) for e in elements]
+      else:
+        found = [None] * len(elements)
+      for step, child in steps:
+        matches = []
+        for e, descendants_by_name in zip(elements, found):
+          items, predicates = Path.candidates(e, step, False, descendants_by_name)
+          if predicates:
+            items = Path.filter(items, predicates)
+          matches.extend(items)
+        stack.append((child, matches))
+    return results
+
+
+
+
+@functools.lru_cache(maxsize=path_cache_size)
+def compile_path_set(xpaths):
+  # Return a PathSet for a tuple of (key, xpath) pairs. Like compile_path, the most recently used PathSets are cached.
+  return PathSet(dict(xpaths))
+
+
+
+
 # NOTES:
 # - The various indices used for tracking position within the data (e.g. line_number) are only used during the processing of an entire Element from a string value, primarily for the detection of errors. As changes are made to the Element (e.g. changing Entry values, adding new Elements), these indices will become inaccurate. They should not be used after the initial construction of the Element.
 
@@ -86,15 +811,40 @@ context_names = {
 
 class Element(object):
   """EML object"""
+  # Notes:
+  # - Element uses __slots__ rather than a per-instance __dict__, so that large trees use less memory. New attributes must be added to the slot list.
+  # - The verbose setting is passed to the parsing methods as an argument. It isn't stored in each Element.
+  # - The end tag name isn't stored. The parser checks that it matches the start tag name, so end_name is a property that returns name.
+  # - Each Element caches its serialized data (cached_data) and its JSON (cached_json) when they are first built. in_cache is True if the Element is covered by a cache, i.e. it has a cache or an ancestor's cache includes its data. A mutation calls invalidate_caches(), which clears the caches of the Element and of its ancestors, and stops at the first ancestor that isn't covered.
+  # - .data caches the data of the Element and of some of the Elements below it whose data is at least cache_threshold characters long (see build_data_cache), not of every Element. So the memory used by the cached data stays within a small multiple of the size of the data, and re-serializing after a small edit only walks the small uncached Elements around the edit and joins the caches on its path to the root again.
+  # - The children of an Element should only be changed through its methods (add, insert_child, detach, etc), so that the caches and the parent links stay correct. Changing an Entry's data through its data attribute also clears the caches.
+  # - children_by_name is an index of the element children of an Element: a dict of name -> list of children with that name, in order. The key None holds all the element children. It is built the first time that a child is looked up by name (get_element_children_with_name, has_child), so Elements that are never queried don't use memory for it. Appending and removing children keep it up to date. Other changes (inserting an Element before the last child, replacing an Element) discard it, and it is rebuilt by the next lookup. An Element's name must not be changed after it has been added to a parent.
+  # - The root Element can hold a NameIndex (name_index), which is used for descendant queries (e.g. '//name'). It is kept up to date by the same methods.
+  # - An Element can hold value indexes (value_index), which are used for xpath predicates such as link[@type='asset'] (see index_values). Like the caches, they are cleared by invalidate_caches() when the tree below the Element changes, and they are rebuilt by the next query.
+  # - Each Element and Entry stores its position in its parent's list of children. The position is checked (by identity) before it is used, and if it's out of date, all the children of the parent are numbered again. So get_index, prev_sibling, and next_sibling take constant time (amortised), without every change to the children having to renumber them.
+  # - recursive_depth and path_from_root are stored in each Element when they are first used. Moving an Element to a different place clears them for the Element and its descendants (see clear_locations), and they are found again from the new parent.
+  # - Use write_data() to serialize a large tree without building any caches.
+
+
+  __slots__ = (
+    'name', 'complete', 'children', 'parent',
+    'data_index', 'line_number', 'line_index',
+    'final_data_index', 'final_line_number', 'final_line_index',
+    'stored_depth', 'cached_path',
+    'cached_data', 'cached_json', 'in_cache',
+    'children_by_name', 'name_index', 'value_index',
+    'position',
+  )
+
+  # The minimum length of the data of an Element below the one whose .data is built, for the Element to keep its own cached data (see build_data_cache).
+  cache_threshold = 256
 
 
   def __init__(self):
     self.name = ""
-    self.end_name = ""
     self.complete = False
     self.children = []
     self.parent = None
-    self.logger = None
     # data_index, line_number, and line_index exist with reference to the original data (which includes escape characters). They record the location of the start of an element.
     self.data_index = 0
     self.line_number = 1  # Text editors start at line number 1.
@@ -102,8 +852,18 @@ class Element(object):
     self.final_data_index = 0
     self.final_line_number = 0
     self.final_line_index = 0
-    self.recursive_depth = 0
-    self.verbose = False
+    # The depth and the path from the root are found when they are first used (see recursive_depth and path_from_root).
+    self.stored_depth = None
+    self.cached_path = None
+    self.cached_data = None
+    self.cached_json = None
+    self.in_cache = False
+    self.children_by_name = None
+    # Only the root Element of a tree can have a name_index (see NameIndex).
+    self.name_index = None
+    self.value_index = None
+    # The index of this Element in its parent's children (see get_index).
+    self.position = 0
 
 
   def hello(self):
@@ -112,23 +872,58 @@ class Element(object):
 
 
   @classmethod
-  def from_file(cls, file):
-    with open(file) as f:
-      text = f.read()
-      text = text.rstrip('\n')  # Remove final newline if it exists.
-    return Element.from_string(data=text)
+  def from_file(cls, file, use_mmap=False):
+    # Notes:
+    # - If use_mmap is True, the file is memory-mapped and parsed directly as bytes with the 'table' engine. The file isn't read into a str, so the memory used is roughly the size of the resulting tree, not the size of the file. Only the names and the entry data are decoded into strs.
+    # - In this mode, the file must be ASCII with '\n' line endings. (When the file is read as text, '\r\n' line endings are converted to '\n'.)
+    if not use_mmap:
+      with open(file) as f:
+        text = f.read()
+        text = text.rstrip('\n')  # Remove final newline if it exists.
+      return Element.from_string(data=text)
+    with open(file, 'rb') as f:
+      data_length = Element.file_length_without_final_newlines(f)
+      location = 'datajack/code/Element.py:Element:from_file()'
+      v.validate_positive_integer(data_length, 'data_length', location)
+      # Only map the data before the final newlines, so that the mapped data is exactly the data that we parse.
+      with mmap.mmap(f.fileno(), data_length, access=mmap.ACCESS_READ) as data:
+        return Element.from_string_trusted(
+          data=data, data_length=data_length,
+          parent=None, data_index=0,
+          line_number=1, line_index=0,
+          recursive_depth=0, verbose=False,
+          engine='table', max_depth=None,
+        )
+
+
+  @staticmethod
+  def file_length_without_final_newlines(f):
+    # Find the length of a binary file, excluding any newline bytes at its end.
+    length = os.fstat(f.fileno()).st_size
+    block_size = 4096
+    while length > 0:
+      start = max(0, length - block_size)
+      f.seek(start)
+      block = f.read(length - start)
+      stripped = block.rstrip(b'\n')
+      length = start + len(stripped)
+      if stripped:
+        break
+    f.seek(0)
+    return length
 
 
   def write_to_file(self, file):
+    # The data is written in chunks, so the whole data string is never built.
     with open(file, 'w') as f:
-      f.write(self.data)
+      self.write_data(f)
       f.write('\n')
 
 
   def write_to_new_file(self, file):
     if os.path.isfile(file):
       raise OSError('File exists.')
-    self.writeToFile(file)
+    self.write_to_file(file)
 
 
   @classmethod
@@ -143,8 +938,16 @@ class Element(object):
       line_index=0,
       recursive_depth=0,
       verbose=False,
+      engine='recursive',
+      max_depth=None,
+      index_names=False,
       ):
     # Note: The root element and any child elements are built using this method.
+    # Notes on engines:
+    # - 'recursive': The original per-character state machine (process_string). Each child Element is built by a new call to from_string, so deeply nested data (roughly 300+ levels) will exceed Python's recursion limit.
+    # - 'table': A table-driven engine (process_string_table). It produces the same tree and the same error messages, but does not produce per-byte verbose log output. It is not recursive: open Elements are kept on an explicit stack, so it can handle data of any depth.
+    # - max_depth: If this is not None, a ValueError is raised if an Element's recursive_depth would exceed it. This can be used to reject unreasonably deep data. The root Element has recursive_depth 0.
+    # - index_names: If this is True, a NameIndex of the Elements is built while the data is parsed, and stored in the root Element.
     if data is None:
       raise ValueError
     if data_length is None:
@@ -158,23 +961,73 @@ class Element(object):
     v.wn(line_index, 'line_index', location)
     v.wn(recursive_depth, 'recursive_depth', location)
     v.validate_boolean(verbose, 'verbose', location)
+    if engine not in parser_engines:
+      msg = "Unrecognised parser engine: {}. Engine list: {}".format(repr(engine), parser_engines)
+      raise ValueError(msg)
+    if max_depth is not None:
+      v.wn(max_depth, 'max_depth', location)
+    v.validate_boolean(index_names, 'index_names', location)
+    name_index = None
+    if index_names:
+      name_index = NameIndex()
+    e = Element.from_string_trusted(
+      data=data, data_length=data_length,
+      parent=parent, data_index=data_index,
+      line_number=line_number, line_index=line_index,
+      recursive_depth=recursive_depth, verbose=verbose,
+      engine=engine, max_depth=max_depth, name_index=name_index,
+    )
+    if name_index is not None:
+      name_index.root = e
+      e.name_index = name_index
+    return e
+
+
+  @classmethod
+  def from_string_trusted(
+      cls,
+      data,
+      data_length,
+      parent,
+      data_index,
+      line_number,
+      line_index,
+      recursive_depth,
+      verbose,
+      engine,
+      max_depth,
+      symbols=None,
+      name_index=None,
+      ):
+    # Same as from_string, except that the arguments are not validated.
+    # Notes:
+    # - This is used by the parser to build each child Element, after from_string has validated the arguments once for the whole data. The data string doesn't need to be type-checked again for each child.
+    # - Only call this with arguments that have already been validated.
+    # - symbols is the symbol table for Element names (see intern_name). A new one is created for the root Element.
+    # - name_index is a NameIndex that the Elements are added to as they are parsed, or None.
+    if max_depth is not None and recursive_depth > max_depth:
+      raise ValueError(Element.max_depth_error_msg(
+        data_index, line_number, line_index, recursive_depth, max_depth
+      ))
     # Process data into an Element tree.
     e = Element()
     e.parent = parent
     e.data_index = data_index
     e.line_number = line_number
     e.line_index = line_index
-    e.recursive_depth = recursive_depth
-    e.verbose = verbose
+    e.stored_depth = recursive_depth
     if parent is None:
       deb("Begin parsing data into an Element tree.")
-    e.process_string(data, data_length)
+    if engine == 'table':
+      e.process_string_table(data, data_length, max_depth, name_index)
+    else:
+      e.process_string(data, data_length, max_depth, verbose, symbols, name_index)
     if e.parent is None:
       deb("Element parsed. Name = '{name}'. Number of children = {c}.".format(name=e.name, c=e.nc))
     return e
 
 
-  def process_string(self, data, data_length):
+  def process_string(self, data, data_length, max_depth=None, verbose=False, symbols=None, name_index=None):
     # Together, from_string and process_string are a recursive function. from_string will be called on the next Element that we find, and it will then call this function.
     # Notes:
     # - An Element can contain 0 items, where an item is an Element or an Entry.
@@ -200,7 +1053,11 @@ class Element(object):
     line_number = self.line_number
     line_index = self.line_index
     recursive_depth = self.recursive_depth
-    verbose = self.verbose
+    if symbols is None:
+      symbols = {}
+    # The start and end tag names are built here, and the start tag name is stored when the start tag is complete.
+    name = ''
+    end_name = ''
     if parent is not None:
       if verbose:
         deb("Switch to new Element")
@@ -245,23 +1102,28 @@ class Element(object):
 
       elif byte == ">":
         if context == START_TAG_NAME:
+          self.name = intern_name(name, symbols)
           deb("New Element: name = '{}'".format(self.name))
+          if name_index is not None:
+            name_index.open(self)
           context = START_TAG_CLOSE
           success = True
         elif context == END_TAG_NAME:
           context = END_TAG_CLOSE
           # We've arrived at the end of this Element.
-          if self.name != self.end_name:
+          if self.name != end_name:
             status_msg = status_msg.format(
               c=context_names[context], b=repr(byte), di=data_index,
               ln=line_number, li=line_index, r=recursive_depth
             )
-            status_msg += " Finished building Element, but end_tagName ({e}) is not the same as start_tagName ({s}).".format(e=self.end_name, s=self.name)
+            status_msg += " Finished building Element, but end_tagName ({e}) is not the same as start_tagName ({s}).".format(e=end_name, s=self.name)
             raise Exception(status_msg)
           self.final_data_index = data_index
           self.final_line_number = line_number
           self.final_line_index = line_index
           self.complete = True
+          if name_index is not None:
+            name_index.close(self)
           if parent is not None:
             deb("Element parsed. Name = '{name}'. Number of children = {c}.".format(name=self.name, c=len(self.children)))
           break
@@ -272,7 +1134,7 @@ class Element(object):
           success = True
         elif context == START_TAG_CLOSE:
           deb("Switch to new Entry.")
-          entry, data_index, line_number, line_index = Entry.from_string_section(
+          entry, data_index, line_number, line_index = Entry.from_string_section_trusted(
             data=data, data_length=data_length,
             parent=self, data_index=data_index,
             line_number=line_number, line_index=line_index,
@@ -285,14 +1147,14 @@ class Element(object):
       elif byte in element_name_characters:
         if context == START_TAG_OPEN:
           context = START_TAG_NAME
-          self.name += byte
+          name += byte
           success = True
         elif context == START_TAG_NAME:
-          self.name += byte
+          name += byte
           success = True
         elif context in [START_TAG_CLOSE, INSIDE_ELEMENT]:
           deb("Switch to new Entry.")
-          entry, data_index, line_number, line_index = Entry.from_string_section(
+          entry, data_index, line_number, line_index = Entry.from_string_section_trusted(
             data=data, data_length=data_length,
             parent=self, data_index=data_index,
             line_number=line_number, line_index=line_index,
@@ -303,19 +1165,21 @@ class Element(object):
           success = True
         elif context == END_TAG_OPEN:
           context = END_TAG_NAME
-          self.end_name += byte
+          end_name += byte
           success = True
         elif context == END_TAG_NAME:
-          self.end_name += byte
+          end_name += byte
           success = True
         elif context == TAG_OPEN:
           deb("Switch to child Element.")
           data_index, line_number, line_index = self.rewind_bytes(1, data_index, line_number, line_index)
-          child = Element.from_string(
+          child = Element.from_string_trusted(
             data=data, data_length=data_length,
             parent=self, data_index=data_index,
             line_number=line_number, line_index=line_index,
             recursive_depth=recursive_depth+1, verbose=verbose,
+            engine='recursive', max_depth=max_depth, symbols=symbols,
+            name_index=name_index,
           )
           self.children.append(child)
           data_index = child.final_data_index
@@ -330,7 +1194,7 @@ class Element(object):
           if byte == '\n':
             # We added 1 at the start of this loop.
             line_number -= 1
-          entry, data_index, line_number, line_index = Entry.from_string_section(
+          entry, data_index, line_number, line_index = Entry.from_string_section_trusted(
             data=data, data_length=data_length,
             parent=self, data_index=data_index,
             line_number=line_number, line_index=line_index,
@@ -377,6 +1241,160 @@ class Element(object):
     return self
 
 
+  def process_string_table(self, data, data_length, max_depth=None, name_index=None):
+    # Table-driven, non-recursive version of process_string.
+    # Notes:
+    # - Each byte is mapped to a character class with a single dict lookup, and the (context, character class) pair is mapped to a (next context, action) pair with a single table lookup. This replaces the chains of if/elif tests and the linear 'in' tests against element_name_characters and entry_characters.
+    # - This method builds the entire tree below this Element in a single loop. The open Elements are kept on an explicit stack, so the depth of the tree is not limited by Python's recursion limit.
+    # - Entries are processed by calling process_string_runs directly. We don't go back through from_string, so the arguments are not re-validated for every child.
+    # - The tree, the position indices, and the error messages are the same as those produced by process_string.
+    # - data can also be bytes-like (e.g. an mmap of a file, see from_file). In this case, each byte is an int, and the names and the entry data are decoded to strs.
+    data_index = self.data_index
+    line_number = self.line_number
+    line_index = self.line_index
+    text = isinstance(data, str)
+    classes = character_classes if text else byte_character_classes
+    # Symbol table for Element names (see intern_name).
+    symbols = {}
+    transitions = element_transitions
+    # State of the Element that we are currently processing.
+    # byte is the last byte that was processed in the current Element. It's used in the error message if we run out of data.
+    element = self
+    recursive_depth = element.stored_depth
+    children = element.children
+    name_chars = []
+    end_name_chars = []
+    context = EMPTY
+    byte = None
+    # Stack of the unfinished ancestors of the current Element, and their states.
+    stack = []
+    while True:
+
+      try:
+        byte = data[data_index]
+      except IndexError as e:
+        status_msg = element_status_msg.format(
+          c=context_names[context], b=repr(as_text(byte)), di=data_index,
+          ln=line_number, li=line_index, r=recursive_depth
+        )
+        status_msg += " No more data left, but Element is not complete."
+        raise Exception(status_msg)
+
+      character_class = classes.get(byte, INVALID)
+      if character_class == NEWLINE:
+        line_index = 0
+        line_number += 1
+
+      transition = transitions[context][character_class]
+
+      if transition is None:
+        status_msg = element_status_msg.format(
+          c=context_names[context], b=repr(as_text(byte)), di=data_index,
+          ln=line_number, li=line_index, r=recursive_depth
+        )
+        status_msg += " Previous bytes: [{p}]. Byte not successfully interpreted.".format(p=as_text(data[data_index-50:data_index]))
+        error_msg = ''
+        if context == START_TAG_NAME:
+          error_msg = 'Tag names can only contain characters in the element_name_characters list: [{}]'.format(element_name_characters)
+          error_msg = '\n\nERROR: ' + error_msg + '\n'
+        raise Exception(status_msg + error_msg)
+
+      context, action = transition
+
+      if action == ADD_TO_NAME:
+        name_chars.append(byte)
+
+      elif action == ADD_TO_END_NAME:
+        end_name_chars.append(byte)
+
+      elif action == CLOSE_START_TAG:
+        name = ''.join(name_chars) if text else bytes(name_chars).decode('ascii')
+        element.name = intern_name(name, symbols)
+        if name_index is not None:
+          name_index.open(element)
+
+      elif action == START_ENTRY:
+        if character_class == NEWLINE:
+          # We added 1 at the start of this loop.
+          line_number -= 1
+        entry = Entry()
+        entry.parent = element
+        entry.data_index = data_index
+        entry.line_number = line_number
+        entry.line_index = line_index
+        entry.stored_depth = recursive_depth + 1
+        data_index, line_number, line_index = entry.process_string_runs(
+          data, data_length
+        )
+        children.append(entry)
+
+      elif action == START_CHILD:
+        # The child Element starts at the '<' byte that we have just passed, and we have just processed the first byte of its name.
+        if max_depth is not None and recursive_depth + 1 > max_depth:
+          raise ValueError(self.max_depth_error_msg(
+            data_index - 1, line_number, line_index - 1, recursive_depth + 1, max_depth
+          ))
+        child = Element()
+        child.parent = element
+        child.data_index = data_index - 1
+        child.line_number = line_number
+        child.line_index = line_index - 1
+        child.stored_depth = recursive_depth + 1
+        children.append(child)
+        # Store the state of the current Element, and switch to the child.
+        stack.append((element, name_chars, end_name_chars, byte))
+        element = child
+        recursive_depth = child.stored_depth
+        children = child.children
+        name_chars = [byte]
+        end_name_chars = []
+        context = START_TAG_NAME
+
+      elif action == CLOSE_ELEMENT:
+        # We've arrived at the end of the current Element.
+        end_name = ''.join(end_name_chars) if text else bytes(end_name_chars).decode('ascii')
+        if element.name != end_name:
+          status_msg = element_status_msg.format(
+            c=context_names[context], b=repr(as_text(byte)), di=data_index,
+            ln=line_number, li=line_index, r=recursive_depth
+          )
+          status_msg += " Finished building Element, but end_tagName ({e}) is not the same as start_tagName ({s}).".format(e=end_name, s=element.name)
+          raise Exception(status_msg)
+        element.final_data_index = data_index
+        element.final_line_number = line_number
+        element.final_line_index = line_index
+        element.complete = True
+        if name_index is not None:
+          name_index.close(element)
+        if not stack:
+          break
+        # Switch back to the parent Element.
+        element, name_chars, end_name_chars, byte = stack.pop()
+        recursive_depth = element.stored_depth
+        children = element.children
+        context = INSIDE_ELEMENT
+
+      data_index += 1
+      line_index += 1
+
+    if self.parent is None:
+      # This is the root Element of the data.
+      # If there is any data left over, this is an error.
+      if data_index < data_length - 1:
+        remaining_data = as_text(data[data_index+1:])
+        _msg = "Finished building root element, but there is remaining data: {}".format(repr(remaining_data))
+        raise ValueError(_msg)
+
+    return self
+
+
+  @staticmethod
+  def max_depth_error_msg(data_index, line_number, line_index, recursive_depth, max_depth):
+    msg = "Element at data_index [{di}], line_number [{ln}], line_index [{li}] has recursive_depth [{r}], which exceeds max_depth [{m}]."
+    msg = msg.format(di=data_index, ln=line_number, li=line_index, r=recursive_depth, m=max_depth)
+    return msg
+
+
 
 
   def rewind_bytes(self, n_bytes, data_index, line_number, line_index):
@@ -413,9 +1431,27 @@ class Element(object):
 
   @property
   def element_children(self):
+    if self.children_by_name is not None:
+      return list(self.children_by_name[None])
     return [c for c in self.children if c.is_element]
 
 
+  def index_children_by_name(self):
+    # Return the children_by_name index, building it if necessary.
+    index = self.children_by_name
+    if index is None:
+      elements = [c for c in self.children if c.is_element]
+      index = {None: elements}
+      for child in elements:
+        names = index.get(child.name)
+        if names is None:
+          index[child.name] = [child]
+        else:
+          names.append(child)
+      self.children_by_name = index
+    return index
+
+
   @property
   def element_child(self):
     # Use: e5.element_child[0].name
@@ -434,18 +1470,64 @@ class Element(object):
 
   @property
   def element_descendants(self):
+    # Order: the element children of this Element, then the element descendants of each child in turn. (For document order, use iter_elements.)
+    # The Elements are processed with an explicit stack, so the depth of the tree is not limited by Python's recursion limit.
     items = []
-    items.extend(self.element_children)
-    for child in self.element_children:
-      items.extend(child.element_descendants)
+    stack = [self]
+    while stack:
+      children = stack.pop().element_children
+      items.extend(children)
+      stack.extend(reversed(children))
     return items
 
 
+  def iter_descendants(self, prune=None):
+    # Generate the descendants of this Element (Elements and Entries), in document order.
+    # Notes:
+    # - The tree is walked with an explicit stack, and each item is produced as it is reached, so a caller that stops early doesn't pay for the rest of the tree.
+    # - prune: If this is not None, it is called with each descendant Element. If it returns True, the Element is still produced, but its descendants are skipped.
+    stack = list(reversed(self.children))
+    pop = stack.pop
+    extend = stack.extend
+    while stack:
+      item = pop()
+      yield item
+      if item.is_element:
+        if prune is None or not prune(item):
+          extend(reversed(item.children))
+
+
+  def iter_elements(self, name=None, prune=None):
+    # Generate the descendant Elements of this Element, in document order. If name is not None, only the Elements with this name are produced. See iter_descendants for prune.
+    stack = [c for c in reversed(self.children) if c.is_element]
+    pop = stack.pop
+    extend = stack.extend
+    while stack:
+      element = pop()
+      if name is None or element.name == name:
+        yield element
+      if prune is None or not prune(element):
+        extend([c for c in reversed(element.children) if c.is_element])
+
+
+  def iter_entries(self, prune=None):
+    # Generate the descendant Entries of this Element, in document order. See iter_descendants for prune.
+    for item in self.iter_descendants(prune):
+      if item.is_entry:
+        yield item
+
+
   @property
   def start_tag(self):
     return "<" + self.name + ">"
 
 
+  @property
+  def end_name(self):
+    # The end tag name is always the same as the start tag name.
+    return self.name
+
+
   @property
   def end_tag(self):
     return "</" + self.end_name + ">"
@@ -473,18 +1555,27 @@ class Element(object):
 
 
   def tree_lines(self, elements_only=False):
+    # Each line is prefixed with one '-' for each level below this Element.
+    # The tree is walked with an explicit stack, and each line is built once, rather than being copied with a new prefix at each level.
     if self.parent is None:
       tree_lines = ["Tree for " + str(self)]
     elif elements_only:
       tree_lines = [" " + self.name]
     else:
       tree_lines = [" " + str(self)]
-    for child in self:
-      if elements_only and child.is_entry:
+    stack = [(child, 1) for child in reversed(self.children)]
+    while stack:
+      item, depth = stack.pop()
+      if item.is_entry:
+        if not elements_only:
+          tree_lines.append('-' * depth + item.tree_lines()[0])
         continue
-      child_lines = child.tree_lines(elements_only)
-      child_lines = [("-" + x) for x in child_lines]
-      tree_lines.extend(child_lines)
+      if elements_only:
+        line = " " + item.name
+      else:
+        line = " " + str(item)
+      tree_lines.append('-' * depth + line)
+      stack.extend((child, depth + 1) for child in reversed(item.children))
     return tree_lines
 
 
@@ -515,44 +1606,169 @@ class Element(object):
 
   @property
   def data(self):
-    data = self.start_tag
-    for child in self.children:
-      if child.is_entry:
-        data += child.escaped_data
-      elif child.is_element:
-        data += child.data
-    data += self.end_tag
-    return data
+    if self.cached_data is None:
+      self.build_data_cache()
+    return self.cached_data
+
+
+  def build_data_cache(self):
+    # Build the cached data of this Element, and of the Elements below it that are large enough to keep their own cache (see cache_threshold).
+    # Notes:
+    # - The tree is walked once, with an explicit stack, and the walk stops at any Element that already has cached data. After an edit, the caches on the path from the edit to this Element have been cleared, so only the small uncached Elements around that path are walked again, and each cache on the path is joined again from the pieces below it.
+    # - The pieces of all the open Elements are kept in one list. When an Element is closed, its pieces are joined into its cached data if it is cached. Otherwise they are left in the list, to be joined into the cache of an ancestor.
+    # - An Element below this one is cached if it has element children, its data is at least cache_threshold characters long, and either it is at least four times as long as the largest cache below it, or it is at most a quarter as long as its parent. So the caches that contain any given character grow at least four times at each step up the tree, and each character is in at most about log4(size / cache_threshold) + 2 caches, however deep the tree is. For the documents in benchmark.py (serialize), the cached data is 2 to 4 times the size of the data.
+    # - An Element that only contains Entries isn't cached, because its pieces are its tags and the Entry data, which usually needs no escaping. So a cache would mostly copy the data again.
+    escape = Entry.escape
+    threshold = self.cache_threshold
+    pieces = ['<' + self.name + '>']
+    append = pieces.append
+    # Each frame is [element, iterator over its children, index of its first piece, length of its data so far, length of the largest cache below it, whether it has element children, uncached element children]. Each uncached element child is stored as (child, index of its first piece, index after its last piece, length of its data, whether it has element children).
+    stack = [[self, iter(self.children), 0, len(pieces[0]), 0, False, []]]
+    while stack:
+      frame = stack[-1]
+      element, children, first, length, largest, has_elements, uncached = frame
+      for child in children:
+        if child.is_entry:
+          piece = escape(child.data)
+          append(piece)
+          length += len(piece)
+          continue
+        has_elements = True
+        piece = child.cached_data
+        if piece is not None:
+          append(piece)
+          length += len(piece)
+          if len(piece) > largest:
+            largest = len(piece)
+          continue
+        # Walk the child, then come back to this Element.
+        frame[3:6] = length, largest, has_elements
+        piece = '<' + child.name + '>'
+        stack.append([child, iter(child.children), len(pieces), len(piece), 0, False, []])
+        append(piece)
+        break
+      else:
+        stack.pop()
+        piece = '</' + element.name + '>'
+        append(piece)
+        length += len(piece)
+        for child, start, end, child_length, child_has_elements in uncached:
+          if child_has_elements and child_length >= threshold and 4 * child_length <= length:
+            child.cached_data = ''.join(pieces[start:end])
+            largest = max(largest, child_length)
+        cached = element is self or (has_elements and length >= threshold and length >= 4 * largest)
+        if cached:
+          data = ''.join(pieces[first:])
+          del pieces[first:]
+          append(data)
+          element.cached_data = data
+          largest = length
+        if stack:
+          parent = stack[-1]
+          parent[3] += length
+          parent[4] = max(parent[4], largest)
+          if not cached:
+            parent[6].append((element, first, len(pieces), length, has_elements))
+    self.mark_in_cache()
+
+
+  def mark_in_cache(self):
+    # Mark this Element and its descendants as covered by a cache (see invalidate_caches).
+    # Note: An Element that is already covered has all its descendants covered too, so we don't look below it.
+    self.in_cache = True
+    stack = [self]
+    while stack:
+      for child in stack.pop().children:
+        if child.is_element and not child.in_cache:
+          child.in_cache = True
+          stack.append(child)
+
+
+  def invalidate_caches(self):
+    # Clear the caches and the value indexes of this Element and of its ancestors.
+    # Notes:
+    # - An ancestor's cache can only include this Element's data if every Element in between is covered by a cache, so we stop at the first Element that isn't covered.
+    # - This is called by every method that changes the tree.
+    element = self
+    while element is not None and element.in_cache:
+      element.cached_data = None
+      element.cached_json = None
+      element.in_cache = False
+      if element.value_index:
+        # Keep the keys, so that the indexes are rebuilt when they are next used.
+        for key in element.value_index:
+          element.value_index[key] = None
+      element = element.parent
 
 
   @property
   def content(self):
     # Same as .data, except without the topmost element's start and end tags.
     # The tags of the children are included.
-    n1 = len(self.start_tag)
-    n2 = len(self.end_tag)
-    result = self.data[n1:-n2]
-    return result
+    if self.cached_data is not None:
+      start = len(self.name) + 2
+      end = len(self.name) + 3
+      return self.cached_data[start:-end]
+    chunks = []
+    self.write_data(chunks, chunk_size=None, include_tags=False)
+    return ''.join(chunks)
 
 
   @property
   def escaped_data(self):
     # Insert backslash before any escaped characters.
-    data = self.start_tag
-    for child in self.children:
-      if child.is_entry:
-        data += child.escaped_data
-      elif child.is_element:
-        data += child.escaped_data
-    data += self.end_tag
-    return data
+    # For an Element, this is the same as .data.
+    return self.data
+
+
+  def write_data(self, out, chunk_size=65536, include_tags=True):
+    # Write the EML data of this Element to out, which can be a file-like object (anything with a write method) or a list (the chunks are appended to it).
+    # Notes:
+    # - The tree is walked once, with an explicit stack, so the total cost is linear in the size of the data, and the depth of the tree is not limited by Python's recursion limit.
+    # - The pieces of data (tags and escaped Entry data) are joined into chunks of about chunk_size characters before they are written, so the memory used doesn't depend on the size of the data. If chunk_size is None, all the data is written as a single chunk.
+    # - If include_tags is False, the start and end tags of this Element are left out (see .content).
+    # - The cached data of an Element is written directly if it exists, but no caches are built, so the memory used stays small.
+    if isinstance(out, list):
+      write = out.append
+    else:
+      write = out.write
+    pieces = []
+    size = 0
+    # The stack contains the items that still have to be written, and the end tags (strings) of the Elements that are still open.
+    if include_tags:
+      stack = [self]
+    else:
+      stack = list(reversed(self.children))
+    pop = stack.pop
+    push = stack.append
+    extend = stack.extend
+    escape = Entry.escape
+    while stack:
+      item = pop()
+      if isinstance(item, str):
+        piece = item
+      elif item.is_entry:
+        piece = escape(item.data)
+      elif item.cached_data is not None:
+        piece = item.cached_data
+      else:
+        piece = '<' + item.name + '>'
+        push('</' + item.name + '>')
+        extend(reversed(item.children))
+      pieces.append(piece)
+      if chunk_size is not None:
+        size += len(piece)
+        if size >= chunk_size:
+          write(''.join(pieces))
+          pieces = []
+          size = 0
+    if pieces:
+      write(''.join(pieces))
 
 
   @staticmethod
   def delete_whitespace(s):
-    new_chars = ' ' * len(whitespace_characters)
-    table = str.maketrans(whitespace_characters, new_chars)
-    return s.translate(table)
+    return s.translate(whitespace_table)
 
 
   @property
@@ -628,69 +1844,63 @@ class Element(object):
 
 
   def get(self, x):
-    # Working principle: Handle any prefixes. Then handle the first section of the xpath. Then recurse.
-    deb('xpath: ' + x)
-    xOriginal = x
-    # xpath: ''
-    if x == '':
-      return [self]
-    # Handle double-slash at begining.
-    # xpath: //name
-    descendants = False
-    if len(x) > 2:
-      if x[:2] == '//':
-        x = x[2:]
-        descendants = True
-        #if self.is_element_name(name):
-        #  return self.get_element_descendants_with_name(name)
-    # xpaths that contain sections split by '/'
-    # x: 'content/list/title'
-    x2 = None
-    if x.count('/') > 0:
-      sections = x.split('/')
-      x = sections[0]  # We process only the first section of path.
-      x2 = '/'.join(sections[1:])  # Rest of path.
-    # Get predicate if it exists.
-    # xpath: link[type='asset']
-    # xpath: //list[@title='Guild_Members'][@name='StJohn_Piano']
-    # xpath: structure/number_of_columns/row[1]/index
-    predicates = {}
-    number = None
-    if x.count('[') > 0:
-      sections = x.split('[')
-      x = sections[0]
-      ps = sections[1:]
-      for p in ps:
-        p = p.replace('@', '').replace(']', '')
-        if '=' in p:
-          k, v = p.split('=')
-          v = v.replace("'", "")
-          predicates[k] = v
-        elif p.isdigit():  # e.g. [1]
-          number = int(p)
-        else:
-          raise Exception
-    # Get children / descendants that match conditions.
-    elements = []
-    if not self.is_element_name(x):
-      raise ValueError(x)
-    if descendants:
-      elements = self.get_element_descendants_with_name(x)
-    else:
-      elements = self.get_element_children_with_name(x)
-    if number is not None:  # e.g. [1] predicate.
-      elements = [elements[number]]
-    for k, v in iter(predicates.items()):
-      elements = [e for e in elements if e.get_value_if_exists(k) == v]
-    if x2:
-      elements2 = []
-      for e in elements:
-        elements2.extend(e.get(x2))
-      elements = elements2
-    return elements
+    # x can be an xpath string or a Path (see compile_path).
+    # Notes:
+    # - An xpath string is compiled into a Path, and the compiled Paths are cached, so a string that is used many times is parsed only once.
+    if not isinstance(x, Path):
+      x = compile_path(x)
+    return x.select(self)
+
+
+  def query(self, xpath):
+    # Return a Query for this xpath (a string or a Path). Its results are found lazily, e.g. e.query('//name').first() stops at the first match.
+    if not isinstance(xpath, Path):
+      xpath = compile_path(xpath)
+    return Query(self, xpath)
+
+
+  def get_first(self, xpath):
+    # Return the first Element that the xpath selects, or None. The search stops at the first match (see Query).
+    return self.query(xpath).first()
+
+
+  def exists(self, xpath):
+    return self.query(xpath).exists()
+
+
+  def get_many(self, xpaths):
+    # Evaluate several xpaths together, and return a dict of the results (each result is the list that get() would return).
+    # Notes:
+    # - xpaths can be a dict of key -> xpath (e.g. a field name -> the xpath of the field), or a list (or other iterable) of xpaths, which are then also the keys.
+    # - The xpaths are evaluated in a single pass, which shares the work for common prefixes (see PathSet). So the cost of extracting many fields from a document depends mainly on the size of the document, rather than on the size multiplied by the number of fields.
+    # - xpaths can also be a PathSet, which is what the xpaths are compiled into. Compiled PathSets are cached.
+    if not isinstance(xpaths, PathSet):
+      if isinstance(xpaths, dict):
+        xpaths = tuple(xpaths.items())
+      else:
+        xpaths = tuple((x, x) for x in xpaths)
+      xpaths = compile_path_set(xpaths)
+    return xpaths.select(self)
+
+
+  def get_value_many(self, xpaths, if_exists=False):
+    # Same as get_many, except that the result for each key is the value of the single Element that its xpath selects (see get_value).
+    # If if_exists is True, the result is None if the xpath selects nothing (see get_value_if_exists).
+    results = self.get_many(xpaths)
+    values = {}
+    for key, items in results.items():
+      if len(items) == 1:
+        values[key] = items[0].value
+      elif if_exists and len(items) == 0:
+        values[key] = None
+      else:
+        msg = "Expected 1 item for {}, but got {}.".format(repr(key), len(items))
+        raise ValueError(msg)
+    return values
 
 
   def get_one(self, xpath):
+    # Note: To show that there is exactly one result, the whole search must be done, so this doesn't use a lazy Query.
     items = self.get(xpath)
     if len(items) != 1:
       raise ValueError("Expected 1 item, but got {n}.".format(n=len(items)))
@@ -735,22 +1945,126 @@ class Element(object):
 
 
   def get_element_children_with_name(self, name):
-    items = []
-    for child in self.element_children:
-      if child.name == name:
-        items.append(child)
-    return items
+    # The children are looked up in the children_by_name index, so the cost doesn't depend on the number of children.
+    return list(self.index_children_by_name().get(name, ()))
 
 
   def get_element_descendants_with_name(self, name):
+    # The result is in document order.
+    # Notes:
+    # - If the tree has a NameIndex, it is used, so the time taken depends on the size of the result, not the size of the tree.
+    # - Otherwise, every descendant is visited (with an explicit stack). We don't build a children_by_name index for each of them.
+    # - Names from parsed data are interned (see intern_name), so if we intern the name that we're looking for, a match is found with an identity check. Names that have been set in other ways are still compared by value.
+    name_index = self.find_name_index()
+    if name_index is not None:
+      items = name_index.select(self, name)
+      if items is not None:
+        return items
+    name = sys.intern(name)
     items = []
-    items.extend(self.get_element_children_with_name(name))
-    for child in self.element_children:
-      items.extend(child.get_element_descendants_with_name(name))
+    stack = list(reversed(self.children))
+    while stack:
+      child = stack.pop()
+      if child.is_element:
+        if child.name is name or child.name == name:
+          items.append(child)
+        stack.extend(reversed(child.children))
     return items
 
 
+  def index_values(self, name, key=''):
+    # Use a value index for the children with this name (or the descendants, if name begins with '//'), keyed by the value of the child at the xpath key. The default key '' is the value of the child itself.
+    # Notes:
+    # - The index is a dict of value -> list of Elements. It is built by the first query that uses it. Then an xpath such as "link[@type='asset']" (name 'link', key 'type') or "//link[@type='asset']" (name '//link', key 'type') is a dict lookup, instead of a check of every link Element. get_one_by_value uses the key ''.
+    # - The index is only used for the first predicate of an xpath section, and not if the section has a number predicate (e.g. [1]).
+    descendants = False
+    if name[:2] == '//':
+      name = name[2:]
+      descendants = True
+    if not self.is_element_name(name):
+      raise ValueError(name)
+    v.validate_string(key, 'key', 'datajack/code/Element.py:Element:index_values()')
+    compile_path(key)
+    if self.value_index is None:
+      self.value_index = {}
+    self.value_index.setdefault((descendants, sys.intern(name), key), None)
+
+
+  def select_by_value(self, descendants, name, key, value):
+    # Return the children (or descendants) with this name whose value at the xpath key is equal to value. Return None if there is no value index for them (see index_values).
+    if self.value_index is None:
+      return None
+    index_key = (descendants, name, key)
+    if index_key not in self.value_index:
+      return None
+    table = self.value_index[index_key]
+    if table is None:
+      if descendants:
+        items = self.get_element_descendants_with_name(name)
+      else:
+        items = self.get_element_children_with_name(name)
+      table = {}
+      for item in items:
+        table.setdefault(item.get_value_if_exists(key), []).append(item)
+      self.value_index[index_key] = table
+      # Any change in the tree below this Element must clear the index.
+      self.mark_in_cache()
+    return list(table.get(value, ()))
+
+
+  def get_element_descendants_with_names(self, names):
+    # Return a dict of name -> list of the descendants with that name (in document order), for each name in names. The tree is walked once for all the names.
+    name_index = self.find_name_index()
+    if name_index is not None:
+      results = {name: name_index.select(self, name) for name in names}
+      if None not in results.values():
+        return results
+    results = {name: [] for name in names}
+    stack = list(reversed(self.children))
+    while stack:
+      child = stack.pop()
+      if child.is_element:
+        items = results.get(child.name)
+        if items is not None:
+          items.append(child)
+        stack.extend(reversed(child.children))
+    return results
+
+
+  def iter_element_descendants_with_name(self, name):
+    # Lazy version of get_element_descendants_with_name. If the tree has a NameIndex, the list of results is already available, so it's used. Otherwise, the tree is walked only as far as the caller needs.
+    name_index = self.find_name_index()
+    if name_index is not None:
+      items = name_index.select(self, name)
+      if items is not None:
+        return iter(items)
+    return self.iter_elements(name)
+
+
+  def find_name_index(self):
+    # Return the NameIndex of the tree that contains this Element, or None.
+    element = self
+    while element.parent is not None:
+      element = element.parent
+    return element.name_index
+
+
+  def build_name_index(self):
+    # Build a NameIndex for the tree below this Element, which must be a root Element.
+    if self.parent is not None:
+      raise ValueError('Only a root Element can hold a NameIndex.')
+    self.name_index = NameIndex(self)
+    self.name_index.build()
+    return self.name_index
+
+
   def get_one_by_value(self, xpath, value):
+    # If the Elements selected by the xpath have a value index for their own value (key ''), the Element is found with a lookup. Otherwise, or if there isn't exactly one result, we filter the Elements, which also produces the same errors as before.
+    path = compile_path(xpath)
+    if path.steps:
+      items = path.where('', value).select(self)
+      if len(items) == 1:
+        return items[0]
     items = self.get_all(xpath)
     items = [x for x in items if x.value == value]
     if len(items) != 1:
@@ -767,12 +2081,19 @@ class Element(object):
 
 
   def get_index(self):
-    # Look through siblings, and find our own index among them.
-    if self.parent is None:
+    # Return our own index among our siblings.
+    # The stored position is used if it's still correct. Otherwise, the siblings are numbered again.
+    parent = self.parent
+    if parent is None:
       raise AttributeError
-    for i, child in enumerate(self.parent.children):
-      if id(child) == id(self):
-        return i
+    children = parent.children
+    i = self.position
+    if i < len(children) and children[i] is self:
+      return i
+    number_children(children)
+    i = self.position
+    if i < len(children) and children[i] is self:
+      return i
     raise KeyError
 
 
@@ -786,8 +2107,12 @@ class Element(object):
       raise ValueError
     # Result: This leaf Element has a single Entry child with the new value.
     entry = Entry.from_string(value)
-    entry.parent = self
-    self.children = [entry]
+    for child in self.children:
+      child.parent = None
+      clear_locations(child, 0)
+    self.children = []
+    self.children_by_name = None
+    self.insert_item(0, entry)
 
 
   def add(self, item, index=None):
@@ -797,7 +2122,70 @@ class Element(object):
       raise ValueError
     if item.class_name not in ['Element', 'Entry']:
       raise TypeError
+    self.insert_item(index, item)
+
+
+  def insert_item(self, index, item):
+    # All changes to the list of children go through insert_item, remove_item, and replace_item, which keep the parent links, the children_by_name index, the NameIndex, and the caches up to date.
+    n = len(self.children)
+    position = min(index, n) if index >= 0 else max(0, n + index)
     self.children.insert(index, item)
+    item.parent = self
+    clear_locations(item, None if self.stored_depth is None else self.stored_depth + 1)
+    # The positions of any later siblings are now out of date. They are renumbered when they are next needed (see get_index).
+    item.position = position
+    if item.is_element:
+      # An Element that is added to a tree is no longer a root Element.
+      item.name_index = None
+      name_index = self.find_name_index()
+      if name_index is not None:
+        name_index.insert(item, position)
+    if self.children_by_name is not None and item.is_element:
+      if self.children[-1] is item:
+        by_name = self.children_by_name
+        by_name[None].append(item)
+        by_name.setdefault(item.name, []).append(item)
+      else:
+        self.children_by_name = None
+    self.invalidate_caches()
+
+
+  def remove_item(self, index):
+    name_index = self.find_name_index()
+    item = self.children.pop(index)
+    item.parent = None
+    clear_locations(item, 0)
+    if name_index is not None and item.is_element:
+      name_index.remove(item)
+    if self.children_by_name is not None and item.is_element:
+      by_name = self.children_by_name
+      remove_by_identity(by_name[None], item)
+      names = by_name[item.name]
+      remove_by_identity(names, item)
+      if not names:
+        del by_name[item.name]
+    self.invalidate_caches()
+    return item
+
+
+  def replace_item(self, index, item):
+    name_index = self.find_name_index()
+    old = self.children[index]
+    old.parent = None
+    clear_locations(old, 0)
+    if name_index is not None and old.is_element:
+      name_index.remove(old)
+    self.children[index] = item
+    item.parent = self
+    clear_locations(item, None if self.stored_depth is None else self.stored_depth + 1)
+    item.position = index
+    if old.is_element or item.is_element:
+      self.children_by_name = None
+    if item.is_element:
+      item.name_index = None
+      if name_index is not None:
+        name_index.insert(item, index)
+    self.invalidate_caches()
 
 
   def add_all(self, items, index=None):
@@ -809,18 +2197,50 @@ class Element(object):
       self.add(item, index + i)
 
 
+  @property
+  def recursive_depth(self):
+    # The depth of this Element below the root of its tree. The root has depth 0.
+    if self.stored_depth is not None:
+      return self.stored_depth
+    return find_depth(self)
+
+
+  @recursive_depth.setter
+  def recursive_depth(self, value):
+    self.stored_depth = value
+
+
   @property
   def path_from_root(self):
     # This path should be usable as the xpath argument to the get() method.
-    if self.recursive_depth == 0:
-      return ''
-    if self.recursive_depth == 1:
-      return self.name
-    p = self.parent
-    path = p.name + '/' + self.name
-    while p.recursive_depth > 1:
-      p = p.parent
-      path = p.name + '/' + path
+    # Notes:
+    # - The path is stored in each Element on the way down from the nearest ancestor that already has one, so finding the paths of all the Elements in a tree takes time proportional to the total length of the paths.
+    # - The path doesn't include the name of the root Element.
+    path = self.cached_path
+    if path is not None:
+      return path
+    parent = self.parent
+    if parent is not None and parent.cached_path:
+      path = self.cached_path = parent.cached_path + '/' + self.name
+      return path
+    chain = []
+    element = self
+    while element.cached_path is None:
+      chain.append(element)
+      element = element.parent
+      if element is None:
+        path = None
+        break
+    else:
+      path = element.cached_path
+    for element in reversed(chain):
+      if path is None:
+        path = ''
+      elif path == '':
+        path = element.name
+      else:
+        path = path + '/' + element.name
+      element.cached_path = path
     return path
 
 
@@ -843,7 +2263,7 @@ class Element(object):
 
 
   def has_child(self, name):
-    n = self.element_children_names.count(name)
+    n = len(self.index_children_by_name().get(name, ()))
     if n > 1:
       raise ValueError
     if n == 1:
@@ -872,10 +2292,7 @@ class Element(object):
     if index > n:
       raise ValueError
     if index > -1:
-      if index in [n, -1]:
-        self.children.append(input)
-      else:
-        self.children.insert(index, input)
+      self.insert_item(index, input)
       return index
     # Handle negative indices.
     # We shift once to the right.
@@ -885,7 +2302,7 @@ class Element(object):
       raise ValueError
     index_original = index
     index += 1
-    self.children.insert(index, input)
+    self.insert_item(index, input)
     return index_original
 
 
@@ -900,8 +2317,7 @@ class Element(object):
     # Note: This doesn't actually make use of self, so it's not really a method.
     # However, this is easier to handle mentally as a sibling of set_value, get, add, etc.
     i = element.get_index()
-    children = element.parent.children
-    element.parent.children = children[:i] + children[i+1:]
+    element.parent.remove_item(i)
 
 
   def detach_all(self, items):
@@ -916,7 +2332,7 @@ class Element(object):
     # Note: "name" can be a path.
     child = self.get_one(name)
     i = child.get_index()
-    child.parent.children[i] = new_child_element
+    child.parent.replace_item(i, new_child_element)
 
 
   def search(self, search_string):
@@ -989,7 +2405,41 @@ class Element(object):
 
 
   def create_copy(self):
-    return Element.from_string(self.escaped_data)
+    # Return a copy of this Element and its descendants, as a new tree.
+    # Notes:
+    # - The nodes are copied directly, with an explicit stack. The data isn't serialized and parsed again, so the cost is one new object per node, and the copy has exactly the same structure (e.g. Entries that are next to each other aren't merged).
+    # - Names and Entry data are strs, which can't be changed, so the copy shares them with the original. Setting data or a value in the copy replaces the string in the copy only.
+    # - The cached data and JSON (see build_data_cache) are shared in the same way, so the data of the copy is available at once. After an edit to the copy, only the caches on the path to its root are rebuilt.
+    # - The copy is the root of its tree, with depth 0. Its children are numbered (see get_index). It has no NameIndex or value indexes.
+    copy = Element()
+    copy.name = self.name
+    copy.complete = self.complete
+    copy.cached_data = self.cached_data
+    copy.cached_json = self.cached_json
+    copy.in_cache = self.in_cache
+    copy.stored_depth = 0
+    stack = [(self, copy)]
+    while stack:
+      original, element = stack.pop()
+      children = element.children
+      depth = element.stored_depth + 1
+      for i, child in enumerate(original.children):
+        if child.is_element:
+          item = Element()
+          item.name = child.name
+          item.complete = child.complete
+          item.cached_data = child.cached_data
+          item.cached_json = child.cached_json
+          item.in_cache = child.in_cache
+          stack.append((child, item))
+        else:
+          item = Entry()
+          item.stored_data = child.stored_data
+        item.parent = element
+        item.position = i
+        item.stored_depth = depth
+        children.append(item)
+    return copy
 
 
   @property
@@ -1001,31 +2451,109 @@ class Element(object):
 
 
   def to_dict(self):
+    # Notes:
+    # - A leaf Element becomes its value. Any other Element becomes a dict of its element children, by name. We preserve Entry data only if the parent Element is a leaf element.
+    # - We translate multiple children with the same name into a list value.
+    # - The names of each Element's children are counted once, so the time taken is linear in the size of the tree. The Elements are processed with an explicit stack, so the depth of the tree is not limited by Python's recursion limit.
     if self.is_leaf:
       return {self.name: self.value}
     result = {self.name: {}}
-    result_value = result[self.name]
-    # We preserve Entry data only if the parent Element is a leaf element.
-    for child in self.element_children:
-      name = child.name
-      if self.element_children_names.count(name) == 1:
-        result_value.update(child.to_dict())
-      # We translate multiple children with the same name into a list value.
-      else:
-        if name not in result_value.keys():
-          result_value[name] = []
+    stack = [(self, result[self.name])]
+    while stack:
+      element, result_value = stack.pop()
+      children = [c for c in element.children if c.is_element]
+      counts = {}
+      for child in children:
+        counts[child.name] = counts.get(child.name, 0) + 1
+      for child in children:
         if child.is_leaf:
-          result_value[name].append(child.value)
+          value = child.value
         else:
-          d = child.to_dict()
-          value = list(d.values())[0]
+          value = {}
+          stack.append((child, value))
+        name = child.name
+        if counts[name] == 1:
+          result_value[name] = value
+        elif name in result_value:
           result_value[name].append(value)
+        else:
+          result_value[name] = [value]
     return result
 
 
   def to_json(self):
-    d = self.to_dict()
-    return json.dumps(d, sort_keys=True)
+    # The JSON is cached. All the Elements in the tree are marked as covered by the cache, so that a change anywhere in the tree clears it.
+    if self.cached_json is None:
+      d = self.to_dict()
+      self.cached_json = json.dumps(d, sort_keys=True)
+      self.mark_in_cache()
+    return self.cached_json
+
+
+  def write_json(self, out, chunk_size=65536):
+    # Write the JSON of this Element to out, which can be a file-like object (anything with a write method) or a list (the chunks are appended to it).
+    # Notes:
+    # - The output is the same as to_json(), but the dict from to_dict() isn't built, so the memory used doesn't depend on the size of the tree. This is the JSON version of write_data.
+    # - The tree is walked once, with an explicit stack. The pieces of JSON are joined into chunks of about chunk_size characters before they are written. If chunk_size is None, all the JSON is written as a single chunk.
+    # - The keys of each object are sorted, as in to_json.
+    # - If this Element's JSON is cached, it's written directly. No cache is built.
+    if isinstance(out, list):
+      write = out.append
+    else:
+      write = out.write
+    if self.cached_json is not None:
+      write(self.cached_json)
+      return
+    encode = json.encoder.encode_basestring_ascii
+    pieces = []
+    size = 0
+    # The stack contains the pieces of JSON (strings) that still have to be written, and the non-leaf Elements whose objects still have to be written.
+    if self.is_leaf:
+      stack = ['{' + encode(self.name) + ': ' + encode(self.value) + '}']
+    else:
+      stack = ['}', self, '{' + encode(self.name) + ': ']
+    pop = stack.pop
+    extend = stack.extend
+    while stack:
+      item = pop()
+      if isinstance(item, str):
+        piece = item
+      else:
+        # Group the element children by name, and build the object's pieces in order.
+        groups = {}
+        for child in item.children:
+          if child.is_element:
+            if child.name in groups:
+              groups[child.name].append(child)
+            else:
+              groups[child.name] = [child]
+        object_pieces = ['{']
+        for i, name in enumerate(sorted(groups)):
+          object_pieces.append((', ' if i else '') + encode(name) + ': ')
+          children = groups[name]
+          if len(children) > 1:
+            object_pieces.append('[')
+          for j, child in enumerate(children):
+            if j:
+              object_pieces.append(', ')
+            if child.is_leaf:
+              object_pieces.append(encode(child.value))
+            else:
+              object_pieces.append(child)
+          if len(children) > 1:
+            object_pieces.append(']')
+        object_pieces.append('}')
+        extend(reversed(object_pieces))
+        continue
+      pieces.append(piece)
+      if chunk_size is not None:
+        size += len(piece)
+        if size >= chunk_size:
+          write(''.join(pieces))
+          pieces = []
+          size = 0
+    if pieces:
+      write(''.join(pieces))
 
 
   def to_json_pretty(self):
@@ -1034,51 +2562,70 @@ class Element(object):
 
 
   @classmethod
-  def from_dict(self, d=None, recursive_depth=0):
+  def from_dict(self, d=None, recursive_depth=0, sort_keys=True):
+    # Notes:
+    # - A str value becomes a leaf Element with one Entry. A dict value becomes an Element with a child for each key, and a list value becomes a sequence of children with the same name. The children are separated by newline Entries, to make the output more readable.
+    # - If sort_keys is True, the children are added in the order of their names. Otherwise, they are added in the order of the dict.
+    # - The tree is built with an explicit stack, so the depth of the dict is not limited by Python's recursion limit. Each Element is added to its parent's children when the parent is built, and its own value is processed later.
+    # - The Entries are made directly, without Entry.from_string. Their text is checked in one regular expression match at the end.
+    # - The names are interned with a symbol table, as in the parser (see intern_name). All the newline Entries share one string.
     if d is None:
       raise ValueError
-    e = Element()
-    keys = list(d.keys())
-    if len(keys) != 1:
+    if len(d) != 1:
       raise KeyError
-    e.name = keys[0]
-    e.end_name = e.name
-    e.recursive_depth = recursive_depth
-    child_value = d[e.name]
-
-    def n():
-      # Add newlines to make the output more readable.
-      return Entry.from_string('\n')
-
-    if type(child_value) == str:
-      child = Entry.from_string(child_value)
-      e.children.append(child)
-    elif type(child_value) == dict:
-      for key, value in sorted(child_value.items()):
-        # Make sure that value is a list, so that we can iterate over it.
-        # This way, we translate a list to a sequence of Elements with the same name.
-        if type(value) == list:
-          values = value
-        else:
-          values = [value]
-        for v in values:
-          d2 = {key: v}
-          child = Element.from_dict(d2, e.recursive_depth + 1)
-          child.parent = self
-          e.children.extend([n(), child])
-      e.children.append(n())
-    else:
-      raise TypeError
-    e.complete = True
+    symbols = {}
+    texts = []
+    name, value = next(iter(d.items()))
+    e = Element()
+    e.name = intern_name(name, symbols)
+    e.stored_depth = recursive_depth
+    stack = [(e, value)]
+    push = stack.append
+    pop = stack.pop
+    newline = '\n'
+    while stack:
+      element, value = pop()
+      element.complete = True
+      children = element.children
+      add = children.append
+      if type(value) is str:
+        entry = Entry()
+        entry.stored_data = value
+        entry.parent = element
+        add(entry)
+        texts.append(value)
+      elif type(value) is dict:
+        items = sorted(value.items()) if sort_keys else value.items()
+        for key, item in items:
+          name = symbols.get(key) or intern_name(key, symbols)
+          # A list is translated to a sequence of Elements with the same name.
+          for x in (item if type(item) is list else (item,)):
+            entry = Entry()
+            entry.stored_data = newline
+            entry.parent = element
+            add(entry)
+            child = Element()
+            child.name = name
+            child.parent = element
+            add(child)
+            push((child, x))
+        entry = Entry()
+        entry.stored_data = newline
+        entry.parent = element
+        add(entry)
+      else:
+        raise TypeError
+    if not entry_data_pattern.fullmatch(''.join(texts)):
+      raise ValueError
     return e
 
 
   @classmethod
-  def from_json(self, s=None):
+  def from_json(self, s=None, sort_keys=True):
     if s is None:
       raise ValueError
     d = json.loads(s)
-    e = Element.from_dict(d)
+    e = Element.from_dict(d, sort_keys=sort_keys)
     return e
 
 
@@ -1101,16 +2648,46 @@ class Element(object):
 
 
 class Entry:
+  # Notes:
+  # - Like Element, Entry uses __slots__.
+  # - The data is stored in stored_data. Setting data clears the caches of the parent Element and its ancestors (see Element.invalidate_caches).
+
+
+  __slots__ = (
+    'stored_data', 'parent',
+    'data_index', 'line_number', 'line_index',
+    'stored_depth', 'position',
+  )
 
 
   def __init__(self):
     # self.data contains the actual data in bytes of the Entry (after the escape characters have been removed).
-    self.data = ""
+    self.stored_data = ""
     self.parent = None
     # data_index, line_number, and line_index exist with reference to the original data (which includes escape characters). They record the location of the start of an entry.
     self.data_index = 0
     self.line_number = 0
     self.line_index = 0
+    # The depth is found when it's first used (see Element.recursive_depth).
+    self.stored_depth = None
+    # The index of this Entry in its parent's children (see Element.get_index).
+    self.position = 0
+
+
+  # The depth is found in the same way as an Element's.
+  recursive_depth = Element.recursive_depth
+
+
+  @property
+  def data(self):
+    return self.stored_data
+
+
+  @data.setter
+  def data(self, value):
+    self.stored_data = value
+    if self.parent is not None:
+      self.parent.invalidate_caches()
 
 
   @classmethod
@@ -1118,9 +2695,8 @@ class Entry:
     # This is for creating a new standalone Entry (which will be inserted into an Element).
     if not isinstance(value, str):
       raise ValueError
-    for byte in value:
-      if byte not in entry_characters:
-        raise ValueError
+    if not entry_data_pattern.fullmatch(value):
+      raise ValueError
     entry = Entry()
     entry.data = value
     return entry
@@ -1153,36 +2729,60 @@ class Entry:
     v.wn(line_index, 'line_index', location)
     v.wn(recursive_depth, 'recursive_depth', location)
     v.validate_boolean(verbose, 'verbose', location)
+    return Entry.from_string_section_trusted(
+      data=data, data_length=data_length,
+      parent=parent, data_index=data_index,
+      line_number=line_number, line_index=line_index,
+      recursive_depth=recursive_depth, verbose=verbose,
+    )
+
+
+  @classmethod
+  def from_string_section_trusted(
+      cls,
+      data,
+      data_length,
+      parent,
+      data_index,
+      line_number,
+      line_index,
+      recursive_depth,
+      verbose,
+      ):
+    # Same as from_string_section, except that the arguments are not validated. See Element.from_string_trusted.
     # Process data into an Entry.
     entry = Entry()
     entry.parent = parent
     entry.data_index = data_index
     entry.line_number = line_number
     entry.line_index = line_index
-    entry.recursive_depth = recursive_depth
-    entry.verbose = verbose
+    entry.stored_depth = recursive_depth
     data_index, line_number, line_index = entry.process_string(
-      data, data_length
+      data, data_length, verbose
     )
-    n_bytes = len(entry.data)
-    z = 10  # How much of the entry's start/end data to show in the log.
-    value = entry.data
-    if n_bytes > 2 * z:
-      value = value[:z] + "..." + value[-z:]
-    value = repr(value)
-    deb("Entry parsed. Length = {n} bytes. Value = {v}.".format(n=n_bytes, v=value))
+    if logger.isEnabledFor(logging.DEBUG):
+      # Only build the log message if it will actually be logged.
+      n_bytes = len(entry.data)
+      z = 10  # How much of the entry's start/end data to show in the log.
+      value = entry.data
+      if n_bytes > 2 * z:
+        value = value[:z] + "..." + value[-z:]
+      value = repr(value)
+      deb("Entry parsed. Length = {n} bytes. Value = {v}.".format(n=n_bytes, v=value))
     return entry, data_index, line_number, line_index
 
 
-  def process_string(self, data, data_length):
+  def process_string(self, data, data_length, verbose=False):
     # Notes:
     # - An entry consists of at least one printable ASCII byte.
+    # - This per-byte loop is only used when verbose is True, so that each byte can be logged. Otherwise, we use process_string_runs, which produces the same result.
+    if not verbose:
+      return self.process_string_runs(data, data_length)
     # Load stored values from self.
     data_index = self.data_index
     line_number = self.line_number
     line_index = self.line_index
     recursive_depth = self.recursive_depth
-    verbose = self.verbose
     status_msg = "Entry: context [{c}], byte [{b}], data_index [{di}], line_number [{ln}], line_index [{li}], recursive_depth [{r}]."
     context = DATA
     # We test for (byte + context) combination that we're interested in, and raise an Error if we get any other combination.
@@ -1266,6 +2866,116 @@ class Entry:
     return data_index, line_number, line_index
 
 
+  def process_string_runs(self, data, data_length):
+    # Run-based version of process_string.
+    self.data, data_index, line_number, line_index = Entry.scan_runs(
+      data, self.data_index, self.line_number, self.line_index,
+      self.recursive_depth,
+    )
+    return data_index, line_number, line_index
+
+
+  @staticmethod
+  def scan_runs(data, data_index, line_number, line_index, recursive_depth):
+    # Scan the Entry that starts at data_index, and return its (unescaped) data and the position indices of its final byte.
+    # Notes:
+    # - Instead of interpreting the data one byte at a time, we use entry_run_pattern to consume a whole run of ordinary entry characters at once, and then handle the single special byte that ends the run ('<', '>', '\', an invalid byte, or the end of the data).
+    # - The Entry data is built by joining the runs (and the escaped characters) together at the end, rather than by adding one byte at a time.
+    # - The position indices and the error messages are the same as those produced by process_string.
+    # - This doesn't need an Entry object, so it can also be used by parsers that don't build a tree.
+    # - data can also be bytes-like (e.g. an mmap of a file). The special bytes are identified by their character class, so the same code handles both cases.
+    text = isinstance(data, str)
+    if text:
+      match_run = entry_run_pattern.match
+      classes = character_classes
+      newline = '\n'
+    else:
+      match_run = entry_run_bytes_pattern.match
+      classes = byte_character_classes
+      newline = b'\n'
+    pieces = []
+    context = DATA
+    while True:
+
+      match = match_run(data, data_index)
+      if match is not None:
+        end = match.end()
+        run = match.group()
+        pieces.append(run)
+        # Update the line indices as though we had processed each byte in the run.
+        n_newlines = run.count(newline)
+        if n_newlines:
+          line_number += n_newlines
+          line_index = end - (data_index + run.rfind(newline))
+        else:
+          line_index += end - data_index
+        data_index = end
+
+      try:
+        byte = data[data_index]
+      except IndexError as e:
+        status_msg = entry_status_msg.format(
+          c=context_names[context], b=repr(as_text(data[data_index-1])), di=data_index,
+          ln=line_number, li=line_index, r=recursive_depth
+        )
+        status_msg += " No more data left, but Element is not complete."
+        raise Exception(status_msg)
+      character_class = classes.get(byte, INVALID)
+
+      if character_class == LT:
+        # We've encountered a new Element.
+        # Rewind one byte so that the Element processing loop completes and begins again on this current byte.
+        data_index, line_number, line_index = Entry.rewind_one_byte(
+          data_index, line_number, line_index
+        )
+        break
+
+      elif character_class == BACKSLASH:
+        # The next byte should be an escaped character.
+        context = ESCAPED
+        data_index += 1
+        line_index += 1
+        try:
+          byte = data[data_index]
+        except IndexError as e:
+          status_msg = entry_status_msg.format(
+            c=context_names[context], b=repr("\\"), di=data_index,
+            ln=line_number, li=line_index, r=recursive_depth
+          )
+          status_msg += " No more data left, but Element is not complete."
+          raise Exception(status_msg)
+        character_class = classes.get(byte, INVALID)
+        if character_class not in (LT, GT, BACKSLASH):
+          if character_class == NEWLINE:
+            line_index = 0
+            line_number += 1
+          status_msg = entry_status_msg.format(
+            c=context_names[context], b=repr(as_text(byte)), di=data_index,
+            ln=line_number, li=line_index, r=recursive_depth
+          )
+          status_msg += " Previous bytes: [{p}]. Byte not successfully interpreted.".format(p=as_text(data[data_index-50:data_index]))
+          raise Exception(status_msg)
+        pieces.append(data[data_index:data_index+1])
+        context = DATA
+        data_index += 1
+        line_index += 1
+
+      else:
+        status_msg = entry_status_msg.format(
+          c=context_names[context], b=repr(as_text(byte)), di=data_index,
+          ln=line_number, li=line_index, r=recursive_depth
+        )
+        if character_class == GT:
+          status_msg += " Encountered unescaped right angle bracket (>) in Entry data."
+        else:
+          status_msg += " Previous bytes: [{p}]. Byte not successfully interpreted.".format(p=as_text(data[data_index-50:data_index]))
+        raise Exception(status_msg)
+
+    if text:
+      return ''.join(pieces), data_index, line_number, line_index
+    return b''.join(pieces).decode('ascii'), data_index, line_number, line_index
+
+
   @staticmethod
   def rewind_one_byte(data_index, line_number, line_index):
     data_index -= 1
@@ -1314,12 +3024,19 @@ class Entry:
 
 
   def get_index(self):
-    # Look through siblings, and find our own index among them.
-    if self.parent is None:
+    # Return our own index among our siblings.
+    # The stored position is used if it's still correct. Otherwise, the siblings are numbered again.
+    parent = self.parent
+    if parent is None:
       raise Exception
-    for i, child in enumerate(self.parent.children):
-      if id(child) == id(self):
-        return i
+    children = parent.children
+    i = self.position
+    if i < len(children) and children[i] is self:
+      return i
+    number_children(children)
+    i = self.position
+    if i < len(children) and children[i] is self:
+      return i
     raise KeyError
 
 
@@ -1344,17 +3061,26 @@ class Entry:
   @property
   def escaped_data(self):
     # Insert backslash before any escaped characters.
-    result = ''
-    for c in self.data:
-      if c in escaped_characters:
-        result += "\\" + c
-      else:
-        result += c
-    return result
+    return Entry.escape(self.data)
+
+
+  @staticmethod
+  def escape(s):
+    # Insert backslash before any escaped characters.
+    # Fast path: Most Entry data contains no escaped characters, so we return it unchanged without building a new string.
+    if '\\' not in s and '<' not in s and '>' not in s:
+      return s
+    for c, replacement in escape_replacements:
+      if c in s:
+        s = s.replace(c, replacement)
+    return s
 
 
   def create_copy(self):
-    return Entry.from_string(self.escaped_data)
+    # The data is stored unescaped, so it can be copied directly.
+    entry = Entry()
+    entry.data = self.data
+    return entry
 
 
 
@@ -7,6 +7,8 @@ import logging
 # Relative imports
 from .. import util
 from . import Element
+from . import stream
+from . import flat
 
 
 
@@ -44,3 +46,15 @@ def setup(
     log_timestamp = log_timestamp,
     log_file = log_file,
   )
+  stream.setup(
+    log_level = log_level,
+    debug = debug,
+    log_timestamp = log_timestamp,
+    log_file = log_file,
+  )
+  flat.setup(
+    log_level = log_level,
+    debug = debug,
+    log_timestamp = log_timestamp,
+    log_file = log_file,
+  )
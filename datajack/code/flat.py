@@ -0,0 +1,597 @@
+# Imports
+import logging
+import array
+
+
+
+
+# Relative imports
+from .. import util
+from . import Element as element_module
+from . import stream
+
+
+
+
+# Shortcuts
+v = util.validate
+Element = element_module.Element
+Entry = element_module.Entry
+
+
+
+
+# Set up logger for this module. By default, it produces no output.
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+logger.setLevel(logging.ERROR)
+log = logger.info
+deb = logger.debug
+
+
+
+
+def setup(
+    log_level = 'error',
+    debug = False,
+    log_timestamp = False,
+    log_file = None,
+    ):
+  # Configure logger for this module.
+  util.module_logger.configure_module_logger(
+    logger = logger,
+    logger_name = __name__,
+    log_level = log_level,
+    debug = debug,
+    log_timestamp = log_timestamp,
+    log_file = log_file,
+  )
+  deb('Setup complete.')
+
+
+
+
+# IMMUTABLE DATA
+# Node kinds.
+ELEMENT = 0
+ENTRY = 1
+# Index value that means "no node".
+NONE = -1
+# END IMMUTABLE DATA
+
+
+
+
+# NOTES:
+# - A Document stores an entire EML tree in parallel array.array columns, with one row per node (Element or Entry). Nodes are numbered in document order, so the root is node 0.
+# -- kinds: ELEMENT or ENTRY.
+# -- name_ids: For an Element, the index of its name in the names list. Each distinct name is stored only once. For an Entry, NONE.
+# -- parents, first_children, next_siblings: Node indices (or NONE).
+# -- starts, ends: For an Entry, the location of its (unescaped) data in the text buffer, which contains the data of all the Entries. For an Element, 0.
+# - This uses a few tens of bytes per node, instead of the hundreds of bytes used by an Element or Entry object, and a scan over the whole tree only reads the columns.
+# - A Document is read-only. To change it, convert it to an Element tree with to_element(), make the changes, and convert it back with Document.from_element().
+# - The nodes are accessed through Cursor objects, which have the same read-only interface as Element and Entry (e.g. name, children, text, value, get).
+# - The parsing position indices (data_index etc) are not stored.
+
+
+
+
+class Document(object):
+  """Flat, array-backed EML tree."""
+
+
+  def __init__(self):
+    self.kinds = array.array('b')
+    self.name_ids = array.array('i')
+    self.parents = array.array('i')
+    self.first_children = array.array('i')
+    self.next_siblings = array.array('i')
+    self.starts = array.array('q')
+    self.ends = array.array('q')
+    self.names = []
+    self.text = ''
+
+
+  @classmethod
+  def from_string(cls, data=None, max_depth=None):
+    # Parse EML data directly into a Document, without building an Element tree.
+    if data is None:
+      raise ValueError
+    return Document.from_events(stream.iterparse(data, max_depth=max_depth))
+
+
+  @classmethod
+  def from_element(cls, element=None):
+    if element is None:
+      raise ValueError
+    if not isinstance(element, Element):
+      raise TypeError
+    return Document.from_events(stream.element_events(element))
+
+
+  @classmethod
+  def from_events(cls, events):
+    # Build a Document from a sequence of events (see stream.py).
+    doc = Document()
+    kinds = doc.kinds
+    name_ids = doc.name_ids
+    parents = doc.parents
+    first_children = doc.first_children
+    next_siblings = doc.next_siblings
+    starts = doc.starts
+    ends = doc.ends
+    names = doc.names
+    name_index = {}
+    pieces = []
+    offset = 0
+    # Stacks of the open Elements, and of the last child that has been added to each of them.
+    open_elements = []
+    last_children = []
+    for event, value, position in events:
+      if event == 'end':
+        open_elements.pop()
+        last_children.pop()
+        continue
+      index = len(kinds)
+      if event == 'start':
+        kinds.append(ELEMENT)
+        name_id = name_index.get(value)
+        if name_id is None:
+          name_id = name_index[value] = len(names)
+          names.append(value)
+        name_ids.append(name_id)
+        starts.append(0)
+        ends.append(0)
+      else:
+        kinds.append(ENTRY)
+        name_ids.append(NONE)
+        pieces.append(value)
+        starts.append(offset)
+        offset += len(value)
+        ends.append(offset)
+      first_children.append(NONE)
+      next_siblings.append(NONE)
+      if open_elements:
+        parent = open_elements[-1]
+        parents.append(parent)
+        if last_children[-1] == NONE:
+          first_children[parent] = index
+        else:
+          next_siblings[last_children[-1]] = index
+        last_children[-1] = index
+      else:
+        parents.append(NONE)
+      if event == 'start':
+        open_elements.append(index)
+        last_children.append(NONE)
+    doc.text = ''.join(pieces)
+    return doc
+
+
+  def __len__(self):
+    # Number of nodes.
+    return len(self.kinds)
+
+
+  @property
+  def root(self):
+    return Cursor(self, 0)
+
+
+  def elements_with_name(self, name):
+    # Return all the Elements with this name, in document order. This scans the name_ids column, rather than walking the tree.
+    try:
+      name_id = self.names.index(name)
+    except ValueError as e:
+      return []
+    return [Cursor(self, i) for i, x in enumerate(self.name_ids) if x == name_id]
+
+
+  def to_element(self):
+    # Build an Element tree that contains the same data.
+    # Nodes are numbered in document order, so each node's parent has already been built when we reach it, and the children of each Element are appended in order.
+    kinds = self.kinds
+    names = self.names
+    name_ids = self.name_ids
+    parents = self.parents
+    starts = self.starts
+    ends = self.ends
+    text = self.text
+    items = []
+    for index in range(len(kinds)):
+      if kinds[index] == ELEMENT:
+        item = Element()
+        item.name = names[name_ids[index]]
+        item.complete = True
+      else:
+        item = Entry()
+        item.data = text[starts[index]:ends[index]]
+      parent = parents[index]
+      if parent != NONE:
+        parent = items[parent]
+        item.parent = parent
+        item.recursive_depth = parent.recursive_depth + 1
+        parent.children.append(item)
+      items.append(item)
+    return items[0]
+
+
+
+
+class Cursor(object):
+  """A position in a Document. It has the same read-only interface as Element and Entry."""
+  # Notes:
+  # - A Cursor only stores the Document and a node index, so it's cheap to create. Two Cursors are equal if they point to the same node of the same Document.
+  # - The xpath methods (get, get_one, get_value, etc) are the same functions that Element uses, so the results are the same. They only need the methods that are defined below.
+
+
+  __slots__ = ('document', 'index')
+  # A Cursor has no value indexes (see Element.index_values).
+  value_index = None
+
+
+  def __init__(self, document, index):
+    self.document = document
+    self.index = index
+
+
+  def __eq__(self, other):
+    return isinstance(other, Cursor) and self.document is other.document and self.index == other.index
+
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+
+  def __hash__(self):
+    return hash((id(self.document), self.index))
+
+
+  def __str__(self):
+    if self.is_entry:
+      return "Entry: [{} bytes]".format(self.nb)
+    return "Element: [{}]".format(self.name)
+
+
+  def __iter__(self):
+    return iter(self.children)
+
+
+  @property
+  def is_element(self):
+    return self.document.kinds[self.index] == ELEMENT
+
+
+  @property
+  def is_entry(self):
+    return self.document.kinds[self.index] == ENTRY
+
+
+  @property
+  def class_name(self):
+    # The class name of the equivalent node in an Element tree.
+    return 'Element' if self.is_element else 'Entry'
+
+
+  @property
+  def name(self):
+    if not self.is_element:
+      raise AttributeError("An Entry has no name.")
+    doc = self.document
+    return doc.names[doc.name_ids[self.index]]
+
+
+  @property
+  def end_name(self):
+    return self.name
+
+
+  @property
+  def parent(self):
+    index = self.document.parents[self.index]
+    if index == NONE:
+      return None
+    return Cursor(self.document, index)
+
+
+  def child_indices(self):
+    # Generate the node indices of this node's children.
+    doc = self.document
+    next_siblings = doc.next_siblings
+    index = doc.first_children[self.index]
+    while index != NONE:
+      yield index
+      index = next_siblings[index]
+
+
+  @property
+  def children(self):
+    doc = self.document
+    return [Cursor(doc, i) for i in self.child_indices()]
+
+
+  @property
+  def child(self):
+    return self.children
+
+
+  @property
+  def nc(self):
+    # Calculate number of children.
+    return sum(1 for i in self.child_indices())
+
+
+  @property
+  def element_children(self):
+    doc = self.document
+    kinds = doc.kinds
+    return [Cursor(doc, i) for i in self.child_indices() if kinds[i] == ELEMENT]
+
+
+  @property
+  def element_child(self):
+    return self.element_children
+
+
+  @property
+  def element_children_names(self):
+    doc = self.document
+    kinds = doc.kinds
+    names = doc.names
+    name_ids = doc.name_ids
+    return [names[name_ids[i]] for i in self.child_indices() if kinds[i] == ELEMENT]
+
+
+  @property
+  def entry_children(self):
+    doc = self.document
+    kinds = doc.kinds
+    return [Cursor(doc, i) for i in self.child_indices() if kinds[i] == ENTRY]
+
+
+  @property
+  def element_descendants(self):
+    # Same order as Element.element_descendants, and also walked with an explicit stack.
+    items = []
+    stack = [self]
+    while stack:
+      children = stack.pop().element_children
+      items.extend(children)
+      stack.extend(reversed(children))
+    return items
+
+
+  @property
+  def start_tag(self):
+    return "<" + self.name + ">"
+
+
+  @property
+  def end_tag(self):
+    return "</" + self.end_name + ">"
+
+
+  @property
+  def is_leaf(self):
+    doc = self.document
+    index = doc.first_children[self.index]
+    if index == NONE:
+      return True
+    if doc.next_siblings[index] == NONE and doc.kinds[index] == ENTRY:
+      return True
+    return False
+
+
+  @property
+  def entry_data(self):
+    # For an Entry, this is its (unescaped) data. For an Element, this is the data of its Entry children.
+    doc = self.document
+    if doc.kinds[self.index] == ENTRY:
+      return doc.text[doc.starts[self.index]:doc.ends[self.index]]
+    starts = doc.starts
+    ends = doc.ends
+    kinds = doc.kinds
+    text = doc.text
+    return ''.join([text[starts[i]:ends[i]] for i in self.child_indices() if kinds[i] == ENTRY])
+
+
+  @property
+  def text(self):
+    # Get only the text contained by the element. Ignore its element children.
+    return self.entry_data
+
+
+  @property
+  def nb(self):  # nb = number of bytes
+    doc = self.document
+    return doc.ends[self.index] - doc.starts[self.index]
+
+
+  @property
+  def value(self):
+    if not self.is_leaf:
+      raise ValueError('{} is not a leaf element.'.format(self))
+    return Element.delete_whitespace(self.text)
+
+
+  @property
+  def branch_value(self):
+    return Element.delete_whitespace(self.entry_data)
+
+
+  @property
+  def data(self):
+    # Same as Element.data and Entry.data: For an Element, this is its EML data. For an Entry, this is its unescaped data.
+    if self.is_entry:
+      return self.entry_data
+    return self.escaped_data
+
+
+  @property
+  def escaped_data(self):
+    # The EML data of this node. Escape characters are inserted into the Entry data.
+    doc = self.document
+    kinds = doc.kinds
+    names = doc.names
+    name_ids = doc.name_ids
+    first_children = doc.first_children
+    next_siblings = doc.next_siblings
+    parents = doc.parents
+    text = doc.text
+    pieces = []
+    index = self.index
+    while True:
+      # Write the current node. If it's an Element with children, descend into it.
+      if kinds[index] == ENTRY:
+        pieces.append(Entry.escape(text[doc.starts[index]:doc.ends[index]]))
+      else:
+        pieces.append('<' + names[name_ids[index]] + '>')
+        if first_children[index] != NONE:
+          index = first_children[index]
+          continue
+        pieces.append('</' + names[name_ids[index]] + '>')
+      # Move to the next node, closing any Elements that we leave.
+      while index != self.index and next_siblings[index] == NONE:
+        index = parents[index]
+        pieces.append('</' + names[name_ids[index]] + '>')
+      if index == self.index:
+        break
+      index = next_siblings[index]
+    return ''.join(pieces)
+
+
+  @property
+  def content(self):
+    # Same as .data, except without the topmost element's start and end tags.
+    n1 = len(self.start_tag)
+    n2 = len(self.end_tag)
+    return self.data[n1:-n2]
+
+
+  def get_element_children_with_name(self, name):
+    doc = self.document
+    kinds = doc.kinds
+    names = doc.names
+    name_ids = doc.name_ids
+    return [
+      Cursor(doc, i) for i in self.child_indices()
+      if kinds[i] == ELEMENT and names[name_ids[i]] == name
+    ]
+
+
+  def get_element_descendants_with_name(self, name):
+    # Same order as Element.get_element_descendants_with_name (document order).
+    # Nodes are numbered in document order, so the descendants of this node are the nodes from the next index up to the end of its subtree.
+    doc = self.document
+    try:
+      name_id = doc.names.index(name)
+    except ValueError as e:
+      return []
+    kinds = doc.kinds
+    name_ids = doc.name_ids
+    return [
+      Cursor(doc, i) for i in range(self.index + 1, self.subtree_end())
+      if kinds[i] == ELEMENT and name_ids[i] == name_id
+    ]
+
+
+  def get_element_descendants_with_names(self, names):
+    # Same as Element.get_element_descendants_with_names.
+    doc = self.document
+    kinds = doc.kinds
+    name_ids = doc.name_ids
+    ids = {}
+    results = {}
+    for name in names:
+      results[name] = []
+      if name in doc.names:
+        ids[doc.names.index(name)] = results[name]
+    for i in range(self.index + 1, self.subtree_end()):
+      if kinds[i] == ELEMENT:
+        items = ids.get(name_ids[i])
+        if items is not None:
+          items.append(Cursor(doc, i))
+    return results
+
+
+  def iter_element_descendants_with_name(self, name):
+    # Lazy version of get_element_descendants_with_name.
+    doc = self.document
+    try:
+      name_id = doc.names.index(name)
+    except ValueError as e:
+      return
+    kinds = doc.kinds
+    name_ids = doc.name_ids
+    for i in range(self.index + 1, self.subtree_end()):
+      if kinds[i] == ELEMENT and name_ids[i] == name_id:
+        yield Cursor(doc, i)
+
+
+  def subtree_end(self):
+    # Return the index after the last node in this node's subtree: the next sibling of this node or of its nearest ancestor that has one.
+    doc = self.document
+    index = self.index
+    while index != NONE:
+      next_index = doc.next_siblings[index]
+      if next_index != NONE:
+        return next_index
+      index = doc.parents[index]
+    return len(doc.kinds)
+
+
+  is_element_name = staticmethod(Element.is_element_name)
+  get = Element.get
+  query = Element.query
+  get_first = Element.get_first
+  exists = Element.exists
+  get_many = Element.get_many
+  get_value_many = Element.get_value_many
+  get_one = Element.get_one
+  get_value = Element.get_value
+  get_if_exists = Element.get_if_exists
+  get_value_if_exists = Element.get_value_if_exists
+  get_branch_value = Element.get_branch_value
+  get_all = Element.get_all
+  get_values = Element.get_values
+  iter_descendants = Element.iter_descendants
+  iter_elements = Element.iter_elements
+  iter_entries = Element.iter_entries
+
+
+  def to_element(self):
+    # Build an Element tree (or an Entry) that contains the same data as this node.
+    if self.is_entry:
+      entry = Entry()
+      entry.data = self.entry_data
+      return entry
+    doc = Document.from_events(self.events())
+    return doc.to_element()
+
+
+  def events(self):
+    # Generate the events (see stream.py) for the data of this node. The positions are not stored, so they are None.
+    doc = self.document
+    kinds = doc.kinds
+    names = doc.names
+    name_ids = doc.name_ids
+    first_children = doc.first_children
+    next_siblings = doc.next_siblings
+    parents = doc.parents
+    text = doc.text
+    index = self.index
+    while True:
+      if kinds[index] == ENTRY:
+        yield ('entry', text[doc.starts[index]:doc.ends[index]], None)
+      else:
+        yield ('start', names[name_ids[index]], None)
+        if first_children[index] != NONE:
+          index = first_children[index]
+          continue
+        yield ('end', names[name_ids[index]], None)
+      while index != self.index and next_siblings[index] == NONE:
+        index = parents[index]
+        yield ('end', names[name_ids[index]], None)
+      if index == self.index:
+        break
+      index = next_siblings[index]
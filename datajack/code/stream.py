@@ -0,0 +1,585 @@
+# Imports
+import logging
+
+
+
+
+# Relative imports
+from .. import util
+from . import Element as element_module
+
+
+
+
+# Shortcuts
+v = util.validate
+Element = element_module.Element
+Entry = element_module.Entry
+intern_name = element_module.intern_name
+# Grammar
+character_classes = element_module.character_classes
+element_transitions = element_module.element_transitions
+context_names = element_module.context_names
+element_status_msg = element_module.element_status_msg
+entry_status_msg = element_module.entry_status_msg
+escaped_characters = element_module.escaped_characters
+entry_run_pattern = element_module.entry_run_pattern
+element_name_characters = element_module.element_name_characters
+INVALID = element_module.INVALID
+NEWLINE = element_module.NEWLINE
+EMPTY = element_module.EMPTY
+START_TAG_NAME = element_module.START_TAG_NAME
+INSIDE_ELEMENT = element_module.INSIDE_ELEMENT
+DATA = element_module.DATA
+ESCAPED = element_module.ESCAPED
+ADD_TO_NAME = element_module.ADD_TO_NAME
+ADD_TO_END_NAME = element_module.ADD_TO_END_NAME
+CLOSE_START_TAG = element_module.CLOSE_START_TAG
+START_ENTRY = element_module.START_ENTRY
+START_CHILD = element_module.START_CHILD
+CLOSE_ELEMENT = element_module.CLOSE_ELEMENT
+
+
+
+
+# Set up logger for this module. By default, it produces no output.
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+logger.setLevel(logging.ERROR)
+log = logger.info
+deb = logger.debug
+
+
+
+
+def setup(
+    log_level = 'error',
+    debug = False,
+    log_timestamp = False,
+    log_file = None,
+    ):
+  # Configure logger for this module.
+  util.module_logger.configure_module_logger(
+    logger = logger,
+    logger_name = __name__,
+    log_level = log_level,
+    debug = debug,
+    log_timestamp = log_timestamp,
+    log_file = log_file,
+  )
+  deb('Setup complete.')
+
+
+
+
+# NOTES:
+# - This module parses EML data into a stream of events, without building an Element tree.
+# - Events are tuples: (event, value, position).
+# -- ('start', name, position): The start tag of an Element. The position is that of its '<' byte.
+# -- ('entry', data, position): An Entry. The data has had its escape characters removed. The position is that of its first byte.
+# -- ('end', name, position): The end tag of an Element. The position is that of its final '>' byte.
+# - A position is a tuple: (data_index, line_number, line_index). These are the same values that Element.from_string stores in the data_index, line_number, and line_index (or final_data_index, final_line_number, and final_line_index) attributes of the corresponding Element or Entry.
+# - The grammar, the escape rules, and the error messages are the same as those of Element.from_string.
+# - Only the names of the currently open Elements are kept, so the memory used by the parser depends on the depth of the data, not its size.
+# - iterparse needs the entire data in a single string. FeedParser accepts the data in chunks (e.g. as it arrives from a pipe or a socket). A chunk can end anywhere, including in the middle of a tag name or an escape sequence.
+
+
+
+
+def iterparse(data=None, max_depth=None):
+  # Generator that yields an event for each start tag, Entry, and end tag in the data.
+  # Example:
+  # - list(iterparse('<a>hi</a>')) == [('start', 'a', (0, 1, 0)), ('entry', 'hi', (3, 1, 3)), ('end', 'a', (8, 1, 8))]
+  if data is None:
+    raise ValueError
+  location = 'datajack/code/stream.py:iterparse()'
+  v.validate_string(data, 'data', location)
+  if max_depth is not None:
+    v.wn(max_depth, 'max_depth', location)
+  data_length = len(data)
+  data_index = 0
+  line_number = 1
+  line_index = 0
+  classes = character_classes
+  transitions = element_transitions
+  scan_entry = Entry.scan_runs
+  # Symbol table for Element names (see intern_name in Element.py).
+  symbols = {}
+  # State of the Element that we are currently processing. (See Element.process_string_table.)
+  name = ''
+  name_chars = []
+  end_name_chars = []
+  context = EMPTY
+  byte = None
+  recursive_depth = 0
+  start_position = (data_index, line_number, line_index)
+  # Stack of the names of the unfinished ancestors of the current Element, and the last byte that was processed in each of them.
+  stack = []
+  while True:
+
+    try:
+      byte = data[data_index]
+    except IndexError as e:
+      status_msg = element_status_msg.format(
+        c=context_names[context], b=repr(byte), di=data_index,
+        ln=line_number, li=line_index, r=recursive_depth
+      )
+      status_msg += " No more data left, but Element is not complete."
+      raise Exception(status_msg)
+
+    character_class = classes.get(byte, INVALID)
+    if character_class == NEWLINE:
+      line_index = 0
+      line_number += 1
+
+    transition = transitions[context][character_class]
+
+    if transition is None:
+      status_msg = element_status_msg.format(
+        c=context_names[context], b=repr(byte), di=data_index,
+        ln=line_number, li=line_index, r=recursive_depth
+      )
+      status_msg += " Previous bytes: [{p}]. Byte not successfully interpreted.".format(p=data[data_index-50:data_index])
+      error_msg = ''
+      if context == START_TAG_NAME:
+        error_msg = 'Tag names can only contain characters in the element_name_characters list: [{}]'.format(element_name_characters)
+        error_msg = '\n\nERROR: ' + error_msg + '\n'
+      raise Exception(status_msg + error_msg)
+
+    context, action = transition
+
+    if action == ADD_TO_NAME:
+      name_chars.append(byte)
+
+    elif action == ADD_TO_END_NAME:
+      end_name_chars.append(byte)
+
+    elif action == CLOSE_START_TAG:
+      name = intern_name(''.join(name_chars), symbols)
+      yield ('start', name, start_position)
+
+    elif action == START_ENTRY:
+      if character_class == NEWLINE:
+        # We added 1 at the start of this loop.
+        line_number -= 1
+      entry_position = (data_index, line_number, line_index)
+      entry_data, data_index, line_number, line_index = scan_entry(
+        data, data_index, line_number, line_index, recursive_depth + 1
+      )
+      yield ('entry', entry_data, entry_position)
+
+    elif action == START_CHILD:
+      # The child Element starts at the '<' byte that we have just passed, and we have just processed the first byte of its name.
+      if max_depth is not None and recursive_depth + 1 > max_depth:
+        raise ValueError(element_module.Element.max_depth_error_msg(
+          data_index - 1, line_number, line_index - 1, recursive_depth + 1, max_depth
+        ))
+      stack.append((name, byte))
+      start_position = (data_index - 1, line_number, line_index - 1)
+      recursive_depth += 1
+      name_chars = [byte]
+      end_name_chars = []
+      context = START_TAG_NAME
+
+    elif action == CLOSE_ELEMENT:
+      # We've arrived at the end of the current Element.
+      end_name = ''.join(end_name_chars)
+      if name != end_name:
+        status_msg = element_status_msg.format(
+          c=context_names[context], b=repr(byte), di=data_index,
+          ln=line_number, li=line_index, r=recursive_depth
+        )
+        status_msg += " Finished building Element, but end_tagName ({e}) is not the same as start_tagName ({s}).".format(e=end_name, s=name)
+        raise Exception(status_msg)
+      end_position = (data_index, line_number, line_index)
+      if not stack:
+        # This is the root Element of the data.
+        # If there is any data left over, this is an error.
+        if data_index < data_length - 1:
+          remaining_data = data[data_index+1:]
+          _msg = "Finished building root element, but there is remaining data: {}".format(repr(remaining_data))
+          raise ValueError(_msg)
+        yield ('end', name, end_position)
+        return
+      yield ('end', name, end_position)
+      # Switch back to the parent Element.
+      name, byte = stack.pop()
+      recursive_depth -= 1
+      end_name_chars = []
+      context = INSIDE_ELEMENT
+
+    data_index += 1
+    line_index += 1
+
+
+
+
+def element_events(element=None):
+  # Generator that yields the events for the data of an existing Element tree. The positions are taken from the Element and Entry attributes.
+  # Notes:
+  # - If the tree was built by Element.from_string, the events are the same as those that iterparse produces for the same data.
+  # - The tree is traversed with an explicit stack, so it can be of any depth.
+  if element is None:
+    raise ValueError
+  # Stack of (item, finished) pairs. If finished is True, the item is an Element whose children have all been processed.
+  stack = [(element, False)]
+  while stack:
+    item, finished = stack.pop()
+    if item.is_entry:
+      yield ('entry', item.data, (item.data_index, item.line_number, item.line_index))
+    elif finished:
+      yield ('end', item.name, (item.final_data_index, item.final_line_number, item.final_line_index))
+    else:
+      yield ('start', item.name, (item.data_index, item.line_number, item.line_index))
+      stack.append((item, True))
+      stack.extend((child, False) for child in reversed(item.children))
+
+
+
+
+def iterparse_file(file=None, chunk_size=65536, max_depth=None):
+  # Generator that reads the data from a file object in chunks, and yields the same events as iterparse.
+  # Notes:
+  # - The file object must be opened in text mode. Reading stops at the end of the file, so this can be used with a pipe (e.g. sys.stdin).
+  # - Each event is yielded as soon as the chunk that completes it has been read.
+  if file is None:
+    raise ValueError
+  location = 'datajack/code/stream.py:iterparse_file()'
+  v.pi(chunk_size, 'chunk_size', location)
+  parser = FeedParser(build_tree=False, events=True, max_depth=max_depth)
+  while True:
+    chunk = file.read(chunk_size)
+    if not chunk:
+      break
+    parser.feed(chunk)
+    for event in parser.read_events():
+      yield event
+  parser.close()
+
+
+
+
+class FeedParser(object):
+  """Incremental EML parser. Data is supplied in chunks with feed(), and close() is called at the end of the data."""
+  # Notes:
+  # - If build_tree is True, close() returns the root Element. The tree is the same as the one that Element.from_string would produce from the concatenated chunks.
+  # - If events is True, the events (see the NOTES above) are stored as they are produced, and can be collected with read_events() after each call to feed().
+  # - The grammar, the position indices, and the error messages are the same as those of Element.from_string, with two exceptions:
+  # -- The "Previous bytes" section of an error message contains the (up to) 50 bytes before the current byte. (Element.from_string uses data[data_index-50:data_index], which produces odd results near the start of the data.)
+  # -- If there is data after the end of the root Element, the error is raised as soon as it is fed, and the error message only contains the remaining data in the current chunk.
+  # -- Newlines after the end of the root Element are ignored, as in Element.from_file, so that a file written by Element.write_to_file can be read with iterparse_file.
+  # - Only the state of the currently open Elements and Entry is kept between chunks, so the parser doesn't need to buffer the data.
+  # Example:
+  # - parser = FeedParser(); parser.feed('<a>h'); parser.feed('i</a>'); e = parser.close()
+
+
+  def __init__(self, build_tree=True, events=False, max_depth=None):
+    location = 'datajack/code/stream.py:FeedParser:__init__()'
+    v.validate_boolean(build_tree, 'build_tree', location)
+    v.validate_boolean(events, 'events', location)
+    if max_depth is not None:
+      v.wn(max_depth, 'max_depth', location)
+    self.build_tree = build_tree
+    self.events = events
+    self.max_depth = max_depth
+    self.pending_events = []
+    self.root = None
+    # Open Elements of the tree that we are building.
+    self.elements = []
+    self.complete = False
+    self.closed = False
+    # Position of the next byte.
+    self.data_index = 0
+    self.line_number = 1
+    self.line_index = 0
+    # State of the Element that we are currently processing. (See iterparse.)
+    self.context = EMPTY
+    self.name = ''
+    self.name_chars = []
+    self.end_name_chars = []
+    self.byte = None
+    self.recursive_depth = 0
+    self.start_position = (0, 1, 0)
+    self.stack = []
+    # Symbol table for Element names (see intern_name in Element.py).
+    self.symbols = {}
+    # State of the Entry that we are currently processing (if context is DATA or ESCAPED).
+    self.entry_pieces = []
+    self.entry_position = None
+    # The last byte that was fed, and the (up to) 50 bytes before the current chunk. These are used in error messages.
+    self.last_byte = None
+    self.previous_bytes = ''
+
+
+  def feed(self, chunk):
+    # Process the next chunk of data.
+    location = 'datajack/code/stream.py:FeedParser:feed()'
+    v.validate_string(chunk, 'chunk', location)
+    if self.closed:
+      raise ValueError("FeedParser: feed() called after close().")
+    if self.complete:
+      self.check_remaining_data(chunk)
+      return
+    events = self.scan(chunk)
+    if self.build_tree:
+      self.build(events)
+    if self.events:
+      self.pending_events.extend(events)
+    if chunk:
+      self.last_byte = chunk[-1]
+      self.previous_bytes = (self.previous_bytes + chunk)[-50:]
+
+
+  def scan(self, chunk):
+    # Process the bytes in the chunk, and return a list of the events that they complete.
+    # Load the parser state into local variables.
+    data_index = self.data_index
+    line_number = self.line_number
+    line_index = self.line_index
+    context = self.context
+    name = self.name
+    name_chars = self.name_chars
+    end_name_chars = self.end_name_chars
+    byte = self.byte
+    recursive_depth = self.recursive_depth
+    start_position = self.start_position
+    stack = self.stack
+    entry_pieces = self.entry_pieces
+    entry_position = self.entry_position
+    max_depth = self.max_depth
+    classes = character_classes
+    transitions = element_transitions
+    match_run = entry_run_pattern.match
+    events = []
+    i = 0
+    n = len(chunk)
+    while i < n:
+
+      if context == DATA:
+        # We're inside an Entry. Consume a whole run of ordinary entry characters at once. (See Entry.scan_runs.)
+        match = match_run(chunk, i)
+        if match is not None:
+          end = match.end()
+          entry_pieces.append(match.group())
+          n_newlines = chunk.count('\n', i, end)
+          if n_newlines:
+            line_number += n_newlines
+            line_index = end - chunk.rfind('\n', i, end)
+          else:
+            line_index += end - i
+          data_index += end - i
+          i = end
+          if i == n:
+            break
+        entry_byte = chunk[i]
+        if entry_byte == '<':
+          # We've reached the end of the Entry. The '<' byte is processed as part of the Element.
+          events.append(('entry', ''.join(entry_pieces), entry_position))
+          entry_pieces = []
+          context = INSIDE_ELEMENT
+          continue
+        if entry_byte == '\\':
+          # The next byte should be an escaped character. It may be in the next chunk.
+          context = ESCAPED
+          i += 1
+          data_index += 1
+          line_index += 1
+          continue
+        status_msg = entry_status_msg.format(
+          c=context_names[context], b=repr(entry_byte), di=data_index,
+          ln=line_number, li=line_index, r=recursive_depth + 1
+        )
+        if entry_byte == '>':
+          status_msg += " Encountered unescaped right angle bracket (>) in Entry data."
+        else:
+          status_msg += " Previous bytes: [{p}]. Byte not successfully interpreted.".format(p=self.previous(chunk, i))
+        raise Exception(status_msg)
+
+      if context == ESCAPED:
+        entry_byte = chunk[i]
+        if entry_byte not in escaped_characters:
+          if entry_byte == '\n':
+            line_index = 0
+            line_number += 1
+          status_msg = entry_status_msg.format(
+            c=context_names[context], b=repr(entry_byte), di=data_index,
+            ln=line_number, li=line_index, r=recursive_depth + 1
+          )
+          status_msg += " Previous bytes: [{p}]. Byte not successfully interpreted.".format(p=self.previous(chunk, i))
+          raise Exception(status_msg)
+        entry_pieces.append(entry_byte)
+        context = DATA
+        i += 1
+        data_index += 1
+        line_index += 1
+        continue
+
+      byte = chunk[i]
+      character_class = classes.get(byte, INVALID)
+      if character_class == NEWLINE:
+        line_index = 0
+        line_number += 1
+
+      transition = transitions[context][character_class]
+
+      if transition is None:
+        status_msg = element_status_msg.format(
+          c=context_names[context], b=repr(byte), di=data_index,
+          ln=line_number, li=line_index, r=recursive_depth
+        )
+        status_msg += " Previous bytes: [{p}]. Byte not successfully interpreted.".format(p=self.previous(chunk, i))
+        error_msg = ''
+        if context == START_TAG_NAME:
+          error_msg = 'Tag names can only contain characters in the element_name_characters list: [{}]'.format(element_name_characters)
+          error_msg = '\n\nERROR: ' + error_msg + '\n'
+        raise Exception(status_msg + error_msg)
+
+      context, action = transition
+
+      if action == ADD_TO_NAME:
+        name_chars.append(byte)
+
+      elif action == ADD_TO_END_NAME:
+        end_name_chars.append(byte)
+
+      elif action == CLOSE_START_TAG:
+        name = intern_name(''.join(name_chars), self.symbols)
+        events.append(('start', name, start_position))
+
+      elif action == START_ENTRY:
+        if character_class == NEWLINE:
+          # We added 1 above.
+          line_number -= 1
+        # The Entry starts at this byte, so we process it again in the DATA context.
+        entry_position = (data_index, line_number, line_index)
+        context = DATA
+        continue
+
+      elif action == START_CHILD:
+        if max_depth is not None and recursive_depth + 1 > max_depth:
+          raise ValueError(Element.max_depth_error_msg(
+            data_index - 1, line_number, line_index - 1, recursive_depth + 1, max_depth
+          ))
+        stack.append((name, byte))
+        start_position = (data_index - 1, line_number, line_index - 1)
+        recursive_depth += 1
+        name_chars = [byte]
+        end_name_chars = []
+        context = START_TAG_NAME
+
+      elif action == CLOSE_ELEMENT:
+        end_name = ''.join(end_name_chars)
+        if name != end_name:
+          status_msg = element_status_msg.format(
+            c=context_names[context], b=repr(byte), di=data_index,
+            ln=line_number, li=line_index, r=recursive_depth
+          )
+          status_msg += " Finished building Element, but end_tagName ({e}) is not the same as start_tagName ({s}).".format(e=end_name, s=name)
+          raise Exception(status_msg)
+        events.append(('end', name, (data_index, line_number, line_index)))
+        if not stack:
+          # This is the root Element of the data.
+          # If there is any data left over (apart from final newlines), this is an error.
+          self.complete = True
+          self.check_remaining_data(chunk[i+1:])
+          break
+        else:
+          # Switch back to the parent Element.
+          name, byte = stack.pop()
+          recursive_depth -= 1
+          end_name_chars = []
+          context = INSIDE_ELEMENT
+
+      i += 1
+      data_index += 1
+      line_index += 1
+
+    # Store the parser state.
+    self.data_index = data_index
+    self.line_number = line_number
+    self.line_index = line_index
+    self.context = context
+    self.name = name
+    self.name_chars = name_chars
+    self.end_name_chars = end_name_chars
+    self.byte = byte
+    self.recursive_depth = recursive_depth
+    self.start_position = start_position
+    self.entry_pieces = entry_pieces
+    self.entry_position = entry_position
+    return events
+
+
+  def build(self, events):
+    # Add the items described by the events to the Element tree.
+    elements = self.elements
+    for event, value, position in events:
+      if event == 'start':
+        e = Element()
+        e.name = value
+        e.data_index, e.line_number, e.line_index = position
+        e.recursive_depth = len(elements)
+        if elements:
+          e.parent = elements[-1]
+          e.parent.children.append(e)
+        else:
+          self.root = e
+        elements.append(e)
+      elif event == 'entry':
+        entry = Entry()
+        entry.parent = elements[-1]
+        entry.data = value
+        entry.data_index, entry.line_number, entry.line_index = position
+        entry.recursive_depth = len(elements)
+        entry.parent.children.append(entry)
+      else:
+        e = elements.pop()
+        e.final_data_index, e.final_line_number, e.final_line_index = position
+        e.complete = True
+
+
+  def read_events(self):
+    # Return the events that have been produced since the last call, and forget them.
+    events = self.pending_events
+    self.pending_events = []
+    return events
+
+
+  def close(self):
+    # Signal the end of the data. If build_tree is True, return the root Element.
+    # If the root Element is not complete, this is an error.
+    if not self.complete:
+      context = self.context
+      if context == DATA or context == ESCAPED:
+        byte = self.last_byte if context == DATA else '\\'
+        status_msg = entry_status_msg.format(
+          c=context_names[context], b=repr(byte), di=self.data_index,
+          ln=self.line_number, li=self.line_index, r=self.recursive_depth + 1
+        )
+      else:
+        status_msg = element_status_msg.format(
+          c=context_names[context], b=repr(self.byte), di=self.data_index,
+          ln=self.line_number, li=self.line_index, r=self.recursive_depth
+        )
+      status_msg += " No more data left, but Element is not complete."
+      raise Exception(status_msg)
+    self.closed = True
+    if self.build_tree:
+      deb("Element parsed. Name = '{name}'. Number of children = {c}.".format(name=self.root.name, c=self.root.nc))
+      return self.root
+
+
+  def previous(self, chunk, i):
+    # Return the (up to) 50 bytes before byte i of the chunk.
+    return (self.previous_bytes + chunk[:i])[-50:]
+
+
+  def check_remaining_data(self, remaining_data):
+    # Newlines after the end of the root Element are allowed, as in Element.from_file (e.g. a file written by write_to_file ends with a newline). Any other remaining data is an error.
+    if remaining_data.strip('\n'):
+      self.remaining_data_error(remaining_data)
+
+
+  def remaining_data_error(self, remaining_data):
+    _msg = "Finished building root element, but there is remaining data: {}".format(repr(remaining_data))
+    raise ValueError(_msg)
@@ -2,6 +2,7 @@
 import pytest
 import pkgutil
 import json
+import io
 
 
 
@@ -15,7 +16,10 @@ from .. import util
 
 # Shortcuts
 Element = code.Element.Element
+NameIndex = code.Element.NameIndex
 Entry = code.Element.Entry
+Path = code.Element.Path
+compile_path = code.Element.compile_path
 
 
 
@@ -153,6 +157,203 @@ def test_tx1_3(e5):
   assert e5.end_tag == '</transaction>'
 
 
+def test_slots(e5):
+  # Elements and Entries don't have a per-instance __dict__.
+  for item in [e5, e5.children[0], e5.element_children[0].children[0]]:
+    assert not hasattr(item, '__dict__')
+  with pytest.raises(AttributeError):
+    e5.foo = 'bar'
+
+
+
+
+
+
+
+# ### SECTION
+# Parser engine checks
+
+
+def tree_summary(e):
+  # Collect the attributes of every node in the tree, in document order.
+  if e.is_entry:
+    return [('Entry', e.data, e.data_index, e.line_number, e.line_index)]
+  summary = [(
+    'Element', e.name, e.end_name, e.complete,
+    e.data_index, e.line_number, e.line_index,
+    e.final_data_index, e.final_line_number, e.final_line_index,
+    e.recursive_depth,
+  )]
+  for child in e.children:
+    summary.extend(tree_summary(child))
+  return summary
+
+
+def parse_error(data, engine):
+  with pytest.raises(Exception) as exc_info:
+    Element.from_string(data=data, engine=engine)
+  return type(exc_info.value), str(exc_info.value)
+
+
+@pytest.mark.parametrize('d_file', ['hello.txt', 'test1.txt', 'transaction1.txt'])
+def test_table_engine(d_file):
+  d = pkgutil.get_data(__name__, '../data/' + d_file).decode('ascii').strip()
+  e = Element.from_string(data=d)
+  e2 = Element.from_string(data=d, engine='table')
+  assert tree_summary(e2) == tree_summary(e)
+  assert e2.data == e.data == d
+
+
+def test_table_engine_2():
+  d = "<a>\\\\foo \\<b\\> /bar\n<b>\n</b>\n<c></c>x</a>"
+  e = Element.from_string(data=d)
+  e2 = Element.from_string(data=d, engine='table')
+  assert tree_summary(e2) == tree_summary(e)
+  assert e2.get_value('b') == ' '
+
+
+@pytest.mark.parametrize('d', [
+  "<a>hello",
+  "<a>hello</b>",
+  "<a><b>hello</a>",
+  "<A>hello</A>",
+  "<a b>hello</a>",
+  "<a>hel>lo</a>",
+  "<a>hel\\lo</a>",
+  "<a>hel\rlo</a>",
+  "<a><b></b>/</a>",
+  "<a>\n<b>x</b>\n</a> ",
+  "<>hello</>",
+])
+def test_table_engine_errors(d):
+  assert parse_error(d, 'table') == parse_error(d, 'recursive')
+
+
+def test_entry_runs():
+  # A long entry with newlines and escaped characters. With verbose=True, the per-byte loop in Entry.process_string is used.
+  line = "abc def\\<\\>\\\\ ghi\n"
+  d = "<a>\n" + line * 1000 + "<b>x</b>" + line + "</a>"
+  e = Element.from_string(data=d)
+  e2 = Element.from_string(data=d, verbose=True)
+  e3 = Element.from_string(data=d, engine='table')
+  assert tree_summary(e) == tree_summary(e2) == tree_summary(e3)
+  assert e.children[0].data == "\n" + "abc def<>\\ ghi\n" * 1000
+  assert e.data == d
+
+
+@pytest.mark.parametrize('d', [
+  "<a>abc\\",
+  "<a>abc\\\n</a>",
+  "<a>abc\\q</a>",
+  "<a>ab\nc\\<\n",
+  "<a>ab\nc\\>\tx>y</a>",
+])
+def test_entry_runs_errors(d):
+  with pytest.raises(Exception) as exc_info:
+    Element.from_string(data=d, verbose=True)
+  assert parse_error(d, 'recursive') == (type(exc_info.value), str(exc_info.value))
+
+
+def test_table_engine_deep():
+  n = 5000
+  d = '<a>' * n + 'x' + '</a>' * n
+  e = Element.from_string(data=d, engine='table')
+  depth = 0
+  while e.nc == 1 and e.children[0].is_element:
+    e = e.children[0]
+    depth += 1
+  assert depth == n - 1
+  assert e.recursive_depth == n - 1
+  assert e.value == 'x'
+
+
+@pytest.mark.parametrize('engine', ['recursive', 'table'])
+def test_max_depth(engine):
+  d = '<a><b><c>x</c></b><d></d></a>'
+  e = Element.from_string(data=d, engine=engine, max_depth=2)
+  assert e.get_value('b/c') == 'x'
+  with pytest.raises(ValueError) as exc_info:
+    Element.from_string(data=d, engine=engine, max_depth=1)
+  assert 'data_index [6]' in str(exc_info.value)
+  assert 'exceeds max_depth [1]' in str(exc_info.value)
+
+
+@pytest.mark.parametrize('engine', ['recursive', 'table'])
+def test_validate_once(engine, monkeypatch):
+  # The arguments are validated once for the whole data, not once per child.
+  calls = []
+  validate_string = util.validate.validate_string
+
+  def counting_validate_string(*args, **kwargs):
+    calls.append(args)
+    validate_string(*args, **kwargs)
+  monkeypatch.setattr(util.validate, 'validate_string', counting_validate_string)
+  d = pkgutil.get_data(__name__, '../data/test1.txt').decode('ascii').strip()
+  e = Element.from_string(data=d, engine=engine)
+  assert len(e.element_descendants) > 10
+  assert len(calls) == 1
+
+
+@pytest.mark.parametrize('engine', ['recursive', 'table'])
+def test_interned_names(engine):
+  d = pkgutil.get_data(__name__, '../data/test1.txt').decode('ascii').strip()
+  e = Element.from_string(data=d, engine=engine)
+  planets = e.get('sublist/planet')
+  assert len(planets) == 4
+  # Elements with the same name share a single string object.
+  assert len(set(id(x.name) for x in planets)) == 1
+  assert planets[0].get_one('name').name is planets[1].get_one('name').name
+  assert planets[0].end_name is planets[0].name
+  assert planets[0].end_tag == '</planet>'
+  # Names that were not produced by the parser are still found.
+  child = Element()
+  child.name = ''.join(['pla', 'net'])
+  e.get_one('sublist').add(child)
+  assert len(e.get('sublist/planet')) == 5
+
+
+def test_unknown_engine():
+  with pytest.raises(ValueError):
+    Element.from_string(data="<a>b</a>", engine='foo')
+
+
+@pytest.mark.parametrize('d_file', ['hello.txt', 'test1.txt', 'transaction1.txt'])
+def test_from_file_mmap(d_file, tmp_path):
+  d = pkgutil.get_data(__name__, '../data/' + d_file)
+  file = tmp_path / d_file
+  file.write_bytes(d + b'\n\n')
+  e = Element.from_file(str(file))
+  e2 = Element.from_file(str(file), use_mmap=True)
+  assert tree_summary(e2) == tree_summary(e)
+  assert e2.data == e.data
+
+
+@pytest.mark.parametrize('d', [
+  "<a>hello",
+  "<a>hello</b>\n",
+  "<a>hel>lo</a>",
+  "<a>hel\\lo</a>",
+  "<a>hello</a> \n\n",
+])
+def test_from_file_mmap_errors(d, tmp_path):
+  file = tmp_path / 'data.txt'
+  file.write_bytes(d.encode('ascii'))
+  errors = []
+  for use_mmap in [False, True]:
+    with pytest.raises(Exception) as exc_info:
+      Element.from_file(str(file), use_mmap=use_mmap)
+    errors.append((type(exc_info.value), str(exc_info.value)))
+  assert errors[0] == errors[1]
+
+
+def test_from_file_mmap_empty(tmp_path):
+  file = tmp_path / 'data.txt'
+  file.write_bytes(b'\n\n')
+  with pytest.raises(ValueError):
+    Element.from_file(str(file), use_mmap=True)
+
+
+
 
 
 
@@ -218,6 +419,126 @@ def test_delete_2(e3):
   assert e_values == ['Apple']
 
 
+def test_children_by_name(e3):
+  # The index of children by name must stay correct as the children change.
+  def check():
+    expected = [c for c in e3.children if c.is_element]
+    assert e3.element_children == expected
+    for name in ['title', 'item', 'new']:
+      assert e3.get_element_children_with_name(name) == [c for c in expected if c.name == name]
+  assert e3.children_by_name is None
+  assert not e3.has_child('new')
+  assert e3.children_by_name is not None
+  check()
+  new = Element.from_string(data='<new>x</new>')
+  e3.add(new)
+  assert e3.children_by_name is not None
+  assert e3.has_child('new')
+  check()
+  e3.insert_child(Element.from_string(data='<item>Cake</item>'), index=0)
+  check()
+  e3.detach(new)
+  check()
+  e3.replace('title', new)
+  check()
+  assert e3.pop_child('new') is new
+  check()
+  # The returned lists are copies.
+  e3.element_children.append(new)
+  e3.get_element_children_with_name('item').append(new)
+  check()
+
+
+def test_value_index(e1):
+  e = Element.from_string(data=e1.data)
+  xpath = "//language[@category='Python'][@version='3']"
+  expected = [x.data for x in e1.get(xpath)]
+  e.index_values('//language', 'category')
+  assert e.value_index == {(True, 'language', 'category'): None}
+  assert [x.data for x in e.get(xpath)] == expected
+  assert e.value_index[(True, 'language', 'category')] is not None
+  sublist = e.get_one('sublist')
+  sublist.index_values('planet', 'name')
+  venus = e.get_one("sublist/planet[@name='Venus']")
+  assert venus.text == '2'
+  # Changing a leaf value clears the index.
+  venus.get_one('name').set_value('Pluto')
+  assert sublist.value_index[(False, 'planet', 'name')] is None
+  assert e.get("sublist/planet[@name='Venus']") == []
+  assert e.get("sublist/planet[@name='Pluto']") == [venus]
+  venus.get_one('name').children[0].data = 'Venus'
+  assert e.get("sublist/planet[@name='Venus']") == [venus]
+  new = Element.from_string(data='<planet>5<name>Venus</name></planet>')
+  sublist.add(new)
+  assert e.get("sublist/planet[@name='Venus']") == [venus, new]
+  with pytest.raises(ValueError):
+    e.index_values('b$d', 'name')
+
+
+def test_value_index_2(e3):
+  e3.index_values('item')
+  orange = e3.get_one_by_value('item', 'Orange')
+  assert orange.value == 'Orange'
+  orange.set_value('Lemon')
+  assert e3.get_one_by_value('item', 'Lemon') is orange
+  with pytest.raises(KeyError):
+    e3.get_one_by_value('item', 'Orange')
+  with pytest.raises(ValueError):
+    e3.get_one_by_value('foo', 'Orange')
+
+
+def test_get_index():
+  n = 1000
+  d = '<a>' + '<b>x</b>\n' * n + '</a>'
+  e = Element.from_string(data=d)
+  # Walk along the siblings.
+  item = e.children[0]
+  items = [item]
+  while True:
+    try:
+      item = item.next_sibling
+    except KeyError:
+      break
+    items.append(item)
+  assert items == e.children
+  assert [x.get_index() for x in e.children] == list(range(2 * n))
+  # Positions stay correct after the children change.
+  b = e.children[10]
+  e.detach(e.children[3])
+  assert b.get_index() == 9
+  e.insert_child(Element.from_string(data='<c>y</c>'), index=0)
+  e.insert_child('z', index=5)
+  assert b.get_index() == 11
+  assert [x.get_index() for x in e.children] == list(range(2 * n + 1))
+  assert b.prev_sibling.next_sibling is b
+  with pytest.raises(AttributeError):
+    e.get_index()
+
+
+def test_path_from_root():
+  d = '<r><a><b><c>x</c></b></a><d>y</d></r>'
+  e = Element.from_string(data=d)
+  c = e.get_one('a/b/c')
+  assert c.path_from_root == 'a/b/c'
+  assert c.recursive_depth == 3
+  assert c.children[0].recursive_depth == 4
+  assert e.path_from_root == ''
+  # Move a subtree to a different depth. The depths and paths below it are updated.
+  b = e.get_one('a/b')
+  e.get_one('a').detach(b)
+  assert (b.path_from_root, b.recursive_depth) == ('', 0)
+  assert (c.path_from_root, c.recursive_depth) == ('c', 1)
+  e.get_one('d').add(b)
+  assert (c.path_from_root, c.recursive_depth) == ('d/b/c', 3)
+  assert c.children[0].recursive_depth == 4
+  assert e.get(c.path_from_root) == [c]
+  # Elements built from a dict.
+  e2 = Element.from_dict({'r': {'a': {'b': 'x'}}})
+  b2 = e2.get_one('a/b')
+  assert (b2.path_from_root, b2.recursive_depth) == ('a/b', 2)
+  assert b2.children[0].recursive_depth == 3
+
+
 def test_prev_sibling(e3):
   apple_item = e3.get_one_by_value('item', 'Apple')
   entry = apple_item.prev_sibling
@@ -313,6 +634,209 @@ def test_xpath_9(e1):
   assert sorted(versions) == ['2']
 
 
+def test_descendants_order():
+  # Descendants are returned in document order.
+  d = '<r><a><b>1</b></a><b>2</b><a><a><b>3</b></a></a></r>'
+  e = Element.from_string(data=d)
+  assert [x.value for x in e.get('//b')] == ['1', '2', '3']
+  assert [x.get_value('b') for x in e.get('//a') if x.has_child('b')] == ['1', '3']
+
+
+@pytest.mark.parametrize('engine', ['recursive', 'table'])
+def test_name_index(e1, engine):
+  e = Element.from_string(data=e1.data, engine=engine, index_names=True)
+  assert e.name_index is not None
+  # Compare with a tree without an index.
+  pairs = [(e, e1), (e.get_one('sublist'), e1.get_one('sublist'))]
+  for x, y in pairs:
+    for name in ['name', 'title', 'planet', 'foo']:
+      assert [z.data for z in x.get('//' + name)] == [z.data for z in y.get('//' + name)]
+  assert Element.from_string(data=e1.data).name_index is None
+
+
+def test_name_index_edits(e1, monkeypatch):
+  e = Element.from_string(data=e1.data)
+  index = e.build_name_index()
+  with pytest.raises(ValueError):
+    e.get_one('sublist').build_name_index()
+
+  def check():
+    # The index must give the same results as a scan of the tree.
+    for x in [e] + e.element_descendants:
+      for name in ['name', 'title', 'planet', 'new']:
+        items = x.get_element_descendants_with_name(name)
+        e.name_index = None
+        expected = x.get_element_descendants_with_name(name)
+        e.name_index = index
+        assert items == expected
+
+  sublist = e.get_one('sublist')
+  sublist.add(Element.from_string(data='<new><name>Pluto</name></new>'), index=2)
+  check()
+  assert [x.value for x in e.get('//name')] == 'Pluto Mercury Venus Earth Mars'.split()
+  planet = sublist.get_one('planet[0]')
+  sublist.detach(planet)
+  check()
+  sublist.replace('new', planet)
+  check()
+  e.insert_child(sublist.pop_child('title'), index=0)
+  check()
+  assert not index.stale
+  # Insert many Elements at the same place. When there is no room left between the numbers of the neighbouring Elements, part of the index is numbered again.
+  for i in range(20):
+    sublist.add(Element.from_string(data='<new>{}</new>'.format(i)), index=0)
+  assert not index.stale
+  check()
+  assert [x.value for x in e.get('//new')] == [str(i) for i in reversed(range(20))]
+  # If that isn't possible, the index is marked as stale, and rebuilt by the next query.
+  monkeypatch.setattr(NameIndex, 'min_gap', 10 ** 9)
+  for i in range(20):
+    sublist.add(Element.from_string(data='<new>x</new>'), index=0)
+  assert index.stale
+  check()
+  assert not index.stale
+
+
+def test_name_index_appends(monkeypatch):
+  # Appending subtrees, at the end of the document or at the end of an Element in the middle of it, doesn't make the index stale.
+  builds = []
+  build = NameIndex.build
+
+  def counting_build(index):
+    builds.append(index)
+    build(index)
+
+  monkeypatch.setattr(NameIndex, 'build', counting_build)
+  d = '<r>' + '<a><b>x</b></a>' * 10 + '</r>'
+  e = Element.from_string(data=d, index_names=True)
+  middle = e.get_one('a[5]')
+  subtree = '<c><name>{}</name><d><name>y</name></d></c>'
+  for i in range(200):
+    e.add(Element.from_string(data=subtree.format(i)))
+    middle.add(Element.from_string(data=subtree.format(i)))
+    assert len(e.get('//name')) == 4 * (i + 1)
+  assert builds == []
+  assert not e.name_index.stale
+  for x in [e, middle, e.get_one('c[7]')]:
+    for name in ['name', 'c', 'b']:
+      items = x.get('//' + name)
+      index, e.name_index = e.name_index, None
+      assert items == x.get('//' + name)
+      e.name_index = index
+
+
+def test_iter_descendants(e1):
+  items = list(e1.iter_descendants())
+  assert [x.name for x in items if x.is_element] == [x.name for x in e1.iter_elements()]
+  assert [x.data for x in items if x.is_entry] == [x.data for x in e1.iter_entries()]
+  assert sorted(id(x) for x in e1.iter_elements()) == sorted(id(x) for x in e1.element_descendants)
+  # Document order.
+  assert [x.value for x in e1.iter_elements('name')] == 'Mercury Venus Earth Mars'.split()
+  # The caller can stop early.
+  first = next(e1.iter_elements('planet'))
+  assert first.text == '1'
+  # Pruned Elements are produced, but not their descendants.
+  names = [x.name for x in e1.iter_elements(prune=lambda x: x.name == 'sublist')]
+  assert 'sublist' in names
+  assert 'planet' not in names
+  entries = list(e1.get_one('sublist').iter_entries(prune=lambda x: x.name == 'planet'))
+  assert [x.data for x in entries] == ['\n', 'Planets', '\n', '\n', '\n', '\n', '\n']
+
+
+def test_iter_descendants_deep():
+  n = 5000
+  d = '<a>' * n + 'x' + '</a>' * n
+  e = Element.from_string(data=d, engine='table')
+  assert sum(1 for x in e.iter_elements(name='a')) == n - 1
+  assert [x.data for x in e.iter_entries()] == ['x']
+  assert len(e.element_descendants) == n - 1
+  assert len(e.tree_lines()) == n + 1
+
+
+@pytest.mark.parametrize('xpath', [
+  '',
+  'item',
+  'sublist/planet/name',
+  '//name',
+  '//name[1]',
+  'sublist//name',
+  "//language[@category='Python'][@version='3']/category",
+  'foo',
+])
+def test_query(e1, xpath):
+  # A lazy Query produces the same results as get.
+  expected = e1.get(xpath)
+  q = e1.query(xpath)
+  assert list(q) == expected
+  assert q.count() == len(expected)
+  assert q.limit(2) == expected[:2]
+  assert q.first() == (expected[0] if expected else None)
+  assert q.exists() == bool(expected)
+  assert e1.get_first(xpath) == q.first()
+  assert e1.exists(xpath) == q.exists()
+
+
+def test_query_lazy():
+  # The search stops at the first match, so an error later in the tree isn't reached.
+  d = '<r><a><b>x</b></a><a><b>y</b><b>z</b></a></r>'
+  e = Element.from_string(data=d)
+  xpath = "//a[@b='x']"
+  assert e.get_first(xpath).get_value('b') == 'x'
+  assert e.exists(xpath)
+  with pytest.raises(ValueError):
+    e.get(xpath)
+  with pytest.raises(ValueError):
+    e.query(xpath).count()
+
+
+def test_get_many(e1):
+  xpaths = [
+    '', 'title', 'item', 'sublist/title', 'sublist/planet/name', 'sublist/planet[2]/name',
+    '//name', '//title', "languages/language[@version='3']/category", 'foo', 'foo/bar',
+  ]
+  results = e1.get_many(xpaths)
+  assert results == {x: e1.get(x) for x in xpaths}
+  # Keys can be field names.
+  fields = {'title': 'title', 'planet': 'sublist/planet[2]/name', 'missing': 'sublist/foo'}
+  values = e1.get_value_many(fields, if_exists=True)
+  assert values == {'title': 'Fruit', 'planet': 'Earth', 'missing': None}
+  with pytest.raises(ValueError):
+    e1.get_value_many(fields)
+  with pytest.raises(ValueError):
+    e1.get_value_many(['item'])
+  # A compiled PathSet can be reused.
+  path_set = code.Element.PathSet(fields)
+  assert e1.get_value_many(path_set, if_exists=True) == values
+  # The shared descendant walk also works with a NameIndex.
+  e = Element.from_string(data=e1.data, index_names=True)
+  assert {k: [x.data for x in v] for k, v in e.get_many(xpaths).items()} == {x: [y.data for y in e1.get(x)] for x in xpaths}
+
+
+def test_compile_path(e1):
+  xpath = "languages/language[@category='Python'][@version='2']/version"
+  p = compile_path(xpath)
+  assert p.steps[1] == ('language', False, None, (('category', 'Python'), ('version', '2')))
+  # Compiled paths are cached, and a Path can be used instead of an xpath string.
+  assert compile_path(xpath) is p
+  assert compile_path(p) is p
+  assert e1.get(p) == e1.get(xpath)
+  assert e1.get_value(p) == '2'
+  assert [e.value for e in e1.get(compile_path('sublist/planet[1]/name'))] == ['Venus']
+  assert e1.get(compile_path('')) == [e1]
+
+
+def test_compile_path_errors(e1):
+  # Errors are raised when the xpath is compiled, even if no Element would reach the invalid step.
+  with pytest.raises(ValueError):
+    compile_path('foo/b$r')
+  with pytest.raises(ValueError):
+    e1.get('foo/b$r')
+  with pytest.raises(Exception):
+    compile_path('item[x]')
+  with pytest.raises(TypeError):
+    compile_path(1)
+
+
 
 
 
@@ -338,6 +862,174 @@ def test_value2(e2):
   assert e2.get_one(xpath).value == 'ASD'
 
 
+def test_data(e1):
+  d = pkgutil.get_data(__name__, '../data/test1.txt').decode('ascii').strip()
+  assert e1.data == e1.escaped_data == d
+  sublist = e1.get_one('sublist')
+  assert sublist.content == sublist.data[len('<sublist>'):-len('</sublist>')]
+  assert Element.from_string(data='<a></a>').content == ''
+
+
+def test_data_deep():
+  n = 5000
+  d = '<a>' * n + 'x\\<' + '</a>' * n
+  e = Element.from_string(data=d, engine='table')
+  assert e.data == d
+
+
+def test_escape():
+  s = 'plain text\n'
+  assert Entry.escape(s) is s
+  s = 'a<b>c\\d\\<'
+  escaped = Entry.escape(s)
+  assert escaped == 'a\\<b\\>c\\\\d\\\\\\<'
+  e = Element.from_string(data='<a>' + escaped + '</a>')
+  assert e.children[0].data == s
+  assert e.children[0].escaped_data == escaped
+  # The copy has the same (unescaped) data.
+  assert e.children[0].create_copy().data == s
+
+
+def test_create_copy(e1):
+  e = Element.from_string(data=e1.data)
+  sublist = e.get_one('sublist')
+  sublist.data
+  # Entries next to each other are copied as they are.
+  sublist.get_one('planet[0]').insert_child('a\\<b', index=0)
+  copy = sublist.create_copy()
+  assert copy.data == sublist.data
+  assert copy.parent is None
+  assert [x.nc for x in copy.iter_descendants() if x.is_element] == [x.nc for x in sublist.iter_descendants() if x.is_element]
+  planet = copy.get_one('planet[1]')
+  assert planet.parent is copy
+  assert planet.get_index() == sublist.get_one('planet[1]').get_index()
+  assert (planet.recursive_depth, planet.path_from_root) == (1, 'planet')
+  # Changing the copy doesn't change the original.
+  before = sublist.data
+  planet.get_one('name').set_value('Vulcan')
+  assert sublist.data == before
+  assert copy.data == Element.from_string(data=copy.data).data
+  assert 'Vulcan' in copy.data
+  # A deep tree.
+  n = 5000
+  e = Element.from_string(data='<a>' * n + 'x' + '</a>' * n, engine='table')
+  assert e.create_copy().data == e.data
+
+
+def test_write_data(e1, tmp_path):
+  # Use a new Element, which has no cached data yet.
+  e = Element.from_string(data=e1.data)
+  chunks = []
+  e.write_data(chunks, chunk_size=50)
+  assert len(chunks) > 1
+  assert ''.join(chunks) == e1.data
+  assert e.cached_data is None
+  file = tmp_path / 'data.txt'
+  e1.write_to_new_file(str(file))
+  assert file.read_text() == e1.data + '\n'
+  with pytest.raises(OSError):
+    e1.write_to_new_file(str(file))
+  assert Element.from_file(str(file)).data == e1.data
+
+
+
+def test_cached_data(e1, monkeypatch):
+  monkeypatch.setattr(Element, 'cache_threshold', 100)
+  e = Element.from_string(data=e1.data)
+  d = e.data
+  sublist = e.get_one('sublist')
+  languages = e.get_one('languages')
+  planet = sublist.get_one('planet[1]')
+  title = e.get_one('title')
+  # Only the Element and the Elements below it with at least cache_threshold characters of data are cached.
+  assert sublist.cached_data is not None
+  assert planet.cached_data is None
+  assert len(sublist.content) >= 100 > len(planet.content)
+  assert e.data is d
+  # A change clears only the caches on the path to the root.
+  planet.get_one('name').set_value('Pluto')
+  assert sublist.cached_data is None
+  assert e.cached_data is None
+  assert languages.cached_data is not None
+  assert e.data == d.replace('Venus', 'Pluto')
+  # Setting the data of an Entry also clears the caches.
+  title.children[0].data = 'Food'
+  assert e.data == d.replace('Venus', 'Pluto').replace('Fruit', 'Food')
+  assert e.content == e.data[len('<list>'):-len('</list>')]
+
+
+def test_cached_data_deep():
+  # The cached data stays close to the size of the data, however deep the tree is.
+  n = 4000
+  d = '<a>' * n + 'x' + '</a>' * n
+  e = Element.from_string(data=d, engine='table')
+
+  def cache_size():
+    return sum(len(x.cached_data) for x in [e] + list(e.iter_elements()) if x.cached_data is not None)
+
+  assert e.data == d
+  assert cache_size() <= 3 * len(d)
+  leaf = e.get_one('/'.join(['a'] * (n - 1)))
+  leaf.set_value('y')
+  assert e.data == d.replace('x', 'y')
+  assert cache_size() <= 3 * len(d)
+  # Getting the data of an Element further down adds at most three times the size of its own data.
+  middle = e.get_one('/'.join(['a'] * (n // 2)))
+  assert middle.data == Element.from_string(data=middle.data, engine='table').data
+  assert cache_size() <= 3 * len(d) + 3 * len(middle.data)
+
+
+def test_cached_data_wrapped(monkeypatch):
+  # A single wrapper Element holds all the articles. After an edit in one article, only that article is walked again: the other articles keep their cached data, and none of their Entries is escaped again.
+  article = '<article><title>T{}</title><body>' + 'x' * 300 + '</body></article>'
+  d = '<doc><archive>' + ''.join(article.format(i) for i in range(200)) + '</archive></doc>'
+  e = Element.from_string(data=d, engine='table')
+  assert e.data == d
+  articles = e.get_one('archive').element_children
+  caches = [x.cached_data for x in articles]
+  assert all(caches)
+  calls = []
+  escape = Entry.escape
+  monkeypatch.setattr(Entry, 'escape', staticmethod(lambda x: calls.append(x) or escape(x)))
+  articles[100].get_one('title').set_value('New')
+  assert e.data == d.replace('T100', 'New')
+  assert calls == ['New', 'x' * 300]
+  assert all(x.cached_data is y for x, y in zip(articles, caches) if x is not articles[100])
+
+
+def test_cached_data_mutations(e1):
+  e = Element.from_string(data=e1.data)
+  new = Element.from_string(data='<new>x</new>')
+
+  def check():
+    # The cached data and JSON must match those of a new Element built from the same data.
+    d = e.data
+    f = Element.from_string(data=d)
+    assert f.data == d
+    assert e.to_json() == f.to_json()
+    return d
+
+  check()
+  sublist = e.get_one('sublist')
+  sublist.add(new)
+  assert new.parent is sublist
+  assert '<new>x</new></sublist>' in check()
+  sublist.add_all([Element.from_string(data='<n2>y</n2>')], index=0)
+  assert check().count('<n2>y</n2>') == 1
+  sublist.insert_child('z')
+  assert '<new>x</new>z</sublist>' in check()
+  sublist.detach(new)
+  assert new.parent is None
+  assert '<new>' not in check()
+  sublist.replace('n2', new)
+  assert '<n2>' not in check()
+  assert sublist.pop_child('new') is new
+  assert '<new>' not in check()
+  e.get_one('title').set_value('Food')
+  assert '<title>Food</title>' in check()
+  assert e.to_json() == Element.from_string(data=e.data).to_json()
+
+
 
 
 # ### SECTION
@@ -403,6 +1095,40 @@ def test_to_dict_3():
   assert d_json == expected_json
 
 
+def test_to_dict_4():
+  # Repeated children that aren't leaves, and many children.
+  n = 1000
+  s = '<a><b><c>1</c><c>2</c></b><b><d>3</d></b><e>4</e>' + '<f>x</f>' * n + '</a>'
+  e = Element.from_string(data=s)
+  d = e.to_dict()
+  assert d['a']['b'] == [{'c': ['1', '2']}, {'d': '3'}]
+  assert d['a']['e'] == '4'
+  assert d['a']['f'] == ['x'] * n
+  # A deep tree.
+  n = 5000
+  e = Element.from_string(data='<a>' * n + 'x' + '</a>' * n, engine='table')
+  d = e.to_dict()
+  for i in range(n - 1):
+    d = d['a']
+  assert d == {'a': 'x'}
+
+
+@pytest.mark.parametrize('chunk_size', [None, 1, 65536])
+def test_write_json(e1, chunk_size):
+  e = Element.from_string(data=e1.data)
+  chunks = []
+  e.write_json(chunks, chunk_size=chunk_size)
+  assert ''.join(chunks) == json.dumps(e.to_dict(), sort_keys=True)
+  assert e.cached_json is None
+  out = io.StringIO()
+  e.write_json(out)
+  assert out.getvalue() == e.to_json()
+  # A leaf Element, and Entry data that needs escaping.
+  chunks = []
+  Element.from_dict({'x': 'a"b\\c'}).write_json(chunks)
+  assert ''.join(chunks) == '{"x": "a\\"b\\\\c"}'
+
+
 def test_from_dict():
   d = {'hello': 'world'}
   e = Element.from_dict(d)
@@ -437,6 +1163,32 @@ def test_from_dict_2():
   assert e.to_json() == expected.to_json()
 
 
+def test_from_dict_3():
+  d = {'a': {'c': 'x', 'b': ['1', {'d': 'y'}]}}
+  e = Element.from_dict(d)
+  assert e.data == '<a>\n<b>1</b>\n<b>\n<d>y</d>\n</b>\n<c>x</c>\n</a>'
+  assert all(x.parent is e for x in e.children)
+  assert e.get_one('b[1]/d').recursive_depth == 2
+  # Keep the order of the dict.
+  e = Element.from_dict(d, sort_keys=False)
+  assert e.data == '<a>\n<c>x</c>\n<b>1</b>\n<b>\n<d>y</d>\n</b>\n</a>'
+  assert Element.from_json(json.dumps(d), sort_keys=False).data == e.data
+  # Invalid values.
+  with pytest.raises(ValueError):
+    Element.from_dict({'a': {'b': 'x', 'c': 'y\x00'}})
+  with pytest.raises(TypeError):
+    Element.from_dict({'a': {'b': 1}})
+  with pytest.raises(KeyError):
+    Element.from_dict({'a': 'x', 'b': 'y'})
+  # A deep dict.
+  n = 5000
+  d = 'x'
+  for i in range(n):
+    d = {'a': d}
+  e = Element.from_dict(d)
+  assert e.get_one('/'.join(['a'] * (n - 1))).value == 'x'
+
+
 def test_from_json(e1):
   j = e1.to_json()
   y = Element.from_json(j)
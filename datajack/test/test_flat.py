@@ -0,0 +1,192 @@
+# Imports
+import pytest
+import pkgutil
+
+
+
+
+# Relative imports
+from .. import code
+
+
+
+
+# Shortcuts
+Element = code.Element.Element
+Document = code.flat.Document
+
+
+
+
+# Setup for this file.
+@pytest.fixture(autouse=True, scope='module')
+def setup_module(pytestconfig):
+  # If log_level is supplied to pytest in the commandline args, then use it to set up the logging in the application code.
+  log_level = pytestconfig.getoption('log_cli_level')
+  if log_level is not None:
+    log_level = log_level.lower()
+    code.setup(log_level = log_level)
+
+
+
+
+def load(d_file):
+  return pkgutil.get_data(__name__, '../data/' + d_file).decode('ascii').strip()
+
+
+
+
+@pytest.fixture(scope="module")
+def d1():
+  yield load('test1.txt')
+
+
+
+
+
+
+
+
+# ### SECTION
+# Conversion checks
+
+
+@pytest.mark.parametrize('d_file', ['hello.txt', 'test1.txt', 'transaction1.txt'])
+def test_from_string(d_file):
+  d = load(d_file)
+  e = Element.from_string(data=d)
+  doc = Document.from_string(d)
+  assert doc.root.data == e.data == d
+  assert doc.to_element().data == d
+  doc2 = Document.from_element(e)
+  assert list(doc2.kinds) == list(doc.kinds)
+  assert list(doc2.first_children) == list(doc.first_children)
+  assert list(doc2.next_siblings) == list(doc.next_siblings)
+  assert doc2.text == doc.text
+
+
+def test_to_element(d1):
+  doc = Document.from_string(d1)
+  e = doc.to_element()
+  assert e.parent is None
+  planet = e.get_one('sublist/planet[1]')
+  assert planet.parent.name == 'sublist'
+  assert planet.recursive_depth == 2
+  assert planet.children[0].data == '2'
+  # Convert a part of the Document.
+  e2 = doc.root.get_one('sublist').to_element()
+  assert e2.parent is None
+  assert e2.data == e.get_one('sublist').data
+
+
+def test_escapes():
+  d = "<a>x\\<y\\>z\\\\\n<b></b></a>"
+  doc = Document.from_string(d)
+  assert doc.text == "x<y>z\\\n"
+  assert doc.root.children[0].data == "x<y>z\\\n"
+  assert doc.root.data == d
+
+
+def test_deep():
+  n = 5000
+  d = '<a>' * n + 'x' + '</a>' * n
+  doc = Document.from_string(d)
+  assert len(doc) == n + 1
+  assert doc.root.data == d
+  e = doc.to_element()
+  assert Document.from_element(e).root.data == d
+
+
+def test_deep_element_descendants():
+  n = 3000
+  d = '<a>' * n + 'x' + '</a>' * n
+  e = Element.from_string(data=d, engine='table')
+  root = Document.from_element(e).root
+  descendants = root.element_descendants
+  assert len(descendants) == n - 1
+  assert [x.name for x in descendants] == [x.name for x in e.element_descendants]
+  assert descendants[-1].data == '<a>x</a>'
+
+
+
+
+
+
+
+
+# ### SECTION
+# Cursor checks
+
+
+def test_cursor(d1):
+  e = Element.from_string(data=d1)
+  r = Document.from_string(d1).root
+  assert r.name == 'list'
+  assert r.parent is None
+  assert r.nc == e.nc
+  assert r.element_children_names == e.element_children_names
+  assert [str(x) for x in r.children] == [str(x) for x in e.children]
+  assert r.children[1].parent == r
+  assert r.children[1] != r
+  title = r.get_one('title')
+  assert title.is_leaf
+  assert title.value == 'Fruit'
+  assert not r.is_leaf
+  with pytest.raises(ValueError):
+    r.value
+  assert r.branch_value == e.branch_value
+  assert r.get_one('sublist').content == e.get_one('sublist').content
+
+
+@pytest.mark.parametrize('xpath', [
+  'item',
+  'sublist/planet/name',
+  '//name',
+  '//title',
+  'sublist/planet[2]',
+  "languages/language[@version='3']/category",
+  "languages/language[@category='Python']",
+  'foo',
+])
+def test_cursor_get(d1, xpath):
+  e = Element.from_string(data=d1)
+  r = Document.from_string(d1).root
+  assert [x.data for x in r.get(xpath)] == [x.data for x in e.get(xpath)]
+
+
+def test_cursor_descendants():
+  # Descendants are returned in document order, as for an Element.
+  d = '<r><a><b>1</b></a><b>2</b><a><a><b>3</b></a></a></r>'
+  r = Document.from_string(d).root
+  assert [x.value for x in r.get('//b')] == ['1', '2', '3']
+  assert [x.value for x in r.get_one('a[1]').get('//b')] == ['3']
+
+
+def test_cursor_iter(d1):
+  e = Element.from_string(data=d1)
+  r = Document.from_string(d1).root
+  assert [x.data for x in r.iter_descendants()] == [x.data for x in e.iter_descendants()]
+  assert [x.value for x in r.iter_elements('name')] == [x.value for x in e.iter_elements('name')]
+  assert [x.data for x in r.iter_entries()] == [x.data for x in e.iter_entries()]
+
+
+def test_cursor_query(d1):
+  r = Document.from_string(d1).root
+  assert r.get_first('//name').value == 'Mercury'
+  assert r.exists('sublist/planet')
+  assert not r.exists('//foo')
+  assert r.query('//name').count() == 4
+
+
+def test_cursor_get_many(d1):
+  e = Element.from_string(data=d1)
+  r = Document.from_string(d1).root
+  xpaths = ['title', 'sublist/planet/name', '//name', '//title', 'foo']
+  results = r.get_many(xpaths)
+  assert {k: [x.data for x in v] for k, v in results.items()} == {x: [y.data for y in e.get(x)] for x in xpaths}
+
+
+def test_elements_with_name(d1):
+  doc = Document.from_string(d1)
+  assert [x.value for x in doc.elements_with_name('title')] == ['Fruit', 'Planets']
+  assert doc.elements_with_name('foo') == []
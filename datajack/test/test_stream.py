@@ -0,0 +1,265 @@
+# Imports
+import pytest
+import pkgutil
+import io
+
+
+
+
+# Relative imports
+from .. import code
+
+
+
+
+# Shortcuts
+Element = code.Element.Element
+iterparse = code.stream.iterparse
+iterparse_file = code.stream.iterparse_file
+FeedParser = code.stream.FeedParser
+
+
+
+
+# Setup for this file.
+@pytest.fixture(autouse=True, scope='module')
+def setup_module(pytestconfig):
+  # If log_level is supplied to pytest in the commandline args, then use it to set up the logging in the application code.
+  log_level = pytestconfig.getoption('log_cli_level')
+  if log_level is not None:
+    log_level = log_level.lower()
+    code.setup(log_level = log_level)
+
+
+
+
+def tree_events(e):
+  # Build the list of events that iterparse should produce for the data of this Element.
+  if e.is_entry:
+    return [('entry', e.data, (e.data_index, e.line_number, e.line_index))]
+  events = [('start', e.name, (e.data_index, e.line_number, e.line_index))]
+  for child in e.children:
+    events.extend(tree_events(child))
+  events.append(('end', e.name, (e.final_data_index, e.final_line_number, e.final_line_index)))
+  return events
+
+
+def tree_summary(e):
+  # Build a list of the attributes of every item in the tree, so that two trees can be compared.
+  if e.is_entry:
+    return [('entry', e.data, e.data_index, e.line_number, e.line_index, e.recursive_depth)]
+  summary = [(
+    'element', e.name, e.end_name, e.complete, e.data_index, e.line_number, e.line_index,
+    e.final_data_index, e.final_line_number, e.final_line_index, e.recursive_depth,
+  )]
+  for child in e.children:
+    assert child.parent is e
+    summary.extend(tree_summary(child))
+  return summary
+
+
+def feed_chunks(chunks, **kwargs):
+  parser = FeedParser(**kwargs)
+  for chunk in chunks:
+    parser.feed(chunk)
+  return parser.close()
+
+
+def parse_error(f, *args, **kwargs):
+  with pytest.raises(Exception) as exc_info:
+    f(*args, **kwargs)
+  return type(exc_info.value), str(exc_info.value)
+
+
+
+
+
+
+
+
+# ### SECTION
+# iterparse checks
+
+
+def test_iterparse():
+  d = '<a>hi</a>'
+  events = list(iterparse(d))
+  assert events == [
+    ('start', 'a', (0, 1, 0)),
+    ('entry', 'hi', (3, 1, 3)),
+    ('end', 'a', (8, 1, 8)),
+  ]
+
+
+@pytest.mark.parametrize('d_file', ['hello.txt', 'test1.txt', 'transaction1.txt'])
+def test_iterparse_2(d_file):
+  d = pkgutil.get_data(__name__, '../data/' + d_file).decode('ascii').strip()
+  e = Element.from_string(data=d)
+  assert list(iterparse(d)) == tree_events(e)
+
+
+def test_iterparse_escapes():
+  d = "<a>x\\<y\\>z\\\\\n<b></b></a>"
+  events = list(iterparse(d))
+  assert events[1] == ('entry', "x<y>z\\\n", (3, 1, 3))
+  assert [x[:2] for x in events[2:]] == [('start', 'b'), ('end', 'b'), ('end', 'a')]
+
+
+def test_iterparse_lazy():
+  # Events are produced as the data is processed, so an error near the end of the data is only raised when we get there.
+  d = '<a><b>1</b><c>2</c></a>x'
+  events = iterparse(d)
+  assert next(events) == ('start', 'a', (0, 1, 0))
+  assert next(events)[:2] == ('start', 'b')
+  with pytest.raises(ValueError):
+    list(events)
+
+
+def test_iterparse_deep():
+  n = 5000
+  d = '<a>' * n + 'x' + '</a>' * n
+  events = list(iterparse(d))
+  assert len(events) == 2 * n + 1
+  assert events[n] == ('entry', 'x', (3 * n, 1, 3 * n))
+
+
+@pytest.mark.parametrize('d', [
+  "<a>hello",
+  "<a>hello</b>",
+  "<a><b>hello</a>",
+  "<a b>hello</a>",
+  "<a>hel>lo</a>",
+  "<a>hel\\lo</a>",
+  "<a><b></b>/</a>",
+  "<a>\n<b>x</b>\n</a> ",
+])
+def test_iterparse_errors(d):
+  expected = parse_error(Element.from_string, data=d)
+  assert parse_error(lambda: list(iterparse(d))) == expected
+
+
+def test_iterparse_max_depth():
+  d = '<a><b><c>x</c></b></a>'
+  assert len(list(iterparse(d, max_depth=2))) == 7
+  expected = parse_error(Element.from_string, data=d, max_depth=1)
+  assert parse_error(lambda: list(iterparse(d, max_depth=1))) == expected
+
+
+
+
+
+
+
+
+
+# ### SECTION
+# FeedParser checks
+
+
+def test_feed_parser():
+  parser = FeedParser(events=True)
+  parser.feed('<a>h\\')
+  assert parser.read_events() == [('start', 'a', (0, 1, 0))]
+  parser.feed('<i</')
+  assert parser.read_events() == [('entry', 'h<i', (3, 1, 3))]
+  assert parser.read_events() == []
+  parser.feed('a>')
+  assert parser.read_events() == [('end', 'a', (10, 1, 10))]
+  e = parser.close()
+  assert e.name == 'a'
+  assert e.children[0].data == 'h<i'
+
+
+@pytest.mark.parametrize('d_file', ['hello.txt', 'test1.txt', 'transaction1.txt'])
+def test_feed_parser_2(d_file):
+  # Split the data at every possible position.
+  d = pkgutil.get_data(__name__, '../data/' + d_file).decode('ascii').strip()
+  expected = tree_summary(Element.from_string(data=d))
+  for i in range(len(d) + 1):
+    e = feed_chunks([d[:i], d[i:]])
+    assert tree_summary(e) == expected
+
+
+def test_feed_parser_bytes():
+  # Feed the data one byte at a time.
+  d = "<a>\n<b>x\\\\y</b>\n z\\>\n</a>"
+  e = feed_chunks(d)
+  assert tree_summary(e) == tree_summary(Element.from_string(data=d))
+  parser = FeedParser(build_tree=False, events=True)
+  events = []
+  for byte in d:
+    parser.feed(byte)
+    events.extend(parser.read_events())
+  assert parser.close() is None
+  assert events == list(iterparse(d))
+
+
+def test_feed_parser_deep():
+  n = 5000
+  d = '<a>' * n + 'x' + '</a>' * n
+  e = feed_chunks([d[:7000], d[7000:]])
+  for i in range(n - 1):
+    e = e.children[0]
+  assert e.recursive_depth == n - 1
+  assert e.children[0].data == 'x'
+
+
+@pytest.mark.parametrize('d', [
+  "<a>hello",
+  "<a>hello\\",
+  "<a>hello</b>",
+  "<a><b>hello</a>",
+  "<a b>hello</a>",
+  "<a>hel>lo</a>",
+  "<a><b></b>/</a>",
+])
+def test_feed_parser_errors(d):
+  expected = parse_error(Element.from_string, data=d)
+  for i in range(len(d) + 1):
+    assert parse_error(feed_chunks, [d[:i], d[i:]]) == expected
+
+
+def test_feed_parser_errors_2():
+  # The "Previous bytes" section contains the bytes before the invalid byte, even if they were in an earlier chunk.
+  d = '<a>' + 'x' * 60 + '\\q</a>'
+  expected = parse_error(Element.from_string, data=d)
+  assert parse_error(feed_chunks, [d[:40], d[40:]]) == expected
+  # Remaining data is detected as soon as it is fed.
+  parser = FeedParser()
+  parser.feed('<a>x</a>')
+  with pytest.raises(ValueError):
+    parser.feed(' ')
+  # No data can be fed after close().
+  parser = FeedParser()
+  parser.feed('<a>x</a>')
+  parser.close()
+  with pytest.raises(ValueError):
+    parser.feed('')
+
+
+def test_feed_parser_max_depth():
+  d = '<a><b><c>x</c></b></a>'
+  expected = parse_error(Element.from_string, data=d, max_depth=1)
+  assert parse_error(feed_chunks, [d[:5], d[5:]], max_depth=1) == expected
+
+
+def test_iterparse_file():
+  d = pkgutil.get_data(__name__, '../data/test1.txt').decode('ascii').strip()
+  events = list(iterparse_file(io.StringIO(d), chunk_size=7))
+  assert events == list(iterparse(d))
+
+
+def test_iterparse_file_2(tmp_path):
+  # A file written by write_to_file ends with a newline, which is allowed after the root Element.
+  d = pkgutil.get_data(__name__, '../data/test1.txt').decode('ascii').strip()
+  file = tmp_path / 'data.txt'
+  Element.from_string(data=d).write_to_file(str(file))
+  for chunk_size in [7, len(d), 65536]:
+    with open(str(file)) as f:
+      assert list(iterparse_file(f, chunk_size=chunk_size)) == list(iterparse(d))
+  assert feed_chunks([d + '\n\n']).data == d
+  assert feed_chunks([d, '\n', '\n']).data == d
+  # Other data after the newlines is still an error.
+  for chunks in [[d + '\nx'], [d + '\n', 'x'], [d, ' \n']]:
+    with pytest.raises(ValueError):
+      feed_chunks(chunks)